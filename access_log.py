@@ -0,0 +1,187 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from config import XRAY_ACCESS_LOG, IP_WINDOW_SECONDS, MAX_IPS_PER_USER, ACCESS_LOG_POLL_INTERVAL
+from async_utils import run_blocking
+
+# 2024/05/01 12:34:56.123456 from 1.2.3.4:51234 accepted tcp:example.com:443 [vmess-in >> direct] email: user
+ACCEPTED_RE = re.compile(
+    r'^(\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2})(?:\.\d+)? '
+    r'(?:from )?(?:tcp:|udp:)?\[?([0-9A-Fa-f.:]+?)\]?:\d+ '
+    r'accepted (\S+)'
+    r'(?: \[[^\]]*\])?'
+    r'(?: email: (\S+))?'
+)
+
+# Bounds that keep memory flat under heavy log volume
+MAX_READ_BYTES = 4 * 1024 * 1024
+MAX_TRACKED_IPS_PER_USER = 64
+RECENT_RECORDS = 1000
+
+class AccessLogFollower:
+    """Tail XRay's access log and index which IPs each user connects from.
+
+    The follower remembers its file offset and notices rotation (new inode)
+    and truncation, so every line is read exactly once. Distinct source IPs
+    per user are kept in a sliding window for multi-login detection.
+    """
+
+    def __init__(self, path=XRAY_ACCESS_LOG, window=IP_WINDOW_SECONDS, from_start=False):
+        self.path = path
+        self.window = window
+        self.from_start = from_start
+        self.file = None
+        self.inode = None
+        self.partial = b''
+        self.lines_read = 0
+        # email -> OrderedDict(ip -> last seen), oldest first
+        self.user_ips = {}
+        self.recent = deque(maxlen=RECENT_RECORDS)
+        self._time_cache = (None, 0)
+        self._lock = threading.RLock()
+
+    def _open(self, seek_end):
+        self.file = open(self.path, 'rb')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.partial = b''
+        if seek_end:
+            self.file.seek(0, os.SEEK_END)
+
+    def poll(self):
+        """Read and index everything appended since the last poll"""
+        with self._lock:
+            return self._poll()
+
+    def _poll(self):
+        if self.file is None:
+            try:
+                # Only the first open skips history; a file that appears after rotation is read whole
+                self._open(seek_end=self.inode is None and not self.from_start)
+            except FileNotFoundError:
+                return 0
+        count = self._read_available()
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return count
+        if st.st_ino != self.inode:
+            # Rotated: drain what was written before the rename, then switch
+            count += self._read_available()
+            self.file.close()
+            self.file = None
+            try:
+                self._open(seek_end=False)
+            except FileNotFoundError:
+                # Renamed again before we got to it, the next poll opens the new file
+                return count
+            count += self._read_available()
+        elif st.st_size < self.file.tell():
+            # Truncated in place (copytruncate)
+            self.file.seek(0)
+            self.partial = b''
+            count += self._read_available()
+        return count
+
+    def _read_available(self):
+        count = 0
+        while True:
+            chunk = self.file.read(MAX_READ_BYTES)
+            if not chunk:
+                return count
+            lines = (self.partial + chunk).split(b'\n')
+            # The last piece has no newline yet, keep it for the next read
+            self.partial = lines.pop()
+            for line in lines:
+                record = self.parse_line(line.decode(errors='replace'))
+                if record:
+                    self.add_record(record)
+                    count += 1
+            self.lines_read += len(lines)
+
+    def _timestamp(self, text):
+        """Parse log time, memoized since it changes at most once a second"""
+        if text != self._time_cache[0]:
+            self._time_cache = (text, time.mktime(time.strptime(text, "%Y/%m/%d %H:%M:%S")))
+        return self._time_cache[1]
+
+    def parse_line(self, line):
+        """Parse an 'accepted' line into (time, source ip, email, destination)"""
+        if 'accepted' not in line:
+            return None
+        match = ACCEPTED_RE.match(line)
+        if not match:
+            return None
+        return (self._timestamp(match.group(1)), match.group(2), match.group(4), match.group(3))
+
+    def add_record(self, record):
+        """Index one record in the per-user sliding window"""
+        self.recent.append(record)
+        ts, ip, email, _ = record
+        if not email:
+            return
+        ips = self.user_ips.get(email)
+        if ips is None:
+            ips = self.user_ips[email] = OrderedDict()
+        ips[ip] = ts
+        ips.move_to_end(ip)
+        if len(ips) > MAX_TRACKED_IPS_PER_USER:
+            ips.popitem(last=False)
+
+    def prune(self, now=None):
+        """Drop IPs that fell out of the window"""
+        cutoff = (now or time.time()) - self.window
+        with self._lock:
+            self._prune(cutoff)
+
+    def _prune(self, cutoff):
+        for email in list(self.user_ips):
+            ips = self.user_ips[email]
+            while ips and next(iter(ips.values())) < cutoff:
+                ips.popitem(last=False)
+            if not ips:
+                del self.user_ips[email]
+
+    def ips_for(self, email):
+        """Distinct source IPs of a user within the window"""
+        with self._lock:
+            self.prune()
+            return list(self.user_ips.get(email, ()))
+
+    def active_ips(self):
+        """Distinct source IPs of all users within the window"""
+        with self._lock:
+            self.prune()
+            ips = set()
+            for user_ips in self.user_ips.values():
+                ips.update(user_ips)
+            return list(ips)
+
+    def violations(self, limit=MAX_IPS_PER_USER):
+        """Users connecting from more than limit distinct IPs, as {email: [ips]}"""
+        if limit <= 0:
+            return {}
+        with self._lock:
+            self.prune()
+            return {email: list(ips) for email, ips in self.user_ips.items() if len(ips) > limit}
+
+    async def run(self, on_violation=None, interval=ACCESS_LOG_POLL_INTERVAL):
+        """Poll forever, reporting users over MAX_IPS_PER_USER"""
+        reported = set()
+        while True:
+            try:
+                await run_blocking(self.poll)
+                violations = self.violations()
+                # Report each user once until they drop back under the limit
+                new = {email: ips for email, ips in violations.items() if email not in reported}
+                reported = set(violations)
+                if new and on_violation:
+                    await on_violation(new)
+            except Exception as e:
+                print(f"Error following XRay access log: {e}")
+            await asyncio.sleep(interval)
+
+follower = AccessLogFollower()
@@ -0,0 +1,98 @@
+"""Node agent: lets a remote bot manage this server's XRay.
+
+Run on every remote node listed in the bot's nodes.json:
+
+    AGENT_TOKEN=secret python agent.py --listen 0.0.0.0:7443
+"""
+import argparse
+import asyncio
+import functools
+import hmac
+import ssl
+from config import AGENT_LISTEN, AGENT_TOKEN, XRAY_CONFIG_PATH, XRAY_SERVICE
+from async_utils import run_blocking
+from xray_manager import CommitScheduler, apply_mutations, get_vmess_users, start_xray, prepare_shards, upgrade_xray_config
+from nodes import MAX_MESSAGE, encode_message, read_message
+
+class Agent:
+    """Serve JSON-line requests from the bot on persistent connections"""
+
+    def __init__(self, token, config_path=XRAY_CONFIG_PATH, api_address=None, service=XRAY_SERVICE):
+        self.token = token
+        self.config_path = config_path
+        # Requests from all of the bot's pooled connections coalesce here
+        self.scheduler = CommitScheduler(apply=functools.partial(
+            apply_mutations, config_path=config_path, api_address=api_address, service=service
+        ))
+
+    async def handle(self, request):
+        """Run one request and return its result"""
+        op = request.get('op')
+        if op == 'ping':
+            return 'pong'
+        if op == 'apply':
+            results = await self.scheduler.submit_many([tuple(m) for m in request['mutations']])
+            return [list(result) for result in results]
+        if op == 'users':
+            return await run_blocking(get_vmess_users, self.config_path)
+        raise ValueError(f"Unknown op: {op}")
+
+    async def serve_connection(self, reader, writer):
+        """Authenticate once, then answer requests until the bot disconnects"""
+        try:
+            hello = await read_message(reader)
+            if hello.get('op') != 'hello' or not hmac.compare_digest(str(hello.get('token', '')), self.token):
+                writer.write(encode_message({'ok': False, 'error': "Authentication failed"}))
+                await writer.drain()
+                return
+            writer.write(encode_message({'ok': True}))
+            await writer.drain()
+            while True:
+                request = await read_message(reader)
+                try:
+                    response = {'id': request.get('id'), 'ok': True, 'result': await self.handle(request)}
+                except Exception as e:
+                    response = {'id': request.get('id'), 'ok': False, 'error': str(e)}
+                writer.write(encode_message(response))
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(agent, host, port, ssl_context=None):
+    """Listen for the bot forever"""
+    server = await asyncio.start_server(agent.serve_connection, host, port, ssl=ssl_context, limit=MAX_MESSAGE)
+    print(f"Agent listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="XRay node agent for the VMess bot")
+    parser.add_argument('--listen', default=AGENT_LISTEN, help='host:port to listen on')
+    parser.add_argument('--token', default=AGENT_TOKEN, help='shared secret (default: AGENT_TOKEN)')
+    parser.add_argument('--config', default=XRAY_CONFIG_PATH, help='XRay config file')
+    parser.add_argument('--api', default=None, help='XRay API address (default: XRAY_API_ADDRESS)')
+    parser.add_argument('--service', default=XRAY_SERVICE, help="systemd unit to restart, '' to never restart")
+    parser.add_argument('--cert', help='TLS certificate file')
+    parser.add_argument('--key', help='TLS private key file')
+    args = parser.parse_args()
+
+    if not args.token:
+        parser.error("a token is required (--token or AGENT_TOKEN)")
+    ssl_context = None
+    if args.cert:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.cert, args.key)
+
+    if args.config == XRAY_CONFIG_PATH:
+        prepare_shards(args.service)
+    upgrade_xray_config(args.config, args.service, int(args.api.rsplit(':', 1)[1]) if args.api else None)
+    if args.service and not start_xray(args.config):
+        print("Error starting XRay")
+    host, port = args.listen.rsplit(':', 1)
+    agent = Agent(args.token, args.config, args.api, args.service)
+    asyncio.run(serve(agent, host, int(port), ssl_context))
+
+if __name__ == "__main__":
+    main()
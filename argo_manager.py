@@ -1,7 +1,28 @@
+import asyncio
 import subprocess
 import json
 import os
-from config import CLOUDFLARED_PATH, XRAY_LOCAL_PORT
+import re
+import time
+from collections import deque
+from config import (
+    CLOUDFLARED_PATH, XRAY_LOCAL_PORT, CLOUDFLARED_METRICS_PORT,
+    TUNNEL_HEALTH_INTERVAL, TUNNEL_BACKOFF_MAX
+)
+from async_utils import run_blocking
+import sharding
+
+QUICK_TUNNEL_URL_RE = re.compile(r'https://[\w-]+\.trycloudflare\.com')
+QUICK_TUNNEL_TIMEOUT = 30
+
+# Restart backoff: 1s, 2s, 4s, ... capped at TUNNEL_BACKOFF_MAX
+BACKOFF_BASE = 1
+# A process that stayed up this long gets its backoff reset
+STABLE_AFTER = 60
+# Consecutive failed readiness probes before the process is restarted
+UNHEALTHY_PROBES = 3
+LOG_LINES = 50
+STOP_TIMEOUT = 10
 
 def install_cloudflared():
     """Install cloudflared if not exists"""
@@ -109,93 +130,285 @@ def get_tunnel_info(tunnel_name):
     except subprocess.CalledProcessError as e:
         return f"Error: {e.stderr}"
 
-def start_argo_tunnel(tunnel_name, domain=None):
-    """Start Argo tunnel with config"""
+def write_tunnel_config(tunnel_name, domain=None):
+    """Write the cloudflared config for a named tunnel, return its path"""
+    config_path = f"/tmp/argo_{tunnel_name}.yaml"
+    
+    # Get tunnel UUID
+    list_output = list_argo_tunnels()
+    tunnel_id = None
+    for line in list_output.split('\n'):
+        if tunnel_name in line:
+            tunnel_id = line.split()[0]
+            break
+    
+    if not tunnel_id:
+        raise ValueError("Tunnel ID not found")
+    
+    config = {
+        'tunnel': tunnel_id,
+        'credentials-file': f'/root/.cloudflared/{tunnel_id}.json',
+        'ingress': [
+            {
+                'service': f'http://localhost:{XRAY_LOCAL_PORT}'
+            }
+        ]
+    }
+    
+    if domain:
+        config['ingress'].insert(0, {
+            'hostname': domain,
+            'service': f'http://localhost:{XRAY_LOCAL_PORT}'
+        })
+    
+    # Each shard's WebSocket path goes straight to its own XRay
+    shard_rules = []
+    for shard in sharding.shards:
+        rule = {'path': f'^{shard.path}$', 'service': f'http://localhost:{shard.port}'}
+        if domain:
+            rule = {'hostname': domain, **rule}
+        shard_rules.append(rule)
+    config['ingress'][:0] = shard_rules
+    
+    # Write config
+    with open(config_path, 'w') as f:
+        import yaml
+        yaml.dump(config, f)
+    return config_path
+
+async def probe_ready(port, timeout=3):
+    """Ask cloudflared's metrics server whether the tunnel has a live connection"""
     try:
-        # Create config
-        config_path = f"/tmp/argo_{tunnel_name}.yaml"
-        
-        # Get tunnel UUID
-        list_output = list_argo_tunnels()
-        tunnel_id = None
-        for line in list_output.split('\n'):
-            if tunnel_name in line:
-                tunnel_id = line.split()[0]
-                break
-        
-        if not tunnel_id:
-            return False, "Tunnel ID not found"
-        
-        config = {
-            'tunnel': tunnel_id,
-            'credentials-file': f'/root/.cloudflared/{tunnel_id}.json',
-            'ingress': [
-                {
-                    'service': f'http://localhost:{XRAY_LOCAL_PORT}'
-                }
-            ]
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        writer.write(b"GET /ready HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n")
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        # /ready answers 200 once at least one edge connection is registered
+        return status_line.split()[1:2] == [b"200"]
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+class TunnelSupervisor:
+    """Own one cloudflared process and keep it running.
+
+    stdout and stderr are streamed line by line, so the quick tunnel URL is
+    known the moment cloudflared prints it. Readiness is probed on
+    cloudflared's metrics server; a process that exits or stays unready is
+    restarted with exponential backoff.
+    """
+
+    def __init__(self, name, args, metrics_port, health_interval=TUNNEL_HEALTH_INTERVAL, backoff_max=TUNNEL_BACKOFF_MAX):
+        self.name = name
+        self.args = args
+        self.metrics_port = metrics_port
+        self.health_interval = health_interval
+        self.backoff_max = backoff_max
+        self.process = None
+        self.url = None
+        self.ready = False
+        self.started_at = None
+        self.restarts = 0
+        self.last_exit = None
+        self.last_error = None
+        self.next_restart = None
+        self.logs = deque(maxlen=LOG_LINES)
+        self._url_found = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def command(self):
+        """cloudflared command line, with the metrics server used for probing"""
+        return [
+            CLOUDFLARED_PATH, 'tunnel', '--no-autoupdate',
+            '--metrics', f'127.0.0.1:{self.metrics_port}',
+            *self.args
+        ]
+
+    def start(self):
+        """Start supervising in the background"""
+        self._stopping = False
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self, timeout=STOP_TIMEOUT):
+        """Stop the process for good, killing it if it won't exit"""
+        self._stopping = True
+        process = self.process
+        if process and process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def wait_for_url(self, timeout=QUICK_TUNNEL_TIMEOUT):
+        """Wait until cloudflared prints a trycloudflare.com URL"""
+        try:
+            await asyncio.wait_for(self._url_found.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.url
+
+    def uptime(self):
+        """Seconds the current process has been running, 0 if it is down"""
+        return time.time() - self.started_at if self.started_at else 0
+
+    def status(self):
+        """Snapshot for display"""
+        return {
+            'name': self.name,
+            'running': self.process is not None and self.process.returncode is None,
+            'pid': self.process.pid if self.process else None,
+            'ready': self.ready,
+            'url': self.url,
+            'uptime': self.uptime(),
+            'restarts': self.restarts,
+            'last_exit': self.last_exit,
+            'last_error': self.last_error,
+            'next_restart': self.next_restart,
         }
-        
-        if domain:
-            config['ingress'].insert(0, {
-                'hostname': domain,
-                'service': f'http://localhost:{XRAY_LOCAL_PORT}'
-            })
-        
-        # Write config
-        with open(config_path, 'w') as f:
-            import yaml
-            yaml.dump(config, f)
-        
-        # Start tunnel in background
-        subprocess.Popen(
-            [CLOUDFLARED_PATH, 'tunnel', '--config', config_path, 'run', tunnel_name],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
+
+    async def _supervise(self):
+        failures = 0
+        while not self._stopping:
+            started = time.monotonic()
+            try:
+                await self._run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Error running cloudflared tunnel {self.name}: {e}")
+            if self._stopping:
+                break
+            if time.monotonic() - started >= STABLE_AFTER:
+                failures = 0
+            delay = min(BACKOFF_BASE * 2 ** failures, self.backoff_max)
+            failures += 1
+            self.restarts += 1
+            self.next_restart = time.time() + delay
+            await asyncio.sleep(delay)
+            self.next_restart = None
+
+    async def _run_once(self):
+        """Run cloudflared until it exits or fails its health checks"""
+        self.ready = False
+        self.url = None
+        self._url_found.clear()
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command(),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
-        
+        self.started_at = time.time()
+        tasks = [
+            asyncio.create_task(self._read_stream(self.process.stdout)),
+            asyncio.create_task(self._read_stream(self.process.stderr)),
+        ]
+        health = asyncio.create_task(self._check_health())
+        try:
+            self.last_exit = await self.process.wait()
+            # Drain whatever the process wrote before exiting
+            await asyncio.gather(*tasks)
+        finally:
+            health.cancel()
+            for task in tasks:
+                task.cancel()
+            if self.process.returncode is None:
+                self.process.kill()
+            self.ready = False
+            self.started_at = None
+
+    async def _read_stream(self, stream):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # Line longer than the stream buffer, skip it
+                continue
+            if not line:
+                return
+            text = line.decode(errors='replace').rstrip()
+            self.logs.append(text)
+            if self.url is None:
+                match = QUICK_TUNNEL_URL_RE.search(text)
+                if match:
+                    self.url = match.group(0)
+                    self._url_found.set()
+            if 'Registered tunnel connection' in text:
+                self.ready = True
+
+    async def _check_health(self):
+        unready = 0
+        while True:
+            await asyncio.sleep(self.health_interval)
+            self.ready = await probe_ready(self.metrics_port)
+            if self.ready:
+                unready = 0
+                continue
+            unready += 1
+            if unready >= UNHEALTHY_PROBES:
+                self.last_error = "Readiness probe failed"
+                self.process.terminate()
+                return
+
+# Supervised tunnels by name
+supervisors = {}
+
+async def supervise_tunnel(name, args):
+    """(Re)start a supervised cloudflared process under name"""
+    existing = supervisors.get(name)
+    if existing:
+        await existing.stop()
+        port = existing.metrics_port
+    else:
+        port = CLOUDFLARED_METRICS_PORT + len(supervisors)
+    supervisor = TunnelSupervisor(name, args, port)
+    supervisors[name] = supervisor
+    supervisor.start()
+    return supervisor
+
+async def start_argo_tunnel(tunnel_name, domain=None):
+    """Start a supervised Argo tunnel with config"""
+    try:
+        config_path = await run_blocking(write_tunnel_config, tunnel_name, domain)
+        await supervise_tunnel(tunnel_name, ['--config', config_path, 'run', tunnel_name])
         return True, f"Tunnel {tunnel_name} started"
     except Exception as e:
         return False, str(e)
 
-def stop_argo_tunnel():
-    """Stop all Argo tunnels"""
+async def stop_argo_tunnel():
+    """Stop all supervised Argo tunnels"""
     try:
-        subprocess.run(['pkill', '-f', 'cloudflared'], check=False)
+        await asyncio.gather(*(supervisor.stop() for supervisor in supervisors.values()))
+        supervisors.clear()
         return True, "Argo tunnels stopped"
     except Exception as e:
         return False, str(e)
 
-def get_quick_tunnel_url():
-    """Get quick tunnel URL (temporary tunnel)"""
+async def get_quick_tunnel_url():
+    """Start a supervised quick tunnel (temporary tunnel) and return its URL"""
     try:
-        # Start quick tunnel
-        process = subprocess.Popen(
-            [CLOUDFLARED_PATH, 'tunnel', '--url', f'http://localhost:{XRAY_LOCAL_PORT}'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        
-        # Wait for URL
-        import time
-        for _ in range(30):
-            if process.poll() is not None:
-                break
-            time.sleep(1)
-            
-            # Check for trycloudflare.com URL
-            try:
-                with open('/tmp/cloudflared.log', 'r') as f:
-                    content = f.read()
-                    if 'trycloudflare.com' in content:
-                        import re
-                        match = re.search(r'https://[\w-]+\.trycloudflare\.com', content)
-                        if match:
-                            return True, match.group(0)
-            except:
-                pass
-        
+        supervisor = await supervise_tunnel('quick', ['--url', f'http://localhost:{XRAY_LOCAL_PORT}'])
+        url = await supervisor.wait_for_url()
+        if url:
+            return True, url
         return False, "Failed to get quick tunnel URL"
     except Exception as e:
         return False, str(e)
+
+def tunnel_status():
+    """Status of every supervised tunnel"""
+    return [supervisor.status() for supervisor in supervisors.values()]
@@ -0,0 +1,38 @@
+import asyncio
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from config import IO_WORKERS
+
+# Bounded pool for blocking file and database work, so handlers never
+# block the event loop and a burst can't spawn unbounded threads
+_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking function in the I/O thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+async def run_command(args, timeout=5, check=False):
+    """Async equivalent of subprocess.run(args, capture_output=True, text=True)"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise subprocess.TimeoutExpired(args, timeout)
+
+    result = subprocess.CompletedProcess(
+        args,
+        process.returncode,
+        stdout.decode(errors='replace'),
+        stderr.decode(errors='replace')
+    )
+    if check:
+        result.check_returncode()
+    return result
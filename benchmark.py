@@ -0,0 +1,552 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid as uuid_lib
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# A regression is flagged when ops/s drops or p99 grows by more than this
+DEFAULT_THRESHOLD = 0.10
+
+def synthetic_stat_names(users):
+    """Counter names for users plus a few inbounds/outbounds"""
+    for i in range(users):
+        for direction in ('uplink', 'downlink'):
+            yield f"user>>>user{i}@bench>>>traffic>>>{direction}"
+    for tag in ('vmess-in', 'api'):
+        for direction in ('uplink', 'downlink'):
+            yield f"inbound>>>{tag}>>>traffic>>>{direction}"
+    for tag in ('direct', 'blocked'):
+        for direction in ('uplink', 'downlink'):
+            yield f"outbound>>>{tag}>>>traffic>>>{direction}"
+
+def synthetic_stats_lines(users):
+    """Stats output in the JSON layout printed by 'xray api statsquery'"""
+    yield '{\n'
+    yield '    "stat": [\n'
+    for i, name in enumerate(synthetic_stat_names(users)):
+        yield '        {\n'
+        yield f'            "name": "{name}",\n'
+        yield f'            "value": "{(i * 7919) % 10**9}"\n'
+        yield '        },\n'
+    yield '    ]\n'
+    yield '}\n'
+
+def measure(func, *args):
+    """Return (seconds, peak traced bytes) for one call of func.
+
+    Timing and memory are taken in separate runs because tracemalloc slows
+    allocation-heavy code down considerably.
+    """
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+def bench_stats(sizes):
+    """Benchmark monitor.parse_stats on string, streamed and structured input"""
+    from monitor import parse_stats
+
+    print(f"{'users':>8} {'input':<10} {'seconds':>9} {'peak MiB':>9}")
+    for users in sizes:
+        text = ''.join(synthetic_stats_lines(users))
+        pairs = [(name, i) for i, name in enumerate(synthetic_stat_names(users))]
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            f.write(text)
+            path = f.name
+
+        def parse_file():
+            with open(path) as stream:
+                parse_stats(stream)
+
+        try:
+            for label, func, args in (
+                ('string', parse_stats, (text,)),
+                ('stream', parse_file, ()),
+                ('api', parse_stats, (pairs,)),
+            ):
+                seconds, peak = measure(func, *args)
+                print(f"{users:>8} {label:<10} {seconds:>9.4f} {peak / 2**20:>9.2f}")
+        finally:
+            os.unlink(path)
+
+def write_synthetic_proc_tcp(path, sockets, port):
+    """Write a /proc/net/tcp-style table, half the sockets on our port"""
+    states = ['01', '01', '01', '06', '08', '0A']
+    with open(path, 'w') as f:
+        f.write("  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n")
+        for i in range(sockets):
+            local_port = port if i % 2 == 0 else 30000 + i % 20000
+            remote_ip = (10 << 24) | (i % 50000)
+            f.write(
+                f"{i:4d}: 0100007F:{local_port:04X} {remote_ip.to_bytes(4, 'big')[::-1].hex().upper()}:{40000 + i % 20000:04X} "
+                f"{states[i % len(states)]} 00000000:00000000 00:00000000 00000000     0        0 {100000 + i} "
+                "1 0000000000000000 20 4 30 10 -1\n"
+            )
+
+def bench_sockets(sizes):
+    """Benchmark monitor.read_socket_table on synthetic proc files"""
+    from monitor import read_socket_table
+
+    port = 54354
+    print(f"{'sockets':>8} {'seconds':>9} {'peak MiB':>9} {'ips':>7}")
+    for sockets in sizes:
+        with tempfile.NamedTemporaryFile('w', suffix='.tcp', delete=False) as f:
+            path = f.name
+        try:
+            write_synthetic_proc_tcp(path, sockets, port)
+            seconds, peak = measure(read_socket_table, {port}, (path,))
+            ips = len(read_socket_table({port}, (path,))['ips'])
+            print(f"{sockets:>8} {seconds:>9.4f} {peak / 2**20:>9.2f} {ips:>7}")
+        finally:
+            os.unlink(path)
+
+def synthetic_uuid(i):
+    """Deterministic UUID for synthetic user i"""
+    return str(uuid_lib.UUID(int=i + 1))
+
+def preload_database(users):
+    """Fill the (temp) database with users synthetic accounts"""
+    import database
+    database.add_users([(f"user{i}", synthetic_uuid(i)) for i in range(users)])
+    database.flush()
+
+def preload_config(users):
+    """Write a (temp) XRay config holding users synthetic clients"""
+    from xray_manager import read_xray_config, write_xray_config, find_vmess_inbound
+    config = read_xray_config()
+    find_vmess_inbound(config)['settings']['clients'] = [
+        {"id": synthetic_uuid(i), "alterId": 0, "email": f"user{i}"} for i in range(users)
+    ]
+    write_xray_config(config)
+
+def setup_db_add_user(users, ops):
+    from database import add_user
+    preload_database(users)
+    return add_user, [(f"new{i}", str(uuid_lib.uuid4())) for i in range(ops)]
+
+def setup_db_get_user(users, ops):
+    from database import get_user
+    preload_database(users)
+    rng = random.Random(0)
+    return get_user, [(f"user{rng.randrange(users)}",) for _ in range(ops)]
+
+def setup_db_list_users(users, ops):
+    from database import list_users
+    preload_database(users)
+    return list_users, [()] * ops
+
+def setup_xray_add_user(users, ops):
+    from xray_manager import add_vmess_user
+    preload_config(users)
+    return add_vmess_user, [(f"new{i}", str(uuid_lib.uuid4())) for i in range(ops)]
+
+def setup_xray_remove_user(users, ops):
+    from xray_manager import remove_vmess_user
+    preload_database(users)
+    preload_config(users)
+    rng = random.Random(0)
+    return remove_vmess_user, [(f"user{i}",) for i in rng.sample(range(users), min(ops, users))]
+
+def setup_vmess_link(users, ops):
+    from utils import generate_vmess_link
+    return generate_vmess_link, [(f"user{i % users}", synthetic_uuid(i % users)) for i in range(ops)]
+
+def setup_parse_stats(users, ops):
+    from monitor import parse_xray_stats
+    text = ''.join(synthetic_stats_lines(users))
+    return parse_xray_stats, [(text,)] * ops
+
+def setup_reconcile_diff(users, ops):
+    from database import active_accounts, set_active
+    from nodes import fleet
+    from reconcile import diff, expected_clients
+    from xray_manager import apply_mutations, get_vmess_users
+    preload_database(users)
+    preload_config(users)
+    # 1% drift each way: clients missing from XRay and revoked accounts still in it
+    rng = random.Random(0)
+    drift = rng.sample(range(users), max(2, users // 50))
+    apply_mutations([("remove", f"user{i}") for i in drift[::2]])
+    set_active([f"user{i}" for i in drift[1::2]], False)
+    name = fleet.default_names()[0]
+
+    def plan():
+        return diff(expected_clients(active_accounts(), fleet)[name], get_vmess_users())
+    return plan, [()] * ops
+
+# name -> (setup(users, ops) returning (func, [args per op]), default op count)
+SUITE = {
+    'db.add_user': (setup_db_add_user, 1000),
+    'db.get_user': (setup_db_get_user, 1000),
+    'db.list_users': (setup_db_list_users, 20),
+    'xray.add_vmess_user': (setup_xray_add_user, 20),
+    'xray.remove_vmess_user': (setup_xray_remove_user, 20),
+    'utils.generate_vmess_link': (setup_vmess_link, 1000),
+    'monitor.parse_xray_stats': (setup_parse_stats, 5),
+    'reconcile.diff': (setup_reconcile_diff, 5),
+}
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def run_one(name, users, ops):
+    """Time every op of one benchmark in this process and return its result"""
+    setup, default_ops = SUITE[name]
+    func, calls = setup(users, ops or default_ops)
+    latencies = []
+    started = time.perf_counter()
+    for args in calls:
+        op_started = time.perf_counter_ns()
+        func(*args)
+        latencies.append(time.perf_counter_ns() - op_started)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'bench': name,
+        'users': users,
+        'ops': len(latencies),
+        'ops_per_sec': round(len(latencies) / elapsed, 2),
+        'p50_us': round(percentile(latencies, 0.50) / 1000, 2),
+        'p90_us': round(percentile(latencies, 0.90) / 1000, 2),
+        'p99_us': round(percentile(latencies, 0.99) / 1000, 2),
+        'max_us': round(latencies[-1] / 1000, 2),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+    }
+
+def run_isolated(name, users, ops):
+    """Run one benchmark in a fresh process and temp dir.
+
+    A new process per run keeps peak RSS meaningful and state (database
+    cache, config file) from leaking between runs. XRay restarts and the
+    API are disabled, so nothing outside the temp dir is touched.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(
+            os.environ,
+            XRAY_CONFIG_PATH=os.path.join(workdir, 'config.json'),
+            XRAY_SERVICE='',
+            USE_XRAY_API='false',
+            DATABASE_FILE=os.path.join(workdir, 'users.db'),
+            TRAFFIC_DB_FILE=os.path.join(workdir, 'traffic.db'),
+            NODES_FILE=os.path.join(workdir, 'nodes.json'),
+            ADMIN_ID=os.environ.get('ADMIN_ID', '0'),
+        )
+        command = [sys.executable, os.path.abspath(__file__), 'run', name, '--users', str(users)]
+        if ops:
+            command += ['--ops', str(ops)]
+        output = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True, check=True)
+        return json.loads(output.stdout.strip().splitlines()[-1])
+
+def bench_suite(sizes, names, ops, output):
+    """Run the suite and write machine-readable results"""
+    results = []
+    print(f"{'bench':<27} {'users':>7} {'ops/s':>11} {'p50 us':>10} {'p99 us':>10} {'RSS MiB':>8}", file=sys.stderr)
+    for name in names:
+        for users in sizes:
+            result = run_isolated(name, users, ops)
+            results.append(result)
+            print(
+                f"{name:<27} {users:>7} {result['ops_per_sec']:>11.1f} {result['p50_us']:>10.1f} "
+                f"{result['p99_us']:>10.1f} {result['peak_rss_mib']:>8.1f}",
+                file=sys.stderr
+            )
+    report = {
+        'meta': {
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+def compare_reports(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Return [(bench, users, metric, old, new, change, regressed)] for runs in both reports"""
+    old = {(r['bench'], r['users']): r for r in baseline['results']}
+    rows = []
+    for result in current['results']:
+        before = old.get((result['bench'], result['users']))
+        if before is None:
+            continue
+        # Higher is better for throughput, lower for latency and memory
+        for metric, higher_is_better in (('ops_per_sec', True), ('p99_us', False), ('peak_rss_mib', False)):
+            change = (result[metric] - before[metric]) / before[metric] if before[metric] else 0.0
+            regressed = -change > threshold if higher_is_better else change > threshold
+            rows.append((result['bench'], result['users'], metric, before[metric], result[metric], change, regressed))
+    return rows
+
+def bench_compare(baseline_path, current_path, threshold):
+    """Print a comparison and exit non-zero if anything regressed"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+    rows = compare_reports(baseline, current, threshold)
+    print(f"{'bench':<27} {'users':>7} {'metric':<13} {'baseline':>11} {'current':>11} {'change':>8}")
+    for bench, users, metric, before, after, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{bench:<27} {users:>7} {metric:<13} {before:>11.1f} {after:>11.1f} {change:>+8.1%}{flag}")
+    regressions = sum(1 for row in rows if row[-1])
+    print(f"\n{regressions} regression(s) above {threshold:.0%}")
+    return 1 if regressions else 0
+
+def free_port():
+    """Ask the kernel for an unused localhost port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_agents(count, workdir, token):
+    """Start count stand-in agents on temp configs, return (processes, nodes)"""
+    from nodes import RemoteNode
+
+    env = dict(
+        os.environ,
+        USE_XRAY_API='false',
+        ADMIN_ID=os.environ.get('ADMIN_ID', '0'),
+        DATABASE_FILE=os.path.join(workdir, 'users.db'),
+    )
+    agent = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent.py')
+    processes, nodes = [], []
+    for i in range(count):
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, agent, '--listen', f'127.0.0.1:{port}', '--token', token,
+             '--config', os.path.join(workdir, f'node{i}.json'), '--service', ''],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL
+        ))
+        nodes.append(RemoteNode(f'node{i}', '127.0.0.1', port, token))
+    return processes, nodes
+
+async def wait_for_agents(fleet, timeout=10):
+    """Wait until every agent answers a ping"""
+    deadline = time.monotonic() + timeout
+    while True:
+        replies = await fleet.ping()
+        if all(ok for ok, _ in replies.values()):
+            return
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Agents not reachable: {replies}")
+        await asyncio.sleep(0.1)
+
+async def run_fleet(node_counts, users):
+    """Time fleet.add_users on each fleet size, then the same removals node by node"""
+    from nodes import Fleet
+    from xray_manager import generate_uuid
+
+    print(f"{'nodes':>6} {'fan-out s':>10} {'sequential s':>13} {'speedup':>8}")
+    for count in node_counts:
+        with tempfile.TemporaryDirectory() as workdir:
+            processes, nodes = start_agents(count, workdir, 'bench')
+            fleet = Fleet(nodes)
+            try:
+                await wait_for_agents(fleet)
+                accounts = [(f"bench{i}", generate_uuid()) for i in range(users)]
+                start = time.perf_counter()
+                await fleet.add_users(accounts)
+                concurrent = time.perf_counter() - start
+
+                # Same work, one node after the other
+                removals = [{'username': name, 'uuid': uuid, 'nodes': []} for name, uuid in accounts]
+                start = time.perf_counter()
+                for name in fleet.nodes:
+                    await Fleet([fleet.nodes[name]]).remove_users(removals)
+                sequential = time.perf_counter() - start
+                print(f"{count:>6} {concurrent:>10.4f} {sequential:>13.4f} {sequential / concurrent:>7.1f}x")
+            finally:
+                await fleet.close()
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+
+def bench_fleet(node_counts, users):
+    """Benchmark fan-out to several local stand-in agents against one-by-one"""
+    asyncio.run(run_fleet(node_counts, users))
+
+# Stand-in for 'xray run -config': a reuseport echo server that answers with its pid
+FAKE_XRAY = """\
+import json, os, signal, socket, sys, threading
+config = json.load(open(sys.argv[sys.argv.index('-config') + 1]))
+pid = str(os.getpid()).encode()
+def serve(conn):
+    with conn:
+        while data := conn.recv(4096):
+            conn.sendall(pid + b':' + data)
+def accept(sock):
+    while True:
+        threading.Thread(target=serve, args=(sock.accept()[0],), daemon=True).start()
+for inbound in config['inbounds']:
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((inbound.get('listen', '127.0.0.1'), inbound['port']))
+    sock.listen(512)
+    threading.Thread(target=accept, args=(sock,), daemon=True).start()
+print('Xray (stand-in) started', flush=True)
+signal.sigwait({signal.SIGTERM, signal.SIGINT})
+"""
+
+def echo(sock):
+    """One round trip, returns the pid that answered"""
+    sock.sendall(b'ping')
+    reply = sock.recv(4096)
+    if not reply.endswith(b':ping'):
+        raise ConnectionError("Bad echo")
+    return int(reply.split(b':', 1)[0])
+
+def hold_session(port, seconds, outcome):
+    """Keep one connection busy for seconds, recording whether it survived"""
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=2) as sock:
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                echo(sock)
+                time.sleep(0.05)
+        outcome.append(True)
+    except OSError:
+        outcome.append(False)
+
+def open_connections(port, stop, results):
+    """Open short connections until stop is set, [(monotonic time, pid or None)]"""
+    while not stop.is_set():
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=2) as sock:
+                results.append((time.monotonic(), echo(sock)))
+        except OSError:
+            results.append((time.monotonic(), None))
+
+def run_reload(grace, sessions, session_seconds, workdir):
+    """One handoff under load, returns a result row"""
+    import threading
+    from bluegreen import BlueGreenReloader, ensure_reuseport, reload_stats
+
+    binary = os.path.join(workdir, 'xray')
+    with open(binary, 'w') as f:
+        f.write(f"#!{sys.executable}\n" + FAKE_XRAY)
+    os.chmod(binary, 0o755)
+    port = free_port()
+    config = {'inbounds': [{'port': port, 'listen': '127.0.0.1', 'protocol': 'vmess'}]}
+    ensure_reuseport(config)
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+
+    reloader = BlueGreenReloader(binary=binary, grace=grace, log_path=os.devnull)
+    if not reloader.start(config_path, [port]):
+        raise RuntimeError("Stand-in XRay did not start")
+    blue = reloader.processes[config_path].pid
+
+    outcome, connections, stop = [], [], threading.Event()
+    threads = [threading.Thread(target=hold_session, args=(port, session_seconds, outcome)) for _ in range(sessions)]
+    threads.append(threading.Thread(target=open_connections, args=(port, stop, connections)))
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    if not reloader.reload(config_path, [port]):
+        raise RuntimeError("Stand-in XRay handoff failed")
+    handed_over = time.monotonic()
+    reloader.wait_drained()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    reloader.stop()
+
+    after = [pid for at, pid in connections if at > handed_over]
+    return {
+        'grace': grace,
+        'handoff_s': reload_stats['last_handoff_seconds'],
+        'drain_s': reload_stats['last_drain_seconds'],
+        'dropped': reload_stats['last_dropped'],
+        'sessions_ok': sum(outcome),
+        'sessions_cut': len(outcome) - sum(outcome),
+        'connections': len(connections),
+        'refused': sum(1 for _, pid in connections if pid is None),
+        'to_old_after': sum(1 for pid in after if pid == blue),
+    }
+
+def bench_reload(graces, sessions, session_seconds):
+    """Blue/green handoff on loopback: handoff time, drain time and dropped sessions"""
+    print(f"{'grace s':>8} {'handoff s':>10} {'drain s':>8} {'dropped':>8} {'sess ok':>8} "
+          f"{'sess cut':>9} {'new conns':>10} {'refused':>8} {'to old':>7}")
+    for grace in graces:
+        with tempfile.TemporaryDirectory() as workdir:
+            r = run_reload(grace, sessions, session_seconds, workdir)
+        print(f"{r['grace']:>8} {r['handoff_s']:>10.3f} {r['drain_s']:>8.3f} {r['dropped']:>8} {r['sessions_ok']:>8} "
+              f"{r['sessions_cut']:>9} {r['connections']:>10} {r['refused']:>8} {r['to_old_after']:>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the bot's hot paths")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    stats = sub.add_parser('stats', help='XRay stats parsing')
+    stats.add_argument('--users', type=int, nargs='+', default=DEFAULT_SIZES)
+
+    sockets = sub.add_parser('sockets', help='/proc/net/tcp connection counting')
+    sockets.add_argument('--sockets', type=int, nargs='+', default=DEFAULT_SIZES)
+
+    fleet = sub.add_parser('fleet', help='multi-node fan-out against local stand-in agents')
+    fleet.add_argument('--nodes', type=int, nargs='+', default=[1, 4, 8])
+    fleet.add_argument('--users', type=int, default=100)
+
+    reload = sub.add_parser('reload', help='blue/green XRay handoff against a loopback stand-in')
+    reload.add_argument('--grace', type=float, nargs='+', default=[10, 0.5])
+    reload.add_argument('--sessions', type=int, default=20)
+    reload.add_argument('--session-seconds', type=float, default=2)
+
+    suite = sub.add_parser('suite', help='database, config, link and stats benchmarks as JSON')
+    suite.add_argument('--users', type=int, nargs='+', default=DEFAULT_SIZES)
+    suite.add_argument('--bench', nargs='+', choices=list(SUITE), default=list(SUITE))
+    suite.add_argument('--ops', type=int, default=0, help='ops per run (default: per benchmark)')
+    suite.add_argument('--output', help='write JSON here instead of stdout')
+
+    run = sub.add_parser('run', help='run one suite benchmark in this process')
+    run.add_argument('bench', choices=list(SUITE))
+    run.add_argument('--users', type=int, required=True)
+    run.add_argument('--ops', type=int, default=0)
+
+    compare = sub.add_parser('compare', help='compare two suite results and flag regressions')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args()
+    if args.command == 'stats':
+        bench_stats(args.users)
+    elif args.command == 'sockets':
+        bench_sockets(args.sockets)
+    elif args.command == 'fleet':
+        bench_fleet(args.nodes, args.users)
+    elif args.command == 'reload':
+        bench_reload(args.grace, args.sessions, args.session_seconds)
+    elif args.command == 'suite':
+        bench_suite(args.users, args.bench, args.ops, args.output)
+    elif args.command == 'run':
+        print(json.dumps(run_one(args.bench, args.users, args.ops)))
+    elif args.command == 'compare':
+        sys.exit(bench_compare(args.baseline, args.current, args.threshold))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""Blue/green XRay reloads: start the new process next to the old one, then drain the old one.
+
+Both processes listen on the same ports with SO_REUSEPORT. Once the new
+process owns a listener on every inbound port, a one-instruction reuseport
+BPF program steers all new connections to it. The old process keeps the
+sessions it already accepted until they finish or the grace period runs
+out, and is then stopped.
+
+XRay must be started by the bot in this mode (not by its systemd unit),
+and every inbound needs the SO_REUSEPORT sockopt; ensure_reuseport adds it.
+"""
+import ctypes
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+from config import XRAY_BINARY, XRAY_HEALTH_TIMEOUT, XRAY_DRAIN_GRACE, XRAY_PROCESS_LOG
+import xray_api
+from monitor import PROC_NET_TCP
+
+# customSockopt entry for SOL_SOCKET / SO_REUSEPORT
+REUSEPORT_SOCKOPT = {"system": "linux", "type": "int", "level": "1", "opt": "15", "value": "1"}
+
+SO_ATTACH_REUSEPORT_CBPF = 51
+SO_DETACH_REUSEPORT_BPF = 68
+SYS_PIDFD_GETFD = 438  # same number on x86_64 and arm64
+BPF_RET_K = 0x06
+
+TCP_LISTEN = '0A'
+TCP_ESTABLISHED = '01'
+
+POLL_INTERVAL = 0.1
+STOP_TIMEOUT = 5
+
+# Outcome of the handoffs so far, for /metrics and the benchmark
+reload_stats = {
+    'handoffs': 0,
+    'failures': 0,
+    'draining': 0,
+    'last_handoff_seconds': 0.0,
+    'last_drain_seconds': 0.0,
+    'last_dropped': 0,
+    'dropped_total': 0,
+}
+
+class _SockFilter(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_uint16), ('jt', ctypes.c_uint8), ('jf', ctypes.c_uint8), ('k', ctypes.c_uint32)]
+
+class _SockFprog(ctypes.Structure):
+    _fields_ = [('len', ctypes.c_uint16), ('filter', ctypes.POINTER(_SockFilter))]
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def ensure_reuseport(config):
+    """Add the SO_REUSEPORT sockopt to every inbound, True if the config changed"""
+    changed = False
+    for inbound in config.get('inbounds', []):
+        sockopt = inbound.setdefault('streamSettings', {}).setdefault('sockopt', {})
+        custom = sockopt.setdefault('customSockopt', [])
+        if not any(str(o.get('level')) == '1' and str(o.get('opt')) == '15' for o in custom):
+            custom.append(dict(REUSEPORT_SOCKOPT))
+            changed = True
+    return changed
+
+def inbound_ports(config):
+    """Fixed TCP ports XRay listens on"""
+    return sorted({inbound['port'] for inbound in config.get('inbounds', []) if isinstance(inbound.get('port'), int)})
+
+def read_sockets(ports, states):
+    """[(local address, state, inode)] of TCP sockets on ports from /proc/net"""
+    suffixes = {f":{port:04X}" for port in ports}
+    rows = []
+    for path in PROC_NET_TCP:
+        try:
+            f = open(path, 'r')
+        except OSError:
+            continue
+        with f:
+            next(f, None)  # header
+            for line in f:
+                fields = line.split()
+                if len(fields) > 9 and fields[1][-5:] in suffixes and fields[3] in states:
+                    rows.append((fields[1], fields[3], fields[9]))
+    return rows
+
+def socket_fds(pid):
+    """{socket inode: fd number} of a process"""
+    fds = {}
+    try:
+        names = os.listdir(f"/proc/{pid}/fd")
+    except OSError:
+        return fds
+    for name in names:
+        try:
+            target = os.readlink(f"/proc/{pid}/fd/{name}")
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            fds[target[8:-1]] = int(name)
+    return fds
+
+def listener_pids(ports):
+    """PIDs of processes listening on any of ports"""
+    inodes = {inode for _, _, inode in read_sockets(ports, {TCP_LISTEN})}
+    pids = set()
+    if not inodes:
+        return pids
+    for name in os.listdir('/proc'):
+        if name.isdigit() and inodes.intersection(socket_fds(name)):
+            pids.add(int(name))
+    return pids
+
+def established_count(pid, ports):
+    """Client sessions a process still holds on ports"""
+    owned = socket_fds(pid)
+    return sum(1 for _, _, inode in read_sockets(ports, {TCP_ESTABLISHED}) if inode in owned)
+
+def listening_ports(pid, ports):
+    """Ports on which a process holds a listener"""
+    owned = socket_fds(pid)
+    return {int(address.rsplit(':', 1)[1], 16) for address, _, inode in read_sockets(ports, {TCP_LISTEN}) if inode in owned}
+
+def steal_fd(pid, fd):
+    """Duplicate another process's file descriptor into ours (pidfd_getfd, Linux 5.6+)"""
+    pidfd = os.pidfd_open(pid)
+    try:
+        stolen = _libc.syscall(SYS_PIDFD_GETFD, pidfd, fd, 0)
+        if stolen < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return stolen
+    finally:
+        os.close(pidfd)
+
+def steer_to(pid, ports):
+    """Send every new connection on ports to pid's listeners, returns the ports steered.
+
+    pid's listener is the newest member of each reuseport group, so its
+    index is the group size minus one; a constant-return BPF program picks it.
+    """
+    listeners = read_sockets(ports, {TCP_LISTEN})
+    owned = socket_fds(pid)
+    steered = []
+    for address, _, inode in listeners:
+        if inode not in owned:
+            continue
+        index = sum(1 for other, _, _ in listeners if other == address) - 1
+        program = (_SockFilter * 1)(_SockFilter(BPF_RET_K, 0, 0, index))
+        fprog = _SockFprog(1, program)
+        with socket.socket(fileno=steal_fd(pid, owned[inode])) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, bytes(fprog))
+        steered.append(int(address.rsplit(':', 1)[1], 16))
+    return steered
+
+def unsteer(pid, ports):
+    """Drop the steering program once pid is the only listener left"""
+    owned = socket_fds(pid)
+    for _, _, inode in read_sockets(ports, {TCP_LISTEN}):
+        if inode in owned:
+            with socket.socket(fileno=steal_fd(pid, owned[inode])) as sock:
+                sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_REUSEPORT_BPF, 0)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class BlueGreenReloader:
+    """Owns the live XRay process of each config and hands its ports over on reload.
+
+    reload() returns once the new process is serving; draining and stopping
+    the old one happens on a background thread per old process.
+    """
+
+    def __init__(self, binary=XRAY_BINARY, health_timeout=XRAY_HEALTH_TIMEOUT,
+                 grace=XRAY_DRAIN_GRACE, log_path=XRAY_PROCESS_LOG):
+        self.binary = binary
+        self.health_timeout = health_timeout
+        self.grace = grace
+        self.log_path = log_path
+        # config path -> live Popen
+        self.processes = {}
+        # pid -> Popen for processes we started, so they get reaped
+        self.children = {}
+        self.drains = []
+        self._lock = threading.Lock()
+
+    def _spawn(self, config_path):
+        try:
+            log = open(self.log_path, 'ab')
+        except OSError:
+            log = subprocess.DEVNULL
+        try:
+            # Own session: XRay outlives the bot and ignores its Ctrl-C
+            process = subprocess.Popen(
+                [self.binary, 'run', '-config', config_path],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+        finally:
+            if log is not subprocess.DEVNULL:
+                log.close()
+        self.children[process.pid] = process
+        return process
+
+    def _wait_healthy(self, process, ports):
+        """True once process holds a listener on every port"""
+        deadline = time.monotonic() + self.health_timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                return False
+            if listening_ports(process.pid, ports) >= set(ports):
+                return True
+            time.sleep(POLL_INTERVAL)
+        return False
+
+    def _stop(self, pid, timeout=STOP_TIMEOUT):
+        """SIGTERM, then SIGKILL after timeout"""
+        process = self.children.pop(pid, None)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None if process else not _alive(pid):
+                return
+            time.sleep(POLL_INTERVAL)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        if process:
+            process.wait()
+
+    def _drain(self, pid, config_path, ports, successor):
+        """Let pid finish its sessions for up to the grace period, then stop it"""
+        started = time.monotonic()
+        deadline = started + self.grace
+        remaining = established_count(pid, ports)
+        while remaining and time.monotonic() < deadline and _alive(pid):
+            time.sleep(POLL_INTERVAL)
+            remaining = established_count(pid, ports)
+        self._stop(pid)
+        with self._lock:
+            reload_stats['draining'] -= 1
+            reload_stats['last_drain_seconds'] = round(time.monotonic() - started, 3)
+            reload_stats['last_dropped'] = remaining
+            reload_stats['dropped_total'] += remaining
+            if reload_stats['draining'] == 0 and self.processes.get(config_path) is successor:
+                try:
+                    unsteer(successor.pid, ports)
+                except OSError:
+                    pass
+        if remaining:
+            print(f"XRay process {pid} stopped with {remaining} session(s) still open")
+
+    def start(self, config_path, ports):
+        """Start XRay if nothing listens on its ports yet, True if it is serving"""
+        if listener_pids(ports):
+            return True
+        process = self._spawn(config_path)
+        if not self._wait_healthy(process, ports):
+            self._stop(process.pid)
+            return False
+        self.processes[config_path] = process
+        return True
+
+    def reload(self, config_path, ports):
+        """Start a process on the new config and hand the ports over to it.
+
+        Returns False, leaving the old process untouched, if the new one does
+        not become healthy in time.
+        """
+        started = time.monotonic()
+        old = listener_pids(ports)
+        process = self._spawn(config_path)
+        if not self._wait_healthy(process, ports):
+            self._stop(process.pid)
+            reload_stats['failures'] += 1
+            return False
+        try:
+            steer_to(process.pid, ports)
+        except OSError as e:
+            # Without steering both processes accept until the old one stops
+            print(f"Error steering connections to the new XRay: {e}")
+        # The API channel is an HTTP/2 connection to the old process
+        xray_api.close_channels()
+        self.processes[config_path] = process
+        reload_stats['handoffs'] += 1
+        reload_stats['last_handoff_seconds'] = round(time.monotonic() - started, 3)
+
+        for pid in old - {process.pid}:
+            with self._lock:
+                reload_stats['draining'] += 1
+            thread = threading.Thread(target=self._drain, args=(pid, config_path, ports, process), daemon=True)
+            thread.start()
+            self.drains.append(thread)
+        self.drains = [thread for thread in self.drains if thread.is_alive()]
+        return True
+
+    def restart(self, config_path, ports):
+        """Stop every XRay on the ports, then start a fresh one"""
+        for pid in listener_pids(ports):
+            self._stop(pid)
+        self.processes.pop(config_path, None)
+        return self.start(config_path, ports)
+
+    def stop(self):
+        """Stop the live processes started by us"""
+        while self.processes:
+            self._stop(self.processes.popitem()[1].pid)
+
+    def wait_drained(self, timeout=None):
+        """Block until old processes are stopped (for tests and shutdown)"""
+        for thread in list(self.drains):
+            thread.join(timeout)
+
+reloader = BlueGreenReloader()
@@ -3,13 +3,64 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID"))
+ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))  # agent.py runs without a bot
 VPS_IP = os.getenv("VPS_IP", "YOUR_VPS_IP")
 BUG_HOST = os.getenv("BUG_HOST", "")
 ARGO_DOMAIN = os.getenv("ARGO_DOMAIN", "")  # Cloudflare Argo domain
 USE_ARGO = os.getenv("USE_ARGO", "false").lower() == "true"
-XRAY_CONFIG_PATH = "/usr/local/etc/xray/config.json"
+XRAY_CONFIG_PATH = os.getenv("XRAY_CONFIG_PATH", "/usr/local/etc/xray/config.json")
+XRAY_SERVICE = os.getenv("XRAY_SERVICE", "xray")  # empty = never restart
 CLOUDFLARED_PATH = "/usr/local/bin/cloudflared"
 VMESS_PORT = int(os.getenv("VMESS_PORT", "443"))
 XRAY_LOCAL_PORT = int(os.getenv("XRAY_LOCAL_PORT", "8080"))
+XRAY_API_ADDRESS = os.getenv("XRAY_API_ADDRESS", "127.0.0.1:10085")
+VMESS_INBOUND_TAG = os.getenv("VMESS_INBOUND_TAG", "vmess-in")
+USE_XRAY_API = os.getenv("USE_XRAY_API", "true").lower() == "true"
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+TRAFFIC_SAMPLE_INTERVAL = int(os.getenv("TRAFFIC_SAMPLE_INTERVAL", "10"))
+TRAFFIC_RING_SIZE = int(os.getenv("TRAFFIC_RING_SIZE", "90"))
+DATABASE_FILE = os.getenv("DATABASE_FILE", os.path.join(BASE_DIR, "users.db"))  # next to the code, not the cwd
+TRAFFIC_DB_FILE = os.getenv("TRAFFIC_DB_FILE", os.path.join(BASE_DIR, "traffic.db"))
+EXPIRY_BATCH_WINDOW = int(os.getenv("EXPIRY_BATCH_WINDOW", "5"))
+EXPIRY_RETRY_DELAY = int(os.getenv("EXPIRY_RETRY_DELAY", "30"))
+QUOTA_WARN_RATIO = float(os.getenv("QUOTA_WARN_RATIO", "0.8"))
+XRAY_ACCESS_LOG = os.getenv("XRAY_ACCESS_LOG", "/var/log/xray/access.log")
+IP_WINDOW_SECONDS = int(os.getenv("IP_WINDOW_SECONDS", "300"))
+MAX_IPS_PER_USER = int(os.getenv("MAX_IPS_PER_USER", "0"))
+ENFORCE_IP_LIMIT = os.getenv("ENFORCE_IP_LIMIT", "false").lower() == "true"
+ACCESS_LOG_POLL_INTERVAL = int(os.getenv("ACCESS_LOG_POLL_INTERVAL", "2"))
+ARGO_TUNNEL_NAME = os.getenv("ARGO_TUNNEL_NAME", "")
+CLOUDFLARED_METRICS_PORT = int(os.getenv("CLOUDFLARED_METRICS_PORT", "20241"))
+TUNNEL_HEALTH_INTERVAL = int(os.getenv("TUNNEL_HEALTH_INTERVAL", "15"))
+TUNNEL_BACKOFF_MAX = int(os.getenv("TUNNEL_BACKOFF_MAX", "300"))
+NODES_FILE = os.getenv("NODES_FILE", os.path.join(BASE_DIR, "nodes.json"))
+NODE_TIMEOUT = int(os.getenv("NODE_TIMEOUT", "15"))
+NODE_POOL_SIZE = int(os.getenv("NODE_POOL_SIZE", "4"))
+AGENT_LISTEN = os.getenv("AGENT_LISTEN", "0.0.0.0:7443")
+AGENT_TOKEN = os.getenv("AGENT_TOKEN", "")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = disabled
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_REFRESH_INTERVAL = int(os.getenv("METRICS_REFRESH_INTERVAL", "15"))
+SUBSCRIPTION_PORT = int(os.getenv("SUBSCRIPTION_PORT", "0"))  # 0 = disabled
+SUBSCRIPTION_HOST = os.getenv("SUBSCRIPTION_HOST", "0.0.0.0")
+SUBSCRIPTION_BASE_URL = os.getenv("SUBSCRIPTION_BASE_URL", "")
+SUBSCRIPTION_SECRET = os.getenv("SUBSCRIPTION_SECRET", "")
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "10000"))
+SUBSCRIPTION_UPDATE_HOURS = int(os.getenv("SUBSCRIPTION_UPDATE_HOURS", "1"))
+XRAY_BINARY = os.getenv("XRAY_BINARY", "/usr/local/bin/xray")
+XRAY_CONFIG_TEST = os.getenv("XRAY_CONFIG_TEST", "false").lower() == "true"  # run 'xray run -test' before activating
+XRAY_RELOAD_MODE = os.getenv("XRAY_RELOAD_MODE", "restart")  # restart | bluegreen
+XRAY_HEALTH_TIMEOUT = int(os.getenv("XRAY_HEALTH_TIMEOUT", "10"))
+XRAY_DRAIN_GRACE = int(os.getenv("XRAY_DRAIN_GRACE", "60"))  # seconds old sessions may keep running
+XRAY_PROCESS_LOG = os.getenv("XRAY_PROCESS_LOG", "/var/log/xray/process.log")
+XRAY_SHARDS = int(os.getenv("XRAY_SHARDS", "1"))  # 1 = one XRay for every account
+XRAY_SHARD_DIR = os.getenv("XRAY_SHARD_DIR", "/usr/local/etc/xray/shards")
+XRAY_SHARD_BASE_PORT = int(os.getenv("XRAY_SHARD_BASE_PORT", "10001"))  # shard N listens on base + N
+XRAY_SHARD_API_BASE_PORT = int(os.getenv("XRAY_SHARD_API_BASE_PORT", "10101"))
+XRAY_SHARD_SERVICE = os.getenv("XRAY_SHARD_SERVICE", "xray@{name}")  # systemd template unit per shard
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", "3600"))  # seconds between database/XRay reconciliations, 0 = startup only
+SYNC_MAX_REMOVE_RATIO = float(os.getenv("SYNC_MAX_REMOVE_RATIO", "0.1"))  # more removals per node need /sync apply force
@@ -1,60 +1,522 @@
+import atexit
+import bisect
 import json
 import os
+import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
+from config import DATABASE_FILE
+from locking import FileLock
 
-DATABASE_FILE = "users.json"
+LEGACY_DATABASE_FILE = os.path.join(os.path.dirname(DATABASE_FILE), "users.json")
+
+# Writes are applied to the in-memory index immediately and flushed to
+# SQLite in one transaction after this many seconds
+WRITE_BEHIND_DELAY = 0.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    uuid TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    expiry_date TEXT NOT NULL,
+    days INTEGER NOT NULL,
+    active INTEGER NOT NULL DEFAULT 1,
+    expires_at TEXT,
+    quota_bytes INTEGER NOT NULL DEFAULT 0,
+    used_bytes INTEGER NOT NULL DEFAULT 0,
+    quota_warned INTEGER NOT NULL DEFAULT 0,
+    nodes TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+INDEXES = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_uuid ON users(uuid);
+CREATE INDEX IF NOT EXISTS idx_users_expiry ON users(expiry_date);
+CREATE INDEX IF NOT EXISTS idx_users_expires_at ON users(expires_at);
+"""
+
+COLUMNS = (
+    "username", "uuid", "created_at", "expiry_date", "days", "active", "expires_at",
+    "quota_bytes", "used_bytes", "quota_warned", "nodes"
+)
+INSERT_COLUMNS = f"({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_conn = None
+_conn_inode = None
+_lock = threading.RLock()
+# Serializes writes with other processes and tools using the same database
+_file_lock = FileLock(DATABASE_FILE + ".lock")
+
+# In-memory index: username -> user, uuid -> username
+_cache = None
+_uuid_index = {}
+_cache_key = None
+
+# Sorted indexes for paging, built on first use and kept up to date
+# incrementally: sort name -> sorted list of keys
+SORT_KEYS = {
+    'created': lambda user: (user['created_at'], user['username']),
+    'expiry': lambda user: (user['expiry'], user['username']),
+    'status': lambda user: (not user['active'], user['expiry'], user['username']),
+}
+_sorted = {}
+
+# Write-behind queue: username -> user (upsert) or None (delete)
+_pending = {}
+_flush_timer = None
+
+def _file_key():
+    """Identity of the database files on disk, changes on any commit or replace"""
+    try:
+        st = os.stat(DATABASE_FILE)
+    except FileNotFoundError:
+        return None
+    try:
+        wal = os.stat(DATABASE_FILE + "-wal")
+        wal_key = (wal.st_mtime_ns, wal.st_size)
+    except FileNotFoundError:
+        wal_key = None
+    return (st.st_ino, st.st_mtime_ns, st.st_size, wal_key)
+
+def get_connection():
+    """Open the SQLite database in WAL mode, reopening it if the file was replaced"""
+    global _conn, _conn_inode
+    with _lock:
+        if _conn is not None:
+            try:
+                inode = os.stat(DATABASE_FILE).st_ino
+            except FileNotFoundError:
+                inode = None
+            if inode != _conn_inode:
+                _conn.close()
+                _conn = None
+        if _conn is None:
+            conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            _upgrade_schema(conn)
+            conn.executescript(INDEXES)
+            _conn = conn
+            _conn_inode = os.stat(DATABASE_FILE).st_ino
+            migrate_from_json()
+        return _conn
+
+def _upgrade_schema(conn):
+    """Add columns introduced after the first SQLite release"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    if 'expires_at' not in columns:
+        with conn:
+            conn.execute("ALTER TABLE users ADD COLUMN expires_at TEXT")
+            # Date-only records expire at the start of their expiry day
+            conn.execute("UPDATE users SET expires_at = expiry_date || ' 00:00:00'")
+    if 'quota_bytes' not in columns:
+        with conn:
+            conn.execute("ALTER TABLE users ADD COLUMN quota_bytes INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE users ADD COLUMN used_bytes INTEGER NOT NULL DEFAULT 0")
+            conn.execute("ALTER TABLE users ADD COLUMN quota_warned INTEGER NOT NULL DEFAULT 0")
+    if 'nodes' not in columns:
+        with conn:
+            # Empty means the fleet's default nodes
+            conn.execute("ALTER TABLE users ADD COLUMN nodes TEXT NOT NULL DEFAULT ''")
+
+def _parse_expiry(expires_at):
+    """Expiry datetime string to a POSIX timestamp"""
+    return datetime.strptime(expires_at, DATETIME_FORMAT).timestamp()
+
+def _row_to_user(row):
+    """Convert a users row to the dict shape used across the bot"""
+    user = dict(zip(COLUMNS, row))
+    user['active'] = bool(user['active'])
+    user['quota_warned'] = bool(user['quota_warned'])
+    user['nodes'] = [name for name in user['nodes'].split(',') if name]
+    user['expiry'] = _parse_expiry(user['expires_at'])
+    return user
+
+def _user_to_row(user):
+    """Convert a user dict to a users row"""
+    return (
+        user['username'],
+        user['uuid'],
+        user['created_at'],
+        user['expiry_date'],
+        user['days'],
+        int(user.get('active', True)),
+        user.get('expires_at') or f"{user['expiry_date']} 00:00:00",
+        user.get('quota_bytes', 0),
+        user.get('used_bytes', 0),
+        int(user.get('quota_warned', False)),
+        ','.join(user.get('nodes', ()))
+    )
+
+def migrate_from_json(path=None):
+    """One-shot import of the legacy users.json into SQLite"""
+    path = path or LEGACY_DATABASE_FILE
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r') as f:
+        users = json.load(f)
+    conn = get_connection()
+    with _lock, conn:
+        conn.executemany(
+            f"INSERT OR IGNORE INTO users {INSERT_COLUMNS}",
+            [_user_to_row(user) for user in users.values()]
+        )
+    # Keep the old file around but make sure we never import it twice
+    os.replace(path, path + ".migrated")
+    return len(users)
+
+def _index():
+    """Return the in-memory index, reloading it only if the files changed on disk.
+
+    Records are replaced, never changed in place, so an up-to-date index is
+    returned without taking the lock.
+    """
+    global _cache, _uuid_index, _cache_key, _sorted
+    cache = _cache
+    if cache is not None and _file_key() == _cache_key:
+        return cache
+    with _lock:
+        conn = get_connection()
+        key = _file_key()
+        if _cache is None or key != _cache_key:
+            rows = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM users").fetchall()
+            cache = {row[0]: _row_to_user(row) for row in rows}
+            # Unflushed local writes win over what is on disk
+            for username, user in _pending.items():
+                if user is None:
+                    cache.pop(username, None)
+                else:
+                    cache[username] = user
+            _cache = cache
+            _uuid_index = {user['uuid']: username for username, user in cache.items()}
+            _sorted = {}
+            _cache_key = key
+        return _cache
+
+def _sorted_index(sort):
+    """Return the sorted key list for sort, building it once after a reload"""
+    index = _sorted.get(sort)
+    if index is None:
+        key = SORT_KEYS[sort]
+        index = _sorted[sort] = sorted(key(user) for user in _index().values())
+    return index
+
+def _update_sorted(old, new):
+    """Move a user between positions in every built sorted index"""
+    for sort, index in _sorted.items():
+        key = SORT_KEYS[sort]
+        if old is not None and new is not None and key(old) == key(new):
+            continue
+        if old is not None:
+            old_key = key(old)
+            pos = bisect.bisect_left(index, old_key)
+            if pos < len(index) and index[pos] == old_key:
+                del index[pos]
+        if new is not None:
+            bisect.insort(index, key(new))
+
+def _put(user):
+    """Update the index and queue the row for write-behind"""
+    with _lock:
+        users = _index()
+        old = users.get(user['username'])
+        if old is not None:
+            _uuid_index.pop(old['uuid'], None)
+        _update_sorted(old, user)
+        users[user['username']] = user
+        _uuid_index[user['uuid']] = user['username']
+        _pending[user['username']] = user
+        _schedule_flush()
+
+def _schedule_flush():
+    """Arm the write-behind timer if it isn't already running"""
+    global _flush_timer
+    if _flush_timer is None:
+        _flush_timer = threading.Timer(WRITE_BEHIND_DELAY, flush)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+def flush():
+    """Write all pending changes to SQLite in a single transaction"""
+    global _pending, _flush_timer, _cache_key
+    if not _pending:
+        # Nothing to write, don't touch the lock file (agent.py never opens the database)
+        return
+    with _lock, _file_lock:
+        _flush_timer = None
+        if not _pending:
+            return
+        pending, _pending = _pending, {}
+        conn = get_connection()
+        try:
+            with conn:
+                upserts = [_user_to_row(u) for u in pending.values() if u is not None]
+                deletes = [(name,) for name, u in pending.items() if u is None]
+                if deletes:
+                    conn.executemany("DELETE FROM users WHERE username = ?", deletes)
+                if upserts:
+                    conn.executemany(
+                        f"INSERT OR REPLACE INTO users {INSERT_COLUMNS}",
+                        upserts
+                    )
+        except sqlite3.Error as e:
+            # Put the batch back so the next flush retries it
+            pending.update(_pending)
+            _pending = pending
+            _schedule_flush()
+            print(f"Error flushing user database: {e}")
+            return
+        # Our own commit changed the files, the index is already up to date
+        _cache_key = _file_key()
+
+atexit.register(flush)
 
 def load_users():
-    """Load users from JSON database"""
-    if not os.path.exists(DATABASE_FILE):
-        return {}
-    with open(DATABASE_FILE, 'r') as f:
-        return json.load(f)
+    """Load all users as {username: user}"""
+    return {username: dict(user) for username, user in _index().items()}
 
 def save_users(users):
-    """Save users to JSON database"""
-    with open(DATABASE_FILE, 'w') as f:
-        json.dump(users, indent=2, fp=f)
-
-def add_user(username, uuid, days=30):
-    """Add new VMess user"""
-    users = load_users()
-    expiry_date = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d")
-    
-    users[username] = {
+    """Replace the whole user table (kept for compatibility)"""
+    global _cache
+    with _lock, _file_lock:
+        flush()
+        conn = get_connection()
+        with conn:
+            conn.execute("DELETE FROM users")
+            conn.executemany(
+                f"INSERT INTO users {INSERT_COLUMNS}",
+                [_user_to_row(user) for user in users.values()]
+            )
+        _cache = None
+
+def _new_user(username, uuid, days, hours=0, quota_bytes=0, nodes=()):
+    """Build a fresh user record"""
+    now = datetime.now().replace(microsecond=0)
+    expires_at = now + timedelta(days=days, hours=hours)
+    return {
         "uuid": uuid,
         "username": username,
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "expiry_date": expiry_date,
+        "created_at": now.strftime(DATETIME_FORMAT),
+        "expiry_date": expires_at.strftime("%Y-%m-%d"),
+        "expires_at": expires_at.strftime(DATETIME_FORMAT),
         "days": days,
-        "active": True
+        "active": True,
+        "quota_bytes": quota_bytes,
+        "used_bytes": 0,
+        "quota_warned": False,
+        "nodes": list(nodes),
+        "expiry": expires_at.timestamp()
     }
-    save_users(users)
-    return users[username]
+
+def add_user(username, uuid, days=30, hours=0, quota_bytes=0, nodes=()):
+    """Add new VMess user, living on the given node names"""
+    user = _new_user(username, uuid, days, hours, quota_bytes, nodes)
+    _put(user)
+    return dict(user)
+
+def add_users(accounts, days=30, hours=0, quota_bytes=0):
+    """Add many (username, uuid[, nodes]) accounts, flushed together in one transaction.
+
+    Every record is built before any is stored, so a bad value adds none.
+    """
+    users = [
+        _new_user(username, uuid, days, hours, quota_bytes, nodes[0] if nodes else ())
+        for username, uuid, *nodes in accounts
+    ]
+    with _lock:
+        for user in users:
+            _put(user)
+    return [dict(user) for user in users]
+
+def allocate_ids(count=1):
+    """Reserve count consecutive IDs and return the first.
+
+    IDs start at the current Unix time and only ever grow, across calls,
+    restarts and processes sharing the database, so no two callers get
+    the same one.
+    """
+    global _cache_key
+    last = int(time.time()) + count - 1
+    with _lock, _file_lock:
+        conn = get_connection()
+        fresh = _cache is not None and _file_key() == _cache_key
+        with conn:
+            (last,), = conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('last_id', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = max(value + ?, excluded.value) RETURNING value",
+                (last, count)
+            ).fetchall()
+        if fresh:
+            # Only the counter changed, the index is still current
+            _cache_key = _file_key()
+    return last - count + 1
+
+def allocate_usernames(prefix="vmess", count=1):
+    """Generate count usernames from fresh IDs, skipping any already taken"""
+    users = _index()
+    usernames = []
+    while len(usernames) < count:
+        needed = count - len(usernames)
+        first = allocate_ids(needed)
+        usernames += [
+            username for username in (f"{prefix}_{i}" for i in range(first, first + needed))
+            if username not in users
+        ]
+    return usernames
 
 def get_user(username):
     """Get user by username"""
-    users = load_users()
-    return users.get(username)
+    user = _index().get(username)
+    return dict(user) if user else None
+
+def get_users(usernames):
+    """Get many users by username, skipping unknown ones"""
+    users = _index()
+    return [dict(users[name]) for name in usernames if name in users]
+
+def get_user_by_uuid(uuid):
+    """Get user by UUID"""
+    users = _index()
+    user = users.get(_uuid_index.get(uuid))
+    return dict(user) if user else None
 
 def delete_user(username):
     """Delete user by username"""
-    users = load_users()
-    if username in users:
-        del users[username]
-        save_users(users)
+    with _lock:
+        users = _index()
+        user = users.pop(username, None)
+        if user is None:
+            return False
+        _uuid_index.pop(user['uuid'], None)
+        _update_sorted(user, None)
+        _pending[username] = None
+        _schedule_flush()
         return True
-    return False
 
 def list_users():
     """List all users"""
     return load_users()
 
+def active_accounts():
+    """(username, uuid, nodes, expiry) of every active user, without copying records"""
+    with _lock:
+        return [
+            (username, user['uuid'], user['nodes'], user['expiry'])
+            for username, user in _index().items() if user['active']
+        ]
+
+def usernames_by_uuid():
+    """{uuid: username} of every user"""
+    with _lock:
+        _index()
+        return dict(_uuid_index)
+
+def count_users():
+    """Count accounts by status without copying records"""
+    counts = {'active': 0, 'expired': 0, 'revoked': 0, 'over_quota': 0}
+    now = time.time()
+    with _lock:
+        for user in _index().values():
+            if not user['active']:
+                counts['revoked'] += 1
+            elif now > user['expiry']:
+                counts['expired'] += 1
+            elif is_over_quota(user):
+                counts['over_quota'] += 1
+            else:
+                counts['active'] += 1
+    return counts
+
+def list_users_page(sort="created", offset=0, limit=10):
+    """Return (users, total) for one page of a sorted index.
+
+    'created' pages newest first, 'expiry' soonest first and 'status'
+    active before inactive. Cost is O(limit), not O(total users).
+    """
+    with _lock:
+        users = _index()
+        index = _sorted_index(sort)
+        total = len(index)
+        if sort == 'created':
+            start = max(total - offset - limit, 0)
+            keys = reversed(index[start:max(total - offset, 0)])
+        else:
+            keys = index[offset:offset + limit]
+        return [dict(users[key[-1]]) for key in keys], total
+
+def set_active(usernames, active):
+    """Activate or deactivate many users in one write-behind batch"""
+    changed = []
+    with _lock:
+        users = _index()
+        for username in usernames:
+            user = users.get(username)
+            if user is not None and user['active'] != active:
+                user = dict(user, active=active)
+                _put(user)
+                changed.append(username)
+    return changed
+
+def add_usage(usage):
+    """Add {username: bytes} to running usage totals in one write-behind batch.
+
+    Returns the updated records of users that have a quota.
+    """
+    updated = []
+    with _lock:
+        users = _index()
+        for username, used in usage.items():
+            user = users.get(username)
+            if user is None or not used:
+                continue
+            user = dict(user, used_bytes=user['used_bytes'] + used)
+            _put(user)
+            if user['quota_bytes']:
+                updated.append(dict(user))
+    return updated
+
+def set_quota_warned(usernames):
+    """Remember that users were warned about their quota"""
+    with _lock:
+        users = _index()
+        for username in usernames:
+            user = users.get(username)
+            if user is not None and not user['quota_warned']:
+                _put(dict(user, quota_warned=True))
+
+def set_quota(username, quota_bytes, reset_usage=False):
+    """Set a user's byte quota (0 = unlimited), optionally resetting usage"""
+    with _lock:
+        user = _index().get(username)
+        if user is None:
+            return None
+        user = dict(user, quota_bytes=quota_bytes, quota_warned=False)
+        if reset_usage:
+            user['used_bytes'] = 0
+        _put(user)
+        return dict(user)
+
+def is_over_quota(user):
+    """Check whether a user has used up their quota"""
+    return bool(user['quota_bytes']) and user['used_bytes'] >= user['quota_bytes']
+
+def is_expired(user):
+    """Check a user record against its cached expiry timestamp"""
+    return time.time() > user['expiry']
+
 def is_user_expired(username):
     """Check if user is expired"""
-    user = get_user(username)
+    user = _index().get(username)
     if not user:
         return True
-    
-    expiry = datetime.strptime(user['expiry_date'], "%Y-%m-%d")
-    return datetime.now() > expiry
+
+    return is_expired(user)
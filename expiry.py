@@ -0,0 +1,110 @@
+import asyncio
+import heapq
+import time
+from config import EXPIRY_BATCH_WINDOW, EXPIRY_RETRY_DELAY
+from async_utils import run_blocking
+from locking import user_locks
+from database import active_accounts, get_users, set_active
+from nodes import fleet, removed
+
+async def revoke_users(usernames):
+    """Remove accounts from every node in one commit each and mark them inactive"""
+    async with user_locks.hold(*usernames):
+        users = await run_blocking(get_users, usernames)
+        results = await fleet.remove_users(users)
+        # Only accounts gone from all their nodes count, a client already missing is just as revoked
+        revoked = [user['username'] for user, result in zip(users, results) if removed(result)]
+        await run_blocking(set_active, revoked, False)
+    return revoked
+
+class ExpiryScheduler:
+    """Revoke accounts when they expire.
+
+    Upcoming expiry times sit in a min-heap. The loop sleeps until the
+    earliest deadline, then revokes everything due within
+    EXPIRY_BATCH_WINDOW seconds in one config commit. Accounts a node
+    failed to remove go back on the heap and are retried after
+    retry_delay. The heap is rebuilt from the database on start, so
+    nothing is lost across restarts.
+    """
+
+    def __init__(self, batch_window=EXPIRY_BATCH_WINDOW, on_revoked=None, retry_delay=EXPIRY_RETRY_DELAY):
+        self.batch_window = batch_window
+        self.retry_delay = retry_delay
+        self.on_revoked = on_revoked
+        self.heap = []
+        self.revoked_total = 0
+        self._wakeup = None
+
+    async def rebuild(self):
+        """Rebuild the heap from every active account, O(n)"""
+        accounts = await run_blocking(active_accounts)
+        # Keep what schedule() pushed while the query ran; stale entries are dropped on pop
+        heap = {(expiry, username) for username, _, _, expiry in accounts}
+        self.heap = list(heap.union(self.heap))
+        heapq.heapify(self.heap)
+
+    def schedule(self, user):
+        """Track a new or renewed account"""
+        heapq.heappush(self.heap, (user['expiry'], user['username']))
+        # Wake the loop in case this deadline is earlier than the one it sleeps on
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def pop_due(self, now=None):
+        """Pop every account due by now + batch window that is still expiring"""
+        now = now or time.time()
+        entries = []
+        while self.heap and self.heap[0][0] <= now + self.batch_window:
+            entries.append(heapq.heappop(self.heap))
+        if not entries:
+            return []
+        users = {
+            user['username']: user
+            for user in await run_blocking(get_users, list({username for _, username in entries}))
+        }
+        due = {}
+        for expiry, username in entries:
+            # Deleted, renewed or already revoked accounts leave stale entries;
+            # retries sit at a later time than the expiry itself
+            user = users.get(username)
+            if user and user['active'] and user['expiry'] <= expiry:
+                due[username] = None
+        return list(due)
+
+    async def revoke(self, usernames):
+        """Revoke expired accounts and report them, rescheduling the ones that failed"""
+        revoked = await revoke_users(usernames)
+        retry_at = time.time() + self.retry_delay
+        for username in set(usernames) - set(revoked):
+            heapq.heappush(self.heap, (retry_at, username))
+        self.revoked_total += len(revoked)
+        if revoked and self.on_revoked:
+            await self.on_revoked(revoked)
+        return revoked
+
+    async def run(self):
+        """Sleep until the next deadline and revoke in batches, forever"""
+        # The heap is only touched from the event loop, never from worker threads
+        self._wakeup = asyncio.Event()
+        await self.rebuild()
+        while True:
+            self._wakeup.clear()
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                due = await self.pop_due()
+                if due:
+                    await self.revoke(due)
+            except Exception as e:
+                print(f"Error revoking expired users: {e}")
+                # Popped entries may be lost, start over from the database
+                await asyncio.sleep(self.retry_delay)
+                await self.rebuild()
+
+expiry_scheduler = ExpiryScheduler()
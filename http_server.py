@@ -0,0 +1,84 @@
+import asyncio
+from urllib.parse import urlsplit, parse_qs
+
+# Bounds for what a client may send before we give up on it
+MAX_REQUEST_LINE = 8192
+MAX_HEADERS = 100
+REQUEST_TIMEOUT = 10
+
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+class Request:
+    """Method, path, query parameters and lower-cased headers of one request"""
+
+    def __init__(self, method, target, headers):
+        self.method = method
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = {name: values[-1] for name, values in parse_qs(parts.query).items()}
+        self.headers = headers
+
+async def read_request(reader):
+    """Parse the request line and headers, None if the client sent nothing"""
+    line = await reader.readline()
+    if not line:
+        return None
+    if len(line) > MAX_REQUEST_LINE:
+        raise ValueError("Request line too long")
+    method, target, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    for _ in range(MAX_HEADERS):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return Request(method, target, headers)
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    raise ValueError("Too many headers")
+
+def render_response(status, headers, body, head=False):
+    """Serialize a response; HEAD gets the headers of the full body"""
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+    headers = dict(headers, **{'Content-Length': str(len(body)), 'Connection': 'close'})
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (b'' if head else body)
+
+async def serve_http(handler, host, port):
+    """Start a minimal HTTP/1.1 server, one request per connection.
+
+    handler is awaited with a Request and returns (status, headers, body).
+    Only GET and HEAD are accepted.
+    """
+    async def on_connection(reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(read_request(reader), REQUEST_TIMEOUT)
+            except (asyncio.TimeoutError, ValueError, asyncio.LimitOverrunError):
+                request = None
+                response = (400, {}, b"Bad Request\n")
+            else:
+                if request is None:
+                    return
+                if request.method not in ('GET', 'HEAD'):
+                    response = (405, {'Allow': 'GET, HEAD'}, b"Method Not Allowed\n")
+                else:
+                    try:
+                        response = await handler(request)
+                    except Exception as e:
+                        print(f"Error handling HTTP request {request.path}: {e}")
+                        response = (500, {}, b"Internal Server Error\n")
+            writer.write(render_response(*response, head=request is not None and request.method == 'HEAD'))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
@@ -0,0 +1,91 @@
+import asyncio
+import contextlib
+import fcntl
+import os
+import threading
+
+class KeyedLock:
+    """asyncio locks per resource key, created on demand and dropped when idle.
+
+    Holding several keys takes them in sorted order, so two callers asking
+    for overlapping sets can't deadlock.
+    """
+
+    def __init__(self):
+        # key -> [lock, holders and waiters]
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        """Hold the locks of every key for the duration of the block"""
+        keys = sorted(set(keys))
+        entries = []
+        for key in keys:
+            entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            entries.append((key, entry))
+        acquired = []
+        try:
+            for _, entry in entries:
+                await entry[0].acquire()
+                acquired.append(entry[0])
+            yield
+        finally:
+            for lock in acquired:
+                lock.release()
+            for key, entry in entries:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def locked(self, key):
+        """True if someone holds or waits for key"""
+        return key in self._locks
+
+class FileLock:
+    """Exclusive flock on a lock file, shared with other processes and tools.
+
+    Reentrant within a thread; other threads of this process wait on an
+    RLock first, so the flock is only ever taken once per process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            except OSError:
+                self._lock.release()
+                raise
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except OSError:
+                os.close(fd)
+                self._lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+# Accounts being changed by a handler, keyed by username
+user_locks = KeyedLock()
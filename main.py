@@ -1,12 +1,37 @@
+import asyncio
+import functools
+import io
 import logging
+import math
+import re
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters, ConversationHandler
 
-from config import BOT_TOKEN, ADMIN_ID
-from database import add_user, get_user, delete_user, list_users, is_user_expired
-from xray_manager import generate_uuid, add_vmess_user, remove_vmess_user, get_vmess_users
-from utils import generate_vmess_link, format_user_info
-from monitor import get_active_connections, get_connection_count
+from config import (
+    BOT_TOKEN, ADMIN_ID, CONCURRENT_UPDATES, MAX_IPS_PER_USER, ENFORCE_IP_LIMIT,
+    USE_ARGO, ARGO_DOMAIN, ARGO_TUNNEL_NAME, METRICS_PORT, SUBSCRIPTION_PORT
+)
+from database import (
+    add_user, add_users, allocate_usernames, get_user, delete_user, list_users_page,
+    is_expired, is_over_quota, set_quota, set_active, usernames_by_uuid
+)
+from xray_manager import generate_uuid, start_xray, prepare_shards, upgrade_xray_config
+from nodes import fleet, succeeded, removed
+from utils import format_user_info, format_duration
+from monitor import get_active_connections_async, get_connection_count_async, format_traffic
+from traffic import sampler, parse_window
+from expiry import expiry_scheduler
+from quota import quota_engine
+from expiry import revoke_users
+from access_log import follower
+from argo_manager import start_argo_tunnel, stop_argo_tunnel, get_quick_tunnel_url, tunnel_status
+from async_utils import run_blocking
+from locking import user_locks
+from metrics import exporter, handler_seconds
+from subscription import subscriptions
+from reconcile import reconciler
 
 # Enable logging
 logging.basicConfig(
@@ -22,8 +47,46 @@ logger = logging.getLogger(__name__)
 # Conversation states
 DELETE_EMAIL = range(1)
 
+# Users per /list page
+LIST_PAGE_SIZE = 20
+
+# Number of users shown by /top
+TOP_USERS = 10
+
+# Bulk creation limits
+MAX_BULK_CREATE = 500
+MAX_DAYS = 3650
+
+# Largest traffic quota accepted, in GB
+MAX_QUOTA_GB = 1_000_000
+USERNAME_PREFIX_RE = re.compile(r'^[A-Za-z0-9_-]{1,20}$')
+
+# Usernames listed per node and direction by /sync
+SYNC_REPORT_NAMES = 20
+
+def parse_quota(text):
+    """GB argument to bytes, ValueError unless it is a finite number within 0..MAX_QUOTA_GB"""
+    quota_gb = float(text)
+    # nan and inf slip through plain comparisons
+    if not math.isfinite(quota_gb) or not 0 <= quota_gb <= MAX_QUOTA_GB:
+        raise ValueError(f"Invalid quota: {text}")
+    return int(quota_gb * 1024 ** 3)
+
+def timed(func):
+    """Decorator to record handler latency for /metrics"""
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, func.__name__)
+    return wrapper
+
 def admin_only(func):
     """Decorator to restrict commands to admin only"""
+    @timed
+    @functools.wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         if user_id != ADMIN_ID:
@@ -32,6 +95,28 @@ def admin_only(func):
         return await func(update, context)
     return wrapper
 
+def format_links(user):
+    """VMess link of every node an account lives on, as Markdown"""
+    links = fleet.links(user)
+    if len(links) == 1:
+        return f"🔗 *VMess Link:*\n`{links[0][1]}`\n"
+    text = "🔗 *VMess Links:*\n"
+    for name, link in links:
+        text += f"`{name}`:\n`{link}`\n\n"
+    return text
+
+def format_subscription(user):
+    """Subscription URL line as Markdown, empty if the server is off"""
+    if not SUBSCRIPTION_PORT:
+        return ""
+    return f"📥 *Subscription (all modes):*\n`{subscriptions.url(user['username'])}`\n"
+
+def format_node_failures(results):
+    """One Markdown line per node where an operation failed"""
+    return "\n".join(
+        f"• `{name}`: `{message}`" for name, (success, message) in results.items() if not success
+    )
+
 @admin_only
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command - show main menu"""
@@ -49,10 +134,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Welcome! Use the buttons below to manage VMess accounts.\n\n"
         "Available commands:\n"
         "/start - Show this menu\n"
-        "/create - Create new VMess account\n"
+        "/create [nodes] - Create new VMess account\n"
+        "/bulkcreate <count> <days> [prefix] [quota] [nodes] - Create many accounts\n"
         "/list - List all accounts\n"
         "/delete - Delete an account\n"
         "/monitor - Show active connections\n"
+        "/top [window] - Top users by traffic\n"
+        "/quota <username> <GB> [reset] - Set traffic quota\n"
+        "/tunnel - Argo tunnel status\n"
+        "/nodes - Node status\n"
+        "/sync - Check XRay against the database\n"
         "/info <username> - Get account info\n"
         "/help - Show help"
     )
@@ -67,7 +158,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if query.data == "create":
         await create_start(update, context)
-    elif query.data == "list":
+    elif query.data == "list" or query.data.startswith("list:"):
         await list_users_command(update, context)
     elif query.data == "delete":
         await delete_start(update, context)
@@ -81,6 +172,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @admin_only
 async def create_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start create user - show duration buttons"""
+    # Optional comma-separated node names, remembered until a duration is picked
+    try:
+        context.user_data['nodes'] = fleet.select(context.args[0].split(',') if context.args else None)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    
     keyboard = [
         [InlineKeyboardButton("1 Day", callback_data="days_1"),
          InlineKeyboardButton("3 Days", callback_data="days_3")],
@@ -96,6 +194,7 @@ async def create_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode="Markdown")
 
+@timed
 async def create_user_with_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Create user with selected days"""
     query = update.callback_query
@@ -104,60 +203,175 @@ async def create_user_with_days(update: Update, context: ContextTypes.DEFAULT_TY
     # Extract days from callback data
     days = int(query.data.split('_')[1])
     
-    # Generate username (vmess_timestamp)
-    import time
-    username = f"vmess_{int(time.time())}"
+    # Generate username (vmess_timestamp, suffixed if already taken)
+    username = (await run_blocking(allocate_usernames, "vmess"))[0]
     
     # Generate UUID
     uuid = generate_uuid()
     
-    # Add to XRay
-    success, message = add_vmess_user(username, uuid)
-    if not success:
-        await query.edit_message_text(f"❌ Failed to add user to XRay: {message}")
-        return
-    
-    # Add to database
-    user = add_user(username, uuid, days)
-    
-    # Generate VMess link
-    vmess_link = generate_vmess_link(username, uuid)
+    async with user_locks.hold(username):
+        # Add to XRay on every selected node at once
+        results = (await fleet.add_users([(username, uuid)], context.user_data.pop('nodes', None)))[0]
+        nodes = succeeded(results)
+        if not nodes:
+            await query.edit_message_text(f"❌ Failed to add user to XRay:\n{format_node_failures(results)}")
+            return
+        
+        # Add to database
+        user = await run_blocking(add_user, username, uuid, days, nodes=nodes)
+    expiry_scheduler.schedule(user)
     
     # Format response
     response = (
         "✅ *VMess Account Created Successfully!*\n\n"
         f"{format_user_info(user, uuid)}\n"
-        f"🔗 *VMess Link:*\n`{vmess_link}`\n\n"
+        f"{format_links(user)}\n"
+        f"{format_subscription(user)}"
         "Copy the link above and import it to your V2Ray client."
     )
+    if len(nodes) < len(results):
+        response += f"\n\n⚠️ *Failed on:*\n{format_node_failures(results)}"
     
     await query.edit_message_text(response, parse_mode="Markdown")
 
+@admin_only
+async def bulk_create_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Create many accounts at once and send the links as a document"""
+    usage = (
+        "Usage: /bulkcreate <count> <days> [prefix] [quota] [nodes]\n"
+        f"Quota is in GB (0 = unlimited), nodes are comma-separated. Max {MAX_BULK_CREATE} accounts "
+        f"and {MAX_DAYS} days per batch."
+    )
+    if len(context.args) < 2:
+        await update.message.reply_text(usage)
+        return
+    
+    try:
+        count = int(context.args[0])
+        days = int(context.args[1])
+        quota_bytes = parse_quota(context.args[3]) if len(context.args) > 3 else 0
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    prefix = context.args[2] if len(context.args) > 2 else "vmess"
+    
+    if not 1 <= count <= MAX_BULK_CREATE or not 1 <= days <= MAX_DAYS:
+        await update.message.reply_text(usage)
+        return
+    if not USERNAME_PREFIX_RE.match(prefix):
+        await update.message.reply_text("❌ Prefix may only contain letters, digits, '_' and '-' (max 20).")
+        return
+    try:
+        names = fleet.select(context.args[4].split(',') if len(context.args) > 4 else None)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    
+    await update.message.reply_text(f"⏳ Creating {count} accounts...")
+    
+    # One config commit per node for the whole batch
+    usernames = await run_blocking(allocate_usernames, prefix, count)
+    accounts = [(username, generate_uuid()) for username in usernames]
+    async with user_locks.hold(*usernames):
+        results = await fleet.add_users(accounts, names)
+        created = [
+            (username, uuid, succeeded(result))
+            for (username, uuid), result in zip(accounts, results) if succeeded(result)
+        ]
+        failed = len(accounts) - len(created)
+        
+        try:
+            users = await run_blocking(add_users, created, days, 0, quota_bytes)
+        except Exception as e:
+            # Clients without a record would never expire or be reconciled away
+            await fleet.remove_users([
+                {'username': username, 'uuid': uuid, 'nodes': nodes} for username, uuid, nodes in created
+            ])
+            await update.message.reply_text(f"❌ Failed to save accounts, nothing was created: {e}")
+            return
+    for user in users:
+        expiry_scheduler.schedule(user)
+    
+    # Build the attachment line by line instead of sending hundreds of messages
+    document = io.BytesIO()
+    for user in users:
+        document.write(f"{user['username']} | expires {user['expiry_date']}\n".encode())
+        for _, link in fleet.links(user):
+            document.write(f"{link}\n".encode())
+        document.write(b"\n")
+    document.seek(0)
+    
+    caption = f"✅ Created {len(users)} accounts ({days} days)"
+    if failed:
+        caption += f"\n❌ Failed: {failed}"
+    partial = sum(1 for _, _, nodes in created if len(nodes) < len(names))
+    if partial:
+        caption += f"\n⚠️ Missing on some nodes: {partial}"
+    if users:
+        await update.message.reply_document(
+            document=document,
+            filename=f"{prefix}_{len(users)}_accounts.txt",
+            caption=caption
+        )
+    else:
+        await update.message.reply_text(caption)
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel conversation"""
     await update.message.reply_text("❌ Operation cancelled.")
     context.user_data.clear()
     return ConversationHandler.END
 
+def render_user_page(sort, offset):
+    """Render one /list page and its navigation keyboard"""
+    users, total = list_users_page(sort, offset, LIST_PAGE_SIZE)
+    
+    if not total:
+        return "📋 No users found.", None
+    
+    text = f"📋 *Users {offset + 1}-{offset + len(users)} of {total}* (by {sort})\n\n"
+    for user in users:
+        if not user['active']:
+            status = "⛔ Revoked"
+        elif is_expired(user):
+            status = "❌ Expired"
+        else:
+            status = "✅ Active"
+        text += f"• `{user['username']}` - {status}\n"
+        text += f"  Expires: {user['expires_at']}\n\n"
+    
+    # Callback data carries the cursor, so paging needs no server-side state
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"list:{sort}:{max(offset - LIST_PAGE_SIZE, 0)}"))
+    if offset + LIST_PAGE_SIZE < total:
+        nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"list:{sort}:{offset + LIST_PAGE_SIZE}"))
+    sorts = [
+        InlineKeyboardButton(("• " if name == sort else "") + label, callback_data=f"list:{name}:0")
+        for name, label in (("created", "Newest"), ("expiry", "Expiry"), ("status", "Status"))
+    ]
+    keyboard = [nav, sorts] if nav else [sorts]
+    return text, InlineKeyboardMarkup(keyboard)
+
 @admin_only
 async def list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """List all users"""
-    users = list_users()
+    """List users one page at a time"""
+    sort, offset = "created", 0
+    if update.callback_query and update.callback_query.data.startswith("list:"):
+        _, sort, offset = update.callback_query.data.split(":")
+        offset = int(offset)
     
-    if not users:
-        text = "📋 No users found."
-    else:
-        text = f"📋 *Total Users: {len(users)}*\n\n"
-        for username, user in users.items():
-            expired = is_user_expired(username)
-            status = "❌ Expired" if expired else "✅ Active"
-            text += f"• `{username}` - {status}\n"
-            text += f"  Expires: {user['expiry_date']}\n\n"
+    text, reply_markup = await run_blocking(render_user_page, sort, offset)
     
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, parse_mode="Markdown")
+        try:
+            await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+        except BadRequest as e:
+            # Tapping the sort that is already shown changes nothing
+            if "not modified" not in str(e):
+                raise
     else:
-        await update.message.reply_text(text, parse_mode="Markdown")
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="Markdown")
 
 @admin_only
 async def delete_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -173,24 +387,28 @@ async def delete_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(message_text)
     return DELETE_EMAIL
 
+@timed
 async def delete_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Receive username and delete user"""
     username = update.message.text.strip()
     
-    # Check if user exists
-    user = get_user(username)
-    if not user:
-        await update.message.reply_text("❌ User not found!")
-        return ConversationHandler.END
-    
-    # Remove from XRay
-    success, message = remove_vmess_user(username)
-    if not success:
-        await update.message.reply_text(f"❌ Failed to remove from XRay: {message}")
-        return ConversationHandler.END
-    
-    # Remove from database
-    delete_user(username)
+    async with user_locks.hold(username):
+        # Check if user exists
+        user = await run_blocking(get_user, username)
+        if not user:
+            await update.message.reply_text("❌ User not found!")
+            return ConversationHandler.END
+        
+        # Remove from XRay on every node the account lives on
+        results = (await fleet.remove_users([user]))[0]
+        if not removed(results):
+            await update.message.reply_text(
+                f"❌ Failed to remove from XRay:\n{format_node_failures(results)}", parse_mode="Markdown"
+            )
+            return ConversationHandler.END
+        
+        # Remove from database
+        await run_blocking(delete_user, username)
     
     await update.message.reply_text(f"✅ User `{username}` has been deleted successfully!", parse_mode="Markdown")
     return ConversationHandler.END
@@ -203,24 +421,22 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     username = context.args[0]
-    user = get_user(username)
+    user = await run_blocking(get_user, username)
     
     if not user:
         await update.message.reply_text("❌ User not found!")
         return
     
-    # Generate VMess link
-    vmess_link = generate_vmess_link(username, user['uuid'])
-    
     # Check expiry
-    expired = is_user_expired(username)
+    expired = is_expired(user)
     status = "❌ Expired" if expired else "✅ Active"
     
     response = (
         f"ℹ️ *User Information*\n\n"
         f"{format_user_info(user, user['uuid'])}"
         f"📊 Status: {status}\n\n"
-        f"🔗 *VMess Link:*\n`{vmess_link}`"
+        f"{format_links(user)}"
+        f"{format_subscription(user)}"
     )
     
     await update.message.reply_text(response, parse_mode="Markdown")
@@ -229,11 +445,11 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def monitor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show active connections monitor"""
     try:
-        # Get connection count
-        conn_count = get_connection_count()
-        
-        # Get active connections
-        connections = get_active_connections()
+        # Get connection count and active connections concurrently
+        conn_count, connections = await asyncio.gather(
+            get_connection_count_async(),
+            get_active_connections_async()
+        )
         
         if conn_count == 0 and not connections:
             text = "📊 *Connection Monitor*\n\n🔴 No active connections"
@@ -262,6 +478,163 @@ async def monitor_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text(error_text)
 
+@admin_only
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show top users by traffic in a time window"""
+    window = context.args[0] if context.args else "1h"
+    try:
+        seconds = parse_window(window)
+    except ValueError:
+        await update.message.reply_text("Usage: /top [window]\nExamples: /top 15m, /top 1h, /top 7d")
+        return
+    
+    top_users = await run_blocking(sampler.top, seconds, TOP_USERS)
+    if not top_users:
+        await update.message.reply_text(f"📈 No traffic in the last {window}.")
+        return
+    
+    text = f"📈 *Top Users ({window})*\n\n"
+    for i, (username, up, down) in enumerate(top_users, 1):
+        up_rate, down_rate = sampler.rates.get(username, (0, 0))
+        text += f"{i}. `{username}` - {format_traffic(up + down)}\n"
+        text += f"   ⬆️ {format_traffic(up)} | ⬇️ {format_traffic(down)}\n"
+        text += f"   ⚡ Now: {format_traffic(int(up_rate))}/s up, {format_traffic(int(down_rate))}/s down\n\n"
+    
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+@admin_only
+async def quota_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set a user's traffic quota, re-enabling them if they were cut off"""
+    usage = "Usage: /quota <username> <GB> [reset]\nUse 0 GB for unlimited, add 'reset' to zero the usage."
+    if len(context.args) < 2:
+        await update.message.reply_text(usage)
+        return
+    
+    username = context.args[0]
+    try:
+        quota_bytes = parse_quota(context.args[1])
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    reset = len(context.args) > 2 and context.args[2].lower() == "reset"
+    
+    async with user_locks.hold(username):
+        user = await run_blocking(set_quota, username, quota_bytes, reset)
+        if not user:
+            await update.message.reply_text("❌ User not found!")
+            return
+        
+        # Accounts disabled by the quota engine come back once they have room again
+        if not user['active'] and not is_expired(user) and not is_over_quota(user):
+            results = (await fleet.add_users([(username, user['uuid'])], fleet.nodes_for(user)))[0]
+            if all(success or message == "User already exists" for success, message in results.values()):
+                await run_blocking(set_active, [username], True)
+                user['active'] = True
+                expiry_scheduler.schedule(user)
+    
+    await update.message.reply_text(
+        f"📦 *Quota updated*\n\n{format_user_info(user, user['uuid'])}",
+        parse_mode="Markdown"
+    )
+
+@admin_only
+async def nodes_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ping every node concurrently and show the registry"""
+    replies = await fleet.ping()
+    text = "🖥 Nodes\n\n"
+    for name, (ok, result) in replies.items():
+        node = fleet.nodes[name]
+        state = f"🟢 {result * 1000:.0f} ms" if ok else f"🔴 {result}"
+        default = " (default)" if name in fleet.default_names() else ""
+        text += f"{name} [{node.driver}] {node.address}{default} - {state}\n"
+    await update.message.reply_text(text)
+
+def render_tunnel_status():
+    """Render uptime, readiness and restarts of the supervised tunnels"""
+    tunnels = tunnel_status()
+    if not tunnels:
+        return "🚇 No Argo tunnel running.\nUse /tunnel quick or /tunnel start <name> [domain]."
+    
+    text = "🚇 Argo Tunnels\n\n"
+    for tunnel in tunnels:
+        if tunnel['ready']:
+            state = "🟢 Ready"
+        elif tunnel['running']:
+            state = "🟡 Connecting"
+        else:
+            state = "🔴 Down"
+        text += f"{tunnel['name']} - {state}\n"
+        if tunnel['url']:
+            text += f"   🔗 {tunnel['url']}\n"
+        if tunnel['running']:
+            text += f"   ⏱ Uptime: {format_duration(tunnel['uptime'])} (pid {tunnel['pid']})\n"
+        elif tunnel['next_restart']:
+            text += f"   ⏳ Restarting in {format_duration(max(tunnel['next_restart'] - time.time(), 0))}\n"
+        text += f"   🔁 Restarts: {tunnel['restarts']}\n"
+        if tunnel['last_error']:
+            text += f"   ⚠️ Last error: {tunnel['last_error']}\n"
+        elif tunnel['last_exit'] is not None:
+            text += f"   ⚠️ Last exit code: {tunnel['last_exit']}\n"
+        text += "\n"
+    return text
+
+@admin_only
+async def tunnel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or control the supervised cloudflared tunnels"""
+    action = context.args[0].lower() if context.args else "status"
+    
+    if action == "quick":
+        await update.message.reply_text("⏳ Starting quick tunnel...")
+        success, message = await get_quick_tunnel_url()
+        text = f"✅ Quick tunnel: {message}" if success else f"❌ {message}"
+    elif action == "start" and len(context.args) > 1:
+        domain = context.args[2] if len(context.args) > 2 else None
+        success, message = await start_argo_tunnel(context.args[1], domain)
+        text = f"✅ {message}" if success else f"❌ {message}"
+    elif action == "stop":
+        success, message = await stop_argo_tunnel()
+        text = f"✅ {message}" if success else f"❌ {message}"
+    elif action == "status":
+        text = render_tunnel_status()
+    else:
+        text = "Usage: /tunnel [quick | start <name> [domain] | stop]"
+    
+    await update.message.reply_text(text, disable_web_page_preview=True)
+
+def render_sync_report(report, applied):
+    """Plain-text summary of a reconciliation, per node"""
+    text = "🔄 Sync applied\n\n" if applied else "🔍 Sync dry run\n\n"
+    for name, entry in report.items():
+        if 'error' in entry:
+            text += f"❌ {name}: {entry['error']}\n"
+            continue
+        text += f"{'✅' if not entry['add'] and not entry['remove'] else '⚠️'} {name}: +{len(entry['add'])} -{len(entry['remove'])}\n"
+        for sign, key in (("+", 'add'), ("-", 'remove')):
+            usernames = [username or uuid for _, username, uuid in entry[key]]
+            if usernames:
+                text += f"  {sign} {', '.join(usernames[:SYNC_REPORT_NAMES])}"
+                if len(usernames) > SYNC_REPORT_NAMES:
+                    text += f" ... and {len(usernames) - SYNC_REPORT_NAMES} more"
+                text += "\n"
+        if 'held' in entry:
+            text += f"  ⏸ Removals held: {entry['held']}\n"
+        for (action, username, _), message in entry.get('failed', []):
+            text += f"  ❌ {action} {username}: {message}\n"
+    if not applied and any(entry.get('add') or entry.get('remove') for entry in report.values()):
+        text += "\nUse /sync apply to fix."
+    return text
+
+@admin_only
+async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Compare every node's XRay clients with the database, fixing them with 'apply'"""
+    args = [arg.lower() for arg in context.args]
+    if args not in ([], ["apply"], ["apply", "force"]):
+        await update.message.reply_text("Usage: /sync [apply [force]]")
+        return
+    apply = bool(args)
+    report = await reconciler.run_once(dry_run=not apply, force="force" in args)
+    await update.message.reply_text(render_sync_report(report, apply))
+
 @admin_only
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show help message"""
@@ -269,10 +642,16 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📚 *VMess Bot Help*\n\n"
         "*Available Commands:*\n"
         "/start - Show main menu\n"
-        "/create - Create new VMess account\n"
+        "/create [nodes] - Create new VMess account\n"
+        "/bulkcreate <count> <days> [prefix] [quota] [nodes] - Create many accounts\n"
         "/list - List all VMess accounts\n"
         "/delete - Delete a VMess account\n"
         "/monitor - Monitor active connections\n"
+        "/top [window] - Top users by traffic (e.g. 1h, 7d)\n"
+        "/quota <username> <GB> [reset] - Set traffic quota\n"
+        "/tunnel [quick|start <name> [domain]|stop] - Manage Argo tunnels\n"
+        "/nodes - Show nodes and their latency\n"
+        "/sync [apply [force]] - Compare XRay clients with the database, or fix them\n"
         "/info <username> - Get account info and link\n"
         "/help - Show this help message\n\n"
         "*How to use:*\n"
@@ -289,10 +668,84 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(help_text, parse_mode="Markdown")
 
+async def post_init(application: Application):
+    """Start background tasks once the bot is initialized"""
+    async def notify_revoked(usernames):
+        text = f"⌛ {len(usernames)} expired account(s) revoked:\n" + "\n".join(usernames[:50])
+        if len(usernames) > 50:
+            text += f"\n... and {len(usernames) - 50} more"
+        await application.bot.send_message(ADMIN_ID, text)
+    
+    async def notify_quota_warning(users):
+        lines = [
+            f"`{user['username']}` - {format_traffic(user['used_bytes'])} of {format_traffic(user['quota_bytes'])}"
+            for user in users
+        ]
+        await application.bot.send_message(
+            ADMIN_ID, "⚠️ Quota almost used up:\n" + "\n".join(lines), parse_mode="Markdown"
+        )
+    
+    async def notify_quota_exhausted(usernames):
+        await application.bot.send_message(
+            ADMIN_ID, f"🚫 {len(usernames)} account(s) disabled, quota exhausted:\n" + "\n".join(usernames)
+        )
+    
+    async def handle_ip_violations(violations):
+        text = f"👥 Accounts used from more than {MAX_IPS_PER_USER} IPs:\n"
+        for username, ips in violations.items():
+            text += f"{username}: {', '.join(ips)}\n"
+        if ENFORCE_IP_LIMIT:
+            revoked = await revoke_users(list(violations))
+            text += f"\n🚫 Disabled: {', '.join(revoked) or 'none'}"
+        await application.bot.send_message(ADMIN_ID, text)
+    
+    moved = await run_blocking(prepare_shards)
+    if moved:
+        logger.info(f"Moved {moved} client(s) to their shard")
+    usernames = await run_blocking(usernames_by_uuid)
+    provisioned, tagged = await run_blocking(upgrade_xray_config, usernames=usernames)
+    if provisioned or tagged:
+        logger.info(f"Upgraded XRay config: stats {'enabled' if provisioned else 'already on'}, {tagged} client email(s) backfilled")
+    if not await run_blocking(start_xray):
+        logger.error("Failed to start XRay")
+    application.create_task(reconciler.run())
+    
+    expiry_scheduler.on_revoked = notify_revoked
+    quota_engine.on_warning = notify_quota_warning
+    quota_engine.on_exhausted = notify_quota_exhausted
+    sampler.listeners.append(quota_engine.consume)
+    application.create_task(sampler.run())
+    application.create_task(expiry_scheduler.run())
+    application.create_task(follower.run(on_violation=handle_ip_violations))
+    
+    if METRICS_PORT:
+        application.create_task(exporter.run())
+    if SUBSCRIPTION_PORT:
+        application.create_task(subscriptions.run())
+    
+    if USE_ARGO and ARGO_TUNNEL_NAME:
+        success, message = await start_argo_tunnel(ARGO_TUNNEL_NAME, ARGO_DOMAIN or None)
+        if not success:
+            logger.error(f"Failed to start Argo tunnel: {message}")
+
+async def post_shutdown(application: Application):
+    """Persist state from background tasks and stop child processes"""
+    sampler.flush()
+    await stop_argo_tunnel()
+    await fleet.close()
+
 def main():
     """Start the bot"""
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Create application - updates are processed concurrently so one slow
+    # handler doesn't stall the rest
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Create conversation handler for delete only
     delete_conv_handler = ConversationHandler(
@@ -306,9 +759,15 @@ def main():
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("create", create_start))
+    application.add_handler(CommandHandler("bulkcreate", bulk_create_command))
     application.add_handler(delete_conv_handler)
     application.add_handler(CommandHandler("list", list_users_command))
     application.add_handler(CommandHandler("monitor", monitor_command))
+    application.add_handler(CommandHandler("top", top_command))
+    application.add_handler(CommandHandler("quota", quota_command))
+    application.add_handler(CommandHandler("tunnel", tunnel_command))
+    application.add_handler(CommandHandler("nodes", nodes_command))
+    application.add_handler(CommandHandler("sync", sync_command))
     application.add_handler(CommandHandler("info", info_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CallbackQueryHandler(button_handler))
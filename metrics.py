@@ -0,0 +1,212 @@
+import asyncio
+import bisect
+import threading
+import time
+from config import METRICS_HOST, METRICS_PORT, METRICS_REFRESH_INTERVAL
+from async_utils import run_blocking
+from database import count_users
+from monitor import stats_client, parse_stats, read_socket_table
+from argo_manager import tunnel_status
+from bluegreen import reload_stats
+from http_server import serve_http
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _label_value(value):
+    """Escape a label value for the text exposition format"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + "}"
+
+def render_metric(name, kind, help_text, samples):
+    """Exposition lines for one metric family; samples are (labels, value)"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{_labels(labels)} {value}" for labels, value in samples]
+    return lines
+
+class Histogram:
+    """Latency histogram with optional one-label series, safe to observe from any thread"""
+
+    def __init__(self, name, help_text, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        # label value -> [per-bucket counts (+Inf last), sum, count]
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, label_value=None):
+        """Record one duration"""
+        with self._lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        """Exposition lines with cumulative buckets"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(value, list(counts), total, count) for value, (counts, total, count) in self.series.items()]
+        for value, counts, total, count in series:
+            labels = {self.label: value} if self.label else {}
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(dict(labels, le=bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+config_write_seconds = Histogram(
+    "vmessbot_config_write_seconds", "Time to write the XRay config file."
+)
+xray_restart_seconds = Histogram(
+    "vmessbot_xray_restart_seconds", "Time to restart the XRay service."
+)
+handler_seconds = Histogram(
+    "vmessbot_handler_seconds", "Telegram handler latency.", label="handler"
+)
+
+class MetricsExporter:
+    """Serve Prometheus metrics from a snapshot refreshed in the background.
+
+    Every METRICS_REFRESH_INTERVAL seconds the collectors query XRay, read
+    the socket table and count accounts, and the result is rendered once.
+    A scrape only returns the last rendered text, so it never waits on
+    XRay, spawns a process or parses a file.
+    """
+
+    def __init__(self, interval=METRICS_REFRESH_INTERVAL):
+        self.interval = interval
+        self.snapshot = b""
+        self.collected_at = None
+
+    async def collect_accounts(self):
+        counts = await run_blocking(count_users)
+        return render_metric(
+            "vmessbot_accounts", "gauge", "Accounts by status.",
+            [({'status': status}, count) for status, count in counts.items()]
+        )
+
+    async def collect_xray(self):
+        try:
+            stats = parse_stats(await stats_client.query_async())
+            up = 1
+        except Exception:
+            stats = {}
+            up = 0
+        lines = render_metric("vmessbot_xray_api_up", "gauge", "Whether the XRay StatsService answered.", [({}, up)])
+        for kind in ('user', 'inbound', 'outbound'):
+            lines += render_metric(
+                f"xray_{kind}_traffic_bytes_total", "counter", f"Traffic per {kind} since XRay started.",
+                [
+                    ({kind: name, 'direction': direction}, entry[direction])
+                    for name, entry in stats.get(kind, {}).items()
+                    for direction in ('uplink', 'downlink')
+                ]
+            )
+        return lines
+
+    async def collect_sockets(self):
+        table = await run_blocking(read_socket_table)
+        return render_metric(
+            "vmessbot_inbound_sockets", "gauge", "TCP sockets on the inbound ports by state.",
+            [({'state': state}, count) for state, count in table['states'].items()]
+        ) + render_metric(
+            "vmessbot_inbound_client_ips", "gauge", "Distinct client IPs with an established socket.",
+            [({}, len(table['ips']))]
+        )
+
+    async def collect_commits(self):
+        # xray_manager imports this module for its histograms
+        from xray_manager import commit_stats
+        lines = []
+        for key, name, kind, help_text in (
+            ('config_writes', 'vmessbot_config_writes_total', 'counter', "XRay config writes."),
+            ('reloads', 'vmessbot_xray_restarts_total', 'counter', "XRay service restarts."),
+            ('batches', 'vmessbot_commit_batches_total', 'counter', "Committed mutation batches."),
+            ('max_batch_size', 'vmessbot_commit_batch_size_max', 'gauge', "Largest mutation batch so far."),
+        ):
+            lines += render_metric(name, kind, help_text, [({}, commit_stats[key])])
+        return lines
+
+    async def collect_reloads(self):
+        lines = []
+        for key, name, kind, help_text in (
+            ('handoffs', 'vmessbot_xray_handoffs_total', 'counter', "Blue/green XRay handoffs."),
+            ('failures', 'vmessbot_xray_handoff_failures_total', 'counter', "New XRay processes that never became healthy."),
+            ('draining', 'vmessbot_xray_draining_processes', 'gauge', "Old XRay processes still finishing sessions."),
+            ('last_handoff_seconds', 'vmessbot_xray_handoff_seconds', 'gauge', "Duration of the last handoff."),
+            ('last_drain_seconds', 'vmessbot_xray_drain_seconds', 'gauge', "How long the last old process drained."),
+            ('dropped_total', 'vmessbot_xray_dropped_sessions_total', 'counter', "Sessions cut when an old process was stopped."),
+        ):
+            lines += render_metric(name, kind, help_text, [({}, reload_stats[key])])
+        return lines
+
+    async def collect_tunnels(self):
+        tunnels = tunnel_status()
+        lines = []
+        for name, kind, help_text, value in (
+            ("vmessbot_tunnel_up", "gauge", "Whether the cloudflared process is running.", lambda t: int(t['running'])),
+            ("vmessbot_tunnel_ready", "gauge", "Whether the tunnel passed its readiness probe.", lambda t: int(t['ready'])),
+            ("vmessbot_tunnel_uptime_seconds", "gauge", "Uptime of the current cloudflared process.", lambda t: round(t['uptime'], 1)),
+            ("vmessbot_tunnel_restarts_total", "counter", "cloudflared restarts by the supervisor.", lambda t: t['restarts']),
+        ):
+            lines += render_metric(name, kind, help_text, [({'tunnel': t['name']}, value(t)) for t in tunnels])
+        return lines
+
+    async def refresh(self):
+        """Run every collector and swap in the newly rendered snapshot"""
+        started = time.perf_counter()
+        collectors = (
+            self.collect_accounts, self.collect_xray, self.collect_sockets,
+            self.collect_commits, self.collect_reloads, self.collect_tunnels,
+        )
+        results = await asyncio.gather(*(collector() for collector in collectors), return_exceptions=True)
+        lines = []
+        for collector, result in zip(collectors, results):
+            if isinstance(result, Exception):
+                print(f"Error collecting metrics in {collector.__name__}: {result}")
+                continue
+            lines += result
+        for histogram in (config_write_seconds, xray_restart_seconds, handler_seconds):
+            lines += histogram.render()
+        self.collected_at = time.time()
+        lines += render_metric(
+            "vmessbot_metrics_collect_seconds", "gauge", "Time spent building this snapshot.",
+            [({}, round(time.perf_counter() - started, 6))]
+        )
+        lines += render_metric(
+            "vmessbot_metrics_collected_timestamp_seconds", "gauge", "When this snapshot was built.",
+            [({}, round(self.collected_at, 3))]
+        )
+        self.snapshot = ("\n".join(lines) + "\n").encode()
+
+    async def handle(self, request):
+        """HTTP handler: the cached snapshot on /metrics"""
+        if request.path != '/metrics':
+            return 404, {}, b"Not Found\n"
+        return 200, {'Content-Type': CONTENT_TYPE}, self.snapshot
+
+    async def run(self, host=METRICS_HOST, port=METRICS_PORT):
+        """Serve /metrics and refresh the snapshot forever"""
+        await self.refresh()
+        server = await serve_http(self.handle, host, port)
+        async with server:
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    print(f"Error refreshing metrics: {e}")
+
+exporter = MetricsExporter()
@@ -1,72 +1,185 @@
+import os
 import subprocess
 import json
 import re
+import socket
 from datetime import datetime
+from async_utils import run_blocking, run_command
+from config import XRAY_API_ADDRESS, VMESS_PORT, XRAY_LOCAL_PORT
+import xray_api
+import sharding
+from access_log import follower
 
-def get_xray_connections():
-    """Get active connections from XRay API"""
+JOURNAL_CMD = ['journalctl', '-u', 'xray', '-n', '100', '--no-pager']
+PROC_NET_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+INBOUND_PORTS = {VMESS_PORT, XRAY_LOCAL_PORT} | {shard.port for shard in sharding.shards}
+MAX_TRACKED_IPS = 10000
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+TCP_STATES = {
+    '01': 'ESTABLISHED', '02': 'SYN_SENT', '03': 'SYN_RECV', '04': 'FIN_WAIT1',
+    '05': 'FIN_WAIT2', '06': 'TIME_WAIT', '07': 'CLOSE', '08': 'CLOSE_WAIT',
+    '09': 'LAST_ACK', '0A': 'LISTEN', '0B': 'CLOSING', '0C': 'NEW_SYN_RECV',
+}
+
+class StatsClient:
+    """Long-lived client for XRay's StatsService.
+
+    The underlying gRPC channel is created once per address and shared, so
+    the bot and background pollers reuse one HTTP/2 connection. With
+    sharding on, every shard's API is queried.
+    """
+    
+    def __init__(self, address=None):
+        if address:
+            self.addresses = [address]
+        else:
+            self.addresses = [shard.api_address for shard in sharding.shards] or [XRAY_API_ADDRESS]
+        self.address = self.addresses[0]
+    
+    def query(self, pattern="", reset=False):
+        """Return [(name, value)] for counters matching pattern"""
+        if len(self.addresses) == 1:
+            return xray_api.query_stats(pattern, reset, self.address)
+        return [stat for address in self.addresses for stat in xray_api.query_stats(pattern, reset, address)]
+    
+    async def query_async(self, pattern="", reset=False):
+        """query() from the event loop"""
+        return await run_blocking(self.query, pattern, reset)
+    
+    def get(self, name, reset=False):
+        """Return a single counter value"""
+        if len(self.addresses) == 1:
+            return xray_api.get_stat(name, reset, self.address)
+        # A user's counter only exists on its own shard
+        return sum(value for stat, value in self.query(name, reset) if stat == name)
+
+stats_client = StatsClient()
+
+def stats_to_connections(stats):
+    """Turn [(name, value)] user counters into connection entries"""
+    return [
+        {'email': email, 'uplink': traffic['uplink'], 'downlink': traffic['downlink']}
+        for email, traffic in parse_stats(stats)['user'].items()
+    ]
+
+def get_xray_connections(reset=False):
+    """Get per-user traffic from the XRay StatsService"""
     try:
-        # Query XRay stats API
-        result = subprocess.run(
-            ['xray', 'api', 'statsquery', '--server=127.0.0.1:10085', '--pattern=""'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        
-        if result.returncode == 0:
-            return parse_xray_stats(result.stdout)
-        return []
+        return stats_to_connections(stats_client.query("user>>>", reset))
     except Exception as e:
         print(f"Error getting XRay connections: {e}")
         return []
 
+async def get_xray_connections_async(reset=False):
+    """Get per-user traffic without blocking the event loop"""
+    return await run_blocking(get_xray_connections, reset)
+
+# Counter names look like user>>>EMAIL>>>traffic>>>uplink. The CLI prints
+# them either as JSON ("name": "...", "value": "123") or protobuf text
+# (name: "..." value: 123), with name and value on one or separate lines.
+STAT_NAME_RE = re.compile(r'name"?\s*:\s*"([^"]+)"')
+STAT_VALUE_RE = re.compile(r'value"?\s*:\s*"?(\d+)')
+STAT_KINDS = ('user', 'inbound', 'outbound')
+
+def iter_lines(text):
+    """Yield lines of text one at a time without building a list"""
+    pos = 0
+    end = len(text)
+    while pos < end:
+        newline = text.find('\n', pos)
+        if newline == -1:
+            newline = end
+        yield text[pos:newline]
+        pos = newline + 1
+
+def iter_stats(source):
+    """Yield (name, value) counters from stats output, incrementally.
+
+    source can be the CLI output as a string, any iterable of lines (e.g. a
+    pipe or file), or an iterable of (name, value) pairs from the API.
+    """
+    if isinstance(source, str):
+        source = iter_lines(source)
+    name = None
+    for item in source:
+        if not isinstance(item, str):
+            yield item
+            continue
+        name_match = STAT_NAME_RE.search(item)
+        if name_match:
+            # Zero values are omitted from the output, so a name without
+            # a value before the next name is a zero counter
+            if name is not None:
+                yield name, 0
+            name = name_match.group(1)
+        if name is not None:
+            value_match = STAT_VALUE_RE.search(item, name_match.end() if name_match else 0)
+            if value_match:
+                yield name, int(value_match.group(1))
+                name = None
+    if name is not None:
+        yield name, 0
+
+def parse_stats(source):
+    """Index counters as {kind: {name: {'uplink': n, 'downlink': n}}} in one pass"""
+    result = {kind: {} for kind in STAT_KINDS}
+    for name, value in iter_stats(source):
+        parts = name.split('>>>')
+        if len(parts) != 4 or parts[3] not in ('uplink', 'downlink'):
+            continue
+        index = result.get(parts[0])
+        if index is None:
+            continue
+        entry = index.get(parts[1])
+        if entry is None:
+            entry = index[parts[1]] = {'uplink': 0, 'downlink': 0}
+        # Shards report inbound and outbound counters under the same names
+        entry[parts[3]] += value
+    return result
+
 def parse_xray_stats(stats_output):
     """Parse XRay stats output"""
-    connections = []
     try:
-        # Parse user traffic data
-        lines = stats_output.strip().split('\n')
-        for line in lines:
-            if 'user>>>' in line and ('uplink' in line or 'downlink' in line):
-                match = re.search(r'user>>>(.+?)>>>(uplink|downlink).+?value:\s*(\d+)', line)
-                if match:
-                    email = match.group(1)
-                    direction = match.group(2)
-                    traffic = int(match.group(3))
-                    
-                    # Find or create connection entry
-                    conn = next((c for c in connections if c['email'] == email), None)
-                    if not conn:
-                        conn = {'email': email, 'uplink': 0, 'downlink': 0}
-                        connections.append(conn)
-                    
-                    conn[direction] = traffic
-        
-        return connections
+        return stats_to_connections(stats_output)
     except Exception as e:
         print(f"Error parsing XRay stats: {e}")
         return []
 
+def parse_log_connections(log_output):
+    """Extract connection IPs from XRay log lines"""
+    connections = set()
+    for line in log_output.split('\n'):
+        if 'accepted' in line.lower() or 'connection' in line.lower():
+            # Try to extract IP or connection info
+            match = re.search(r'(\d+\.\d+\.\d+\.\d+)', line)
+            if match:
+                connections.add(match.group(1))
+    
+    return list(connections)
+
 def get_xray_log_connections():
     """Get connections from XRay logs (fallback method)"""
+    # Prefer the incremental access-log follower, journald is the last resort
+    if os.path.exists(follower.path):
+        try:
+            follower.poll()
+            return follower.active_ips()
+        except Exception as e:
+            print(f"Error reading XRay access log: {e}")
     try:
-        result = subprocess.run(
-            ['journalctl', '-u', 'xray', '-n', '100', '--no-pager'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        
-        connections = set()
-        for line in result.stdout.split('\n'):
-            if 'accepted' in line.lower() or 'connection' in line.lower():
-                # Try to extract IP or connection info
-                match = re.search(r'(\d+\.\d+\.\d+\.\d+)', line)
-                if match:
-                    connections.add(match.group(1))
-        
-        return list(connections)
+        result = subprocess.run(JOURNAL_CMD, capture_output=True, text=True, timeout=5)
+        return parse_log_connections(result.stdout)
+    except Exception as e:
+        print(f"Error reading XRay logs: {e}")
+        return []
+
+async def get_xray_log_connections_async():
+    """Get connections from XRay logs without blocking the event loop"""
+    if os.path.exists(follower.path):
+        return await run_blocking(get_xray_log_connections)
+    try:
+        result = await run_command(JOURNAL_CMD, timeout=5)
+        return parse_log_connections(result.stdout)
     except Exception as e:
         print(f"Error reading XRay logs: {e}")
         return []
@@ -82,25 +195,26 @@ def format_traffic(bytes_count):
     else:
         return f"{bytes_count / (1024 * 1024 * 1024):.2f} GB"
 
-def get_active_connections():
-    """Get list of active connections with details"""
+def has_traffic(api_connections):
+    """Check whether any API entry carries traffic"""
+    return any(c.get('uplink', 0) > 0 or c.get('downlink', 0) > 0 for c in api_connections)
+
+def format_connections(api_connections, log_connections):
+    """Format API stats, falling back to log IPs when the API has nothing"""
     connections = []
     
-    # Method 1: Try XRay API
-    api_connections = get_xray_connections()
-    if api_connections:
-        for conn in api_connections:
-            if conn.get('uplink', 0) > 0 or conn.get('downlink', 0) > 0:
-                connections.append({
-                    'user': conn['email'],
-                    'upload': format_traffic(conn['uplink']),
-                    'download': format_traffic(conn['downlink']),
-                    'total': format_traffic(conn['uplink'] + conn['downlink'])
-                })
+    # Method 1: XRay API
+    for conn in api_connections:
+        if conn.get('uplink', 0) > 0 or conn.get('downlink', 0) > 0:
+            connections.append({
+                'user': conn['email'],
+                'upload': format_traffic(conn['uplink']),
+                'download': format_traffic(conn['downlink']),
+                'total': format_traffic(conn['uplink'] + conn['downlink'])
+            })
     
     # Method 2: Fallback to logs
     if not connections:
-        log_connections = get_xray_log_connections()
         for ip in log_connections:
             connections.append({
                 'ip': ip,
@@ -109,19 +223,73 @@ def get_active_connections():
     
     return connections
 
+def get_active_connections():
+    """Get list of active connections with details"""
+    api_connections = get_xray_connections()
+    log_connections = [] if has_traffic(api_connections) else get_xray_log_connections()
+    return format_connections(api_connections, log_connections)
+
+async def get_active_connections_async():
+    """Get list of active connections without blocking the event loop"""
+    api_connections = await get_xray_connections_async()
+    log_connections = [] if has_traffic(api_connections) else await get_xray_log_connections_async()
+    return format_connections(api_connections, log_connections)
+
+def _decode_ip(hex_addr):
+    """Decode an address from /proc/net/tcp{,6} (host byte order words)"""
+    raw = bytes.fromhex(hex_addr)
+    if len(raw) == 4:
+        return socket.inet_ntop(socket.AF_INET, raw[::-1])
+    # IPv6 is four 32-bit little-endian words
+    words = b''.join(raw[i:i + 4][::-1] for i in range(0, 16, 4))
+    if words.startswith(IPV4_MAPPED_PREFIX):
+        return socket.inet_ntop(socket.AF_INET, words[12:])
+    return socket.inet_ntop(socket.AF_INET6, words)
+
+def read_socket_table(ports=None, paths=PROC_NET_TCP, max_ips=MAX_TRACKED_IPS):
+    """Count TCP sockets on our inbound ports straight from /proc/net.
+
+    Returns {'states': {state: count}, 'ips': {remote ip: established
+    count}, 'total': count}. Files are streamed line by line and at most
+    max_ips distinct remote IPs are tracked (the rest count as 'other'), so
+    time and memory stay bounded on huge socket tables.
+    """
+    ports = INBOUND_PORTS if ports is None else ports
+    # Match on the hex port suffix of the local address, no int() per line
+    suffixes = {f":{port:04X}" for port in ports}
+    states = {}
+    ips = {}
+    total = 0
+    for path in paths:
+        try:
+            f = open(path, 'r')
+        except OSError:
+            continue
+        with f:
+            next(f, None)  # header
+            for line in f:
+                fields = line.split(None, 4)
+                if len(fields) < 4 or fields[1][-5:] not in suffixes:
+                    continue
+                state = TCP_STATES.get(fields[3], fields[3])
+                states[state] = states.get(state, 0) + 1
+                total += 1
+                if state != 'ESTABLISHED':
+                    continue
+                ip = _decode_ip(fields[2].rsplit(':', 1)[0])
+                if ip in ips or len(ips) < max_ips:
+                    ips[ip] = ips.get(ip, 0) + 1
+                else:
+                    ips['other'] = ips.get('other', 0) + 1
+    return {'states': states, 'ips': ips, 'total': total}
+
 def get_connection_count():
     """Get total active connection count"""
     try:
-        # Count established connections on XRay port
-        result = subprocess.run(
-            ['ss', '-tn', 'sport', '=', ':54354'],
-            capture_output=True,
-            text=True,
-            timeout=5
-        )
-        
-        # Count ESTABLISHED connections
-        count = len([line for line in result.stdout.split('\n') if 'ESTAB' in line])
-        return count
+        return read_socket_table()['states'].get('ESTABLISHED', 0)
     except Exception:
         return 0
+
+async def get_connection_count_async():
+    """Get total active connection count without blocking the event loop"""
+    return await run_blocking(get_connection_count)
@@ -0,0 +1,302 @@
+import asyncio
+import functools
+import itertools
+import json
+import os
+import ssl
+import time
+from config import (
+    NODES_FILE, NODE_TIMEOUT, NODE_POOL_SIZE, VPS_IP, XRAY_CONFIG_PATH, XRAY_SERVICE
+)
+from async_utils import run_blocking
+from xray_manager import CommitScheduler, apply_mutations, get_vmess_users, scheduler as local_scheduler
+from utils import generate_vmess_link
+
+# Largest JSON line either side will buffer (a few thousand mutations)
+MAX_MESSAGE = 16 * 1024 * 1024
+
+class NodeError(Exception):
+    """A node refused or failed a request"""
+
+def encode_message(message):
+    """One JSON object per line"""
+    return json.dumps(message, separators=(',', ':')).encode() + b'\n'
+
+async def read_message(reader):
+    """Read one JSON line, raising ConnectionError if the peer went away"""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    return json.loads(line)
+
+class LocalNode:
+    """XRay running on this machine, managed through its config file"""
+
+    driver = "local"
+
+    def __init__(self, name, address=None, port=None, argo_domain=None, default=True,
+                 config_path=XRAY_CONFIG_PATH, api_address=None, service=XRAY_SERVICE):
+        self.name = name
+        self.address = address or VPS_IP
+        self.port = port
+        self.argo_domain = argo_domain
+        self.default = default
+        self.config_path = config_path
+        # The stock config path stands for every shard when sharding is on
+        self.sharded = config_path == XRAY_CONFIG_PATH
+        if config_path == XRAY_CONFIG_PATH and not api_address and service == XRAY_SERVICE:
+            # The stock install shares the bot's scheduler so every commit coalesces
+            self.scheduler = local_scheduler
+        else:
+            self.scheduler = CommitScheduler(apply=functools.partial(
+                apply_mutations, config_path=config_path, api_address=api_address, service=service
+            ))
+
+    async def apply(self, mutations):
+        """Apply mutations through this node's commit scheduler"""
+        return await self.scheduler.submit_many(mutations)
+
+    async def users(self):
+        """Clients in this node's XRay config"""
+        return await run_blocking(get_vmess_users, self.config_path)
+
+    async def ping(self):
+        """Local nodes are always reachable"""
+        return 0.0
+
+    async def close(self):
+        pass
+
+class RemoteNode:
+    """XRay on another server, driven through agent.py.
+
+    Requests are JSON lines over TCP (optionally TLS). Authenticated
+    connections are kept in a small pool and reused, so a fleet operation
+    costs one round trip per node instead of a handshake each time.
+    """
+
+    driver = "remote"
+    # The agent's own links are not shard-aware
+    sharded = False
+
+    def __init__(self, name, host, agent_port, token, address=None, port=None, argo_domain=None,
+                 default=True, tls=False, ca_file=None, pool_size=NODE_POOL_SIZE):
+        self.name = name
+        self.host = host
+        self.agent_port = agent_port
+        self.token = token
+        self.address = address or host
+        self.port = port
+        self.argo_domain = argo_domain
+        self.default = default
+        self.ssl = ssl.create_default_context(cafile=ca_file) if tls else None
+        self._slots = asyncio.Semaphore(pool_size)
+        self._idle = []
+        self._ids = itertools.count(1)
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(
+            self.host, self.agent_port, ssl=self.ssl, limit=MAX_MESSAGE
+        )
+        try:
+            writer.write(encode_message({'op': 'hello', 'token': self.token}))
+            await writer.drain()
+            response = await read_message(reader)
+            if not response.get('ok'):
+                raise NodeError(response.get('error', "Authentication failed"))
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _exchange(self, connection, op, params):
+        reader, writer = connection
+        request_id = next(self._ids)
+        writer.write(encode_message({'id': request_id, 'op': op, **params}))
+        await writer.drain()
+        response = await read_message(reader)
+        if response.get('id') != request_id:
+            raise ConnectionError("Out of sync response")
+        return response
+
+    async def request(self, op, **params):
+        """Send one request on a pooled connection and return its result"""
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            while True:
+                fresh = connection is None
+                if fresh:
+                    connection = await self._connect()
+                try:
+                    response = await self._exchange(connection, op, params)
+                except (OSError, ConnectionError, ValueError):
+                    connection[1].close()
+                    connection = None
+                    # The agent may have dropped an idle pooled connection, retry on a new one
+                    if fresh:
+                        raise
+                    continue
+                except BaseException:
+                    # Cancelled mid-request, the stream state is unknown
+                    connection[1].close()
+                    raise
+                self._idle.append(connection)
+                if not response.get('ok'):
+                    raise NodeError(response.get('error', "Request failed"))
+                return response.get('result')
+
+    async def apply(self, mutations):
+        """Apply mutations on the remote node, coalesced by its agent"""
+        results = await self.request('apply', mutations=[list(m) for m in mutations])
+        return [tuple(result) for result in results]
+
+    async def users(self):
+        """Clients in the remote node's XRay config"""
+        return await self.request('users')
+
+    async def ping(self):
+        """Round-trip time to the agent in seconds"""
+        start = time.perf_counter()
+        await self.request('ping')
+        return time.perf_counter() - start
+
+    async def close(self):
+        """Close pooled connections"""
+        while self._idle:
+            self._idle.pop()[1].close()
+
+def node_from_dict(entry):
+    """Build a node from one nodes.json entry"""
+    entry = dict(entry)
+    driver = entry.pop('driver', 'local')
+    if driver == 'local':
+        return LocalNode(**entry)
+    if driver == 'remote':
+        return RemoteNode(**entry)
+    raise ValueError(f"Unknown node driver: {driver}")
+
+def load_nodes(path=NODES_FILE):
+    """Load the node registry, or just this machine if there is none"""
+    if not os.path.exists(path):
+        return [LocalNode("local")]
+    with open(path, 'r') as f:
+        return [node_from_dict(entry) for entry in json.load(f)]
+
+class Fleet:
+    """Every node the bot manages, with concurrent fan-out.
+
+    Each operation is sent to all selected nodes at once and bounded by
+    NODE_TIMEOUT, so it takes about as long as the slowest node. Results
+    are reported per node; one unreachable node never fails the others.
+    """
+
+    def __init__(self, nodes, timeout=NODE_TIMEOUT):
+        self.nodes = {node.name: node for node in nodes}
+        self.timeout = timeout
+
+    def default_names(self):
+        """Nodes new accounts go to when none are chosen"""
+        names = [name for name, node in self.nodes.items() if node.default]
+        return names or list(self.nodes)
+
+    def select(self, names=None):
+        """Resolve node names, raising ValueError for unknown ones"""
+        if not names:
+            return self.default_names()
+        unknown = [name for name in names if name not in self.nodes]
+        if unknown:
+            raise ValueError(f"Unknown node(s): {', '.join(unknown)}")
+        return list(dict.fromkeys(names))
+
+    def nodes_for(self, user):
+        """Nodes an account lives on, ignoring ones removed from the registry"""
+        if not user.get('nodes'):
+            return self.default_names()
+        return [name for name in user['nodes'] if name in self.nodes]
+
+    async def _call(self, name, method, *args):
+        try:
+            return name, True, await asyncio.wait_for(getattr(self.nodes[name], method)(*args), self.timeout)
+        except asyncio.TimeoutError:
+            return name, False, "Timed out"
+        except Exception as e:
+            return name, False, str(e) or type(e).__name__
+
+    async def gather(self, method, names, *args):
+        """Call a node method on many nodes concurrently, {name: (ok, result or error)}"""
+        results = await asyncio.gather(*(self._call(name, method, *args) for name in names))
+        return {name: (ok, result) for name, ok, result in results}
+
+    async def gather_each(self, method, per_node):
+        """Like gather, with different arguments per node"""
+        results = await asyncio.gather(*(self._call(name, method, args) for name, args in per_node.items()))
+        return {name: (ok, result) for name, ok, result in results}
+
+    async def apply(self, per_node):
+        """Apply {node name: mutations}, returning {node name: [(success, message)]}"""
+        replies = await self.gather_each('apply', per_node)
+        return {
+            name: result if ok else [(False, f"Node error: {result}")] * len(per_node[name])
+            for name, (ok, result) in replies.items()
+        }
+
+    async def add_users(self, accounts, names=None):
+        """Add (username, uuid) accounts on the selected nodes.
+
+        Returns one {node name: (success, message)} dict per account.
+        """
+        mutations = [("add", username, uuid) for username, uuid in accounts]
+        replies = await self.apply({name: mutations for name in self.select(names)})
+        return [
+            {name: results[i] for name, results in replies.items()}
+            for i in range(len(accounts))
+        ]
+
+    async def remove_users(self, users):
+        """Remove user records from the nodes they live on.
+
+        Returns one {node name: (success, message)} dict per user.
+        """
+        per_node = {}
+        for user in users:
+            for name in self.nodes_for(user):
+                per_node.setdefault(name, []).append(("remove", user['username'], user['uuid']))
+        replies = await self.apply(per_node)
+        outcome = {user['username']: {} for user in users}
+        for name, results in replies.items():
+            for (_, username, _), result in zip(per_node[name], results):
+                outcome[username][name] = result
+        return [outcome[user['username']] for user in users]
+
+    async def ping(self):
+        """Round-trip time per node"""
+        return await self.gather('ping', list(self.nodes))
+
+    def links(self, user):
+        """(node name, VMess link) for every node an account lives on"""
+        label = len(self.nodes) > 1
+        return [
+            (name, generate_vmess_link(
+                user['username'], user['uuid'],
+                server=self.nodes[name].address,
+                port=self.nodes[name].port,
+                argo_domain=self.nodes[name].argo_domain,
+                label=name if label else None,
+                sharded=self.nodes[name].sharded
+            ))
+            for name in self.nodes_for(user)
+        ]
+
+    async def close(self):
+        """Close connections to remote nodes"""
+        await asyncio.gather(*(node.close() for node in self.nodes.values()))
+
+def succeeded(results):
+    """Node names where an operation went through"""
+    return [name for name, (success, _) in results.items() if success]
+
+def removed(results):
+    """True if a removal left the account on no node"""
+    return all(success or message == "User not found in XRay config" for success, message in results.values())
+
+fleet = Fleet(load_nodes())
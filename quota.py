@@ -0,0 +1,48 @@
+from config import QUOTA_WARN_RATIO
+from async_utils import run_blocking
+from database import add_usage, set_quota_warned, is_over_quota
+from expiry import revoke_users
+
+class QuotaEngine:
+    """Enforce per-user byte quotas from the traffic sampler's deltas.
+
+    Usage is kept as a running total per account, so each sample only costs
+    the users that moved traffic. The sampler already turns counter resets
+    after an XRay restart into correct deltas.
+    """
+
+    def __init__(self, warn_ratio=QUOTA_WARN_RATIO, on_warning=None, on_exhausted=None):
+        self.warn_ratio = warn_ratio
+        self.on_warning = on_warning
+        self.on_exhausted = on_exhausted
+        self.disabled_total = 0
+
+    def account(self, deltas):
+        """Add deltas to usage totals, return (users to warn, users to disable)"""
+        updated = add_usage({username: up + down for username, (up, down) in deltas.items()})
+        warn = []
+        exhausted = []
+        for user in updated:
+            if not user['active']:
+                continue
+            if is_over_quota(user):
+                exhausted.append(user)
+            elif not user['quota_warned'] and user['used_bytes'] >= user['quota_bytes'] * self.warn_ratio:
+                warn.append(user)
+        set_quota_warned([user['username'] for user in warn])
+        return warn, exhausted
+
+    async def consume(self, deltas):
+        """Sampler listener: account deltas and disable exhausted users in one batch"""
+        if not deltas:
+            return
+        warn, exhausted = await run_blocking(self.account, deltas)
+        if warn and self.on_warning:
+            await self.on_warning(warn)
+        if exhausted:
+            disabled = await revoke_users([user['username'] for user in exhausted])
+            self.disabled_total += len(disabled)
+            if disabled and self.on_exhausted:
+                await self.on_exhausted(disabled)
+
+quota_engine = QuotaEngine()
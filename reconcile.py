@@ -0,0 +1,140 @@
+import asyncio
+import time
+from config import SYNC_INTERVAL, SYNC_MAX_REMOVE_RATIO
+from async_utils import run_blocking
+from database import active_accounts, count_users
+from locking import user_locks
+from nodes import fleet
+
+def diff(expected, clients, busy=None):
+    """Minimal mutations that turn a node's clients into the expected set.
+
+    expected maps UUID -> username of every account that should be on the
+    node, clients is the node's client list. Set differences on UUIDs keep
+    this O(n). Usernames for which busy() is true are being changed right
+    now and are left alone. Returns (adds, removes).
+    """
+    present = {client.get('id'): client.get('email', '') for client in clients}
+    adds = [("add", expected[uuid], uuid) for uuid in expected.keys() - present.keys()]
+    removes = [("remove", present[uuid], uuid) for uuid in present.keys() - expected.keys()]
+    if busy is not None:
+        adds = [m for m in adds if not busy(m[1])]
+        removes = [m for m in removes if not busy(m[1])]
+    adds.sort()
+    removes.sort()
+    return adds, removes
+
+def expected_clients(accounts, fleet):
+    """{node name: {uuid: username}} of the accounts each node should serve"""
+    defaults = fleet.default_names()
+    expected = {name: {} for name in fleet.nodes}
+    for username, uuid, nodes, _ in accounts:
+        for name in (nodes or defaults):
+            if name in expected:
+                expected[name][uuid] = username
+    return expected
+
+class Reconciler:
+    """Bring every node's XRay clients in line with the database.
+
+    The database is the source of truth: active accounts missing from a
+    node are added back, clients with no active account are removed.
+    Each node gets all of its changes as a single commit. Accounts held
+    in user_locks are skipped, their handler is mid-change, and so are
+    expired ones still waiting for the expiry scheduler.
+
+    Removals are held back when the database is empty (wrong path, lost
+    file) or when they exceed max_remove_ratio of a node's clients, unless
+    forced. The periodic passes only ever add.
+    """
+
+    def __init__(self, fleet=fleet, interval=SYNC_INTERVAL, max_remove_ratio=SYNC_MAX_REMOVE_RATIO):
+        self.fleet = fleet
+        self.interval = interval
+        self.max_remove_ratio = max_remove_ratio
+        self.last_run = None
+        self.last_report = None
+
+    async def plan(self):
+        """{node name: (adds, removes, client count)}, or an error string for unreachable nodes"""
+        # Nodes first: a create or delete finishing in between then shows up as a
+        # harmless "already exists"/"not found" instead of a wrong removal
+        replies = await self.fleet.gather('users', list(self.fleet.nodes))
+        accounts = await run_blocking(active_accounts)
+        expected = expected_clients(accounts, self.fleet)
+        now = time.time()
+        expired = {username for username, _, _, expiry in accounts if now > expiry}
+
+        def busy(username):
+            return user_locks.locked(username) or username in expired
+        return {
+            name: diff(expected[name], clients, busy) + (len(clients),) if ok else str(clients)
+            for name, (ok, clients) in replies.items()
+        }
+
+    def hold_reason(self, removes, clients, empty, force):
+        """Why removals must not be applied, or None"""
+        if empty:
+            return "database has no accounts"
+        if not force and len(removes) > self.max_remove_ratio * clients:
+            return f"{len(removes)} of {clients} clients, use force"
+        return None
+
+    async def run_once(self, dry_run=False, remove=True, force=False):
+        """Plan and (unless dry_run) apply, returning a per-node report.
+
+        Each entry has 'add' and 'remove' mutation lists, 'held' with the
+        reason removals were not applied (if so) and, once applied,
+        'failed' with the mutations that did not go through; unreachable
+        nodes have 'error' instead. remove=False only adds.
+        """
+        started = time.perf_counter()
+        plan = await self.plan()
+        empty = not any((await run_blocking(count_users)).values())
+        report = {}
+        per_node = {}
+        for name, changes in plan.items():
+            if isinstance(changes, str):
+                report[name] = {'error': changes}
+                continue
+            adds, removes, clients = changes
+            report[name] = {'add': adds, 'remove': removes}
+            if removes:
+                reason = "automatic sync only adds" if not remove else self.hold_reason(removes, clients, empty, force)
+                if reason:
+                    report[name]['held'] = reason
+                    removes = []
+            if adds or removes:
+                per_node[name] = adds + removes
+        if not dry_run and per_node:
+            results = await self.fleet.apply(per_node)
+            for name, mutations in per_node.items():
+                report[name]['failed'] = [
+                    (mutation, message) for mutation, (ok, message) in zip(mutations, results[name])
+                    if not ok and message not in ("User already exists", "User not found in XRay config")
+                ]
+        self.last_run = time.time()
+        self.last_report = report
+        if not dry_run:
+            if per_node:
+                print(f"Sync applied in {time.perf_counter() - started:.2f}s: " + ", ".join(
+                    f"{name} +{len(report[name]['add'])} -{0 if 'held' in report[name] else len(report[name]['remove'])}"
+                    for name in per_node
+                ))
+            for name, entry in report.items():
+                if 'held' in entry:
+                    print(f"Sync held {len(entry['remove'])} removal(s) on {name}: {entry['held']}")
+        return report
+
+    async def run(self):
+        """Reconcile at startup, then every interval seconds, adding only"""
+        while True:
+            try:
+                await self.run_once(remove=False)
+            except Exception as e:
+                print(f"Error reconciling nodes: {e}")
+            if not self.interval:
+                return
+            await asyncio.sleep(self.interval)
+
+reconciler = Reconciler()
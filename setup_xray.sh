@@ -10,14 +10,38 @@ if [ -f /usr/local/etc/xray/config.json ]; then
     echo "✓ Backup config lama"
 fi
 
+# Folder untuk access log (dipakai bot untuk deteksi multi-login)
+mkdir -p /var/log/xray
+
 # Buat config baru
 cat > /usr/local/etc/xray/config.json << 'EOF'
 {
   "log": {
-    "loglevel": "warning"
+    "loglevel": "warning",
+    "access": "/var/log/xray/access.log"
+  },
+  "stats": {},
+  "api": {
+    "tag": "api",
+    "services": ["HandlerService", "StatsService", "LoggerService"]
+  },
+  "policy": {
+    "levels": {
+      "0": {
+        "statsUserUplink": true,
+        "statsUserDownlink": true
+      }
+    },
+    "system": {
+      "statsInboundUplink": true,
+      "statsInboundDownlink": true,
+      "statsOutboundUplink": true,
+      "statsOutboundDownlink": true
+    }
   },
   "inbounds": [
     {
+      "tag": "vmess-in",
       "port": 54354,
       "listen": "0.0.0.0",
       "protocol": "vmess",
@@ -31,6 +55,15 @@ cat > /usr/local/etc/xray/config.json << 'EOF'
           "path": "/vmess"
         }
       }
+    },
+    {
+      "tag": "api",
+      "listen": "127.0.0.1",
+      "port": 10085,
+      "protocol": "dokodemo-door",
+      "settings": {
+        "address": "127.0.0.1"
+      }
     }
   ],
   "outbounds": [
@@ -38,7 +71,16 @@ cat > /usr/local/etc/xray/config.json << 'EOF'
       "protocol": "freedom",
       "settings": {}
     }
-  ]
+  ],
+  "routing": {
+    "rules": [
+      {
+        "type": "field",
+        "inboundTag": ["api"],
+        "outboundTag": "api"
+      }
+    ]
+  }
 }
 EOF
 
@@ -69,6 +111,29 @@ else
     exit 1
 fi
 
+# Sharding (opsional): satu proses XRay per shard, config di /usr/local/etc/xray/shards
+if [ "${XRAY_SHARDS:-1}" -gt 1 ]; then
+    mkdir -p /usr/local/etc/xray/shards
+    cat > /etc/systemd/system/xray@.service << 'EOF'
+[Unit]
+Description=XRay shard %i
+After=network.target
+
+[Service]
+ExecStart=/usr/local/bin/xray run -config /usr/local/etc/xray/shards/%i.json
+Restart=on-failure
+LimitNOFILE=1000000
+
+[Install]
+WantedBy=multi-user.target
+EOF
+    systemctl daemon-reload
+    for i in $(seq 0 $((XRAY_SHARDS - 1))); do
+        systemctl enable xray@shard$i
+    done
+    echo "✓ Unit xray@shard0..$((XRAY_SHARDS - 1)) dibuat (config dibuat oleh bot saat start)"
+fi
+
 echo ""
 echo "=== Setup selesai! ==="
 echo "Sekarang jalankan bot Telegram dan buat akun baru"
@@ -0,0 +1,66 @@
+"""Spread accounts over several XRay processes by consistent hashing of their UUID.
+
+Each shard is its own XRay process with its own config file under
+XRAY_SHARD_DIR, inbound port and WebSocket path. A UUID maps to the first
+ring point at or after its hash; every shard owns many points, so adding
+or removing one shard only moves the accounts on its points.
+"""
+import bisect
+import hashlib
+import os
+from config import (
+    XRAY_SHARDS, XRAY_SHARD_DIR, XRAY_SHARD_BASE_PORT, XRAY_SHARD_API_BASE_PORT, XRAY_SHARD_SERVICE
+)
+
+# Ring points per shard; more points even out the share of each shard
+VIRTUAL_NODES = 160
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+class Shard:
+    """One XRay process serving a slice of the accounts"""
+
+    def __init__(self, index, directory=XRAY_SHARD_DIR, base_port=XRAY_SHARD_BASE_PORT,
+                 api_base_port=XRAY_SHARD_API_BASE_PORT, service=XRAY_SHARD_SERVICE):
+        self.index = index
+        self.name = f"shard{index}"
+        self.config_path = os.path.join(directory, f"{self.name}.json")
+        self.port = base_port + index
+        self.path = f"/vmess-{index}"
+        self.api_port = api_base_port + index
+        self.api_address = f"127.0.0.1:{self.api_port}"
+        self.service = service.format(name=self.name) if service else ""
+
+class HashRing:
+    """Consistent hash ring over shard names"""
+
+    def __init__(self, names, vnodes=VIRTUAL_NODES):
+        points = sorted((_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.names = [name for _, name in points]
+
+    def lookup(self, key):
+        """Name owning a key"""
+        return self.names[bisect.bisect(self.points, _hash(key)) % len(self.points)]
+
+shards = [Shard(i) for i in range(XRAY_SHARDS)] if XRAY_SHARDS > 1 else []
+_by_name = {shard.name: shard for shard in shards}
+_by_path = {shard.config_path: shard for shard in shards}
+ring = HashRing(list(_by_name)) if shards else None
+
+def enabled():
+    """True when accounts are split over more than one XRay"""
+    return bool(shards)
+
+def shard_for(uuid):
+    """Shard an account belongs to, None when sharding is off"""
+    return _by_name[ring.lookup(uuid)] if ring else None
+
+def shard_for_path(path):
+    """Shard whose config lives at path, or None"""
+    return _by_path.get(path)
+
+def layout():
+    """Shard settings that end up in links"""
+    return [(shard.name, shard.port, shard.path) for shard in shards]
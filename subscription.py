@@ -0,0 +1,142 @@
+import base64
+import hashlib
+import hmac
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+from config import (
+    BOT_TOKEN, VPS_IP, VMESS_PORT, BUG_HOST, ARGO_DOMAIN, SUBSCRIPTION_HOST, SUBSCRIPTION_PORT,
+    SUBSCRIPTION_BASE_URL, SUBSCRIPTION_SECRET, SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_UPDATE_HOURS
+)
+from async_utils import run_blocking
+from database import get_user
+from http_server import serve_http
+from nodes import fleet
+import sharding
+from utils import generate_vmess_link, available_link_modes
+
+TOKEN_LENGTH = 22
+
+def _secret_key():
+    """Signing key for subscription URLs, derived from the bot token if none is set"""
+    if SUBSCRIPTION_SECRET:
+        return SUBSCRIPTION_SECRET.encode()
+    return hashlib.sha256(f"subscription:{BOT_TOKEN}".encode()).digest()
+
+def _etag_matches(header, etag):
+    """If-None-Match check, ignoring weak validators"""
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+class SubscriptionServer:
+    """Serve each user's links as a base64 subscription at a secret URL.
+
+    The URL carries an HMAC of the username, so no token table is stored.
+    Rendered payloads are cached per user under a key made of the config
+    version and the account fields links depend on; a change to either
+    re-renders once. Clients polling with If-None-Match get a 304 without
+    any rendering.
+    """
+
+    def __init__(self, key=None, cache_size=SUBSCRIPTION_CACHE_SIZE):
+        self.key = key or _secret_key()
+        self.cache_size = cache_size
+        # username -> (cache key, etag, body), least recently used first
+        self.cache = OrderedDict()
+        self.version = self.config_version()
+        self.hits = 0
+        self.renders = 0
+        self.not_modified = 0
+
+    def config_version(self):
+        """Digest of every setting that ends up in a link"""
+        settings = [VPS_IP, VMESS_PORT, BUG_HOST, ARGO_DOMAIN, sharding.layout()] + [
+            (name, node.address, node.port, node.argo_domain) for name, node in fleet.nodes.items()
+        ]
+        return hashlib.sha1(repr(settings).encode()).hexdigest()[:12]
+
+    def invalidate(self):
+        """Drop cached payloads after link settings changed"""
+        self.version = self.config_version()
+        self.cache.clear()
+
+    def token(self, username):
+        """Secret URL token of a user"""
+        digest = hmac.new(self.key, username.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode()[:TOKEN_LENGTH]
+
+    def url(self, username):
+        """Public subscription URL of a user"""
+        base = SUBSCRIPTION_BASE_URL or f"http://{VPS_IP}:{SUBSCRIPTION_PORT}"
+        return f"{base.rstrip('/')}/sub/{quote(username)}/{self.token(username)}"
+
+    def render(self, user):
+        """Base64 subscription with a link per node and mode"""
+        links = []
+        label = len(fleet.nodes) > 1
+        for name in fleet.nodes_for(user):
+            node = fleet.nodes[name]
+            for mode in available_link_modes(node.argo_domain):
+                links.append(generate_vmess_link(
+                    user['username'], user['uuid'],
+                    server=node.address, port=node.port, argo_domain=node.argo_domain,
+                    label=name if label else None, mode=mode, sharded=node.sharded
+                ))
+        return base64.b64encode("\n".join(links).encode())
+
+    def payload(self, user):
+        """(etag, body) for a user, rendered only if the cache is stale"""
+        key = (self.version, user['uuid'], tuple(fleet.nodes_for(user)))
+        entry = self.cache.get(user['username'])
+        if entry is not None and entry[0] == key:
+            self.cache.move_to_end(user['username'])
+            self.hits += 1
+            return entry[1], entry[2]
+        body = self.render(user)
+        etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        self.cache[user['username']] = (key, etag, body)
+        self.cache.move_to_end(user['username'])
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        self.renders += 1
+        return etag, body
+
+    async def handle(self, request):
+        """HTTP handler for /sub/<username>/<token>"""
+        parts = request.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'sub':
+            return 404, {}, b"Not Found\n"
+        username, token = unquote(parts[1]), parts[2]
+        # Bad tokens and unknown users look the same from outside
+        if not hmac.compare_digest(token, self.token(username)):
+            return 404, {}, b"Not Found\n"
+        user = await run_blocking(get_user, username)
+        if user is None:
+            return 404, {}, b"Not Found\n"
+        if not user['active']:
+            return 403, {}, b"Account disabled\n"
+
+        etag, body = self.payload(user)
+        headers = {
+            'ETag': etag,
+            'Cache-Control': 'private, no-cache',
+            'Profile-Update-Interval': str(SUBSCRIPTION_UPDATE_HOURS),
+            # Shown by most clients as usage and expiry
+            'Subscription-Userinfo': (
+                f"upload=0; download={user['used_bytes']}; "
+                f"total={user['quota_bytes']}; expire={int(user['expiry'])}"
+            ),
+        }
+        if _etag_matches(request.headers.get('if-none-match', ''), etag):
+            self.not_modified += 1
+            return 304, headers, b""
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        return 200, headers, body
+
+    async def run(self, host=SUBSCRIPTION_HOST, port=SUBSCRIPTION_PORT):
+        """Serve subscriptions forever"""
+        server = await serve_http(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+subscriptions = SubscriptionServer()
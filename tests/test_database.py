@@ -0,0 +1,176 @@
+"""User database against a throwaway SQLite file: write-behind, legacy import and ID allocation."""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import uuid
+from unittest import mock
+
+import database
+from locking import FileLock
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_user(username):
+    """A users.json record as the JSON-backed bot stored it"""
+    return {
+        "uuid": str(uuid.uuid4()),
+        "username": username,
+        "created_at": "2024-01-01 00:00:00",
+        "expiry_date": "2099-01-31",
+        "days": 30,
+        "active": True,
+    }
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "users.db")
+        self.legacy_path = os.path.join(tmp.name, "users.json")
+        for name, value in [
+            ("DATABASE_FILE", self.path),
+            ("LEGACY_DATABASE_FILE", self.legacy_path),
+            ("_file_lock", FileLock(self.path + ".lock")),
+            # Only explicit flush() calls write, so the tests see both sides of it
+            ("WRITE_BEHIND_DELAY", 3600),
+        ]:
+            patcher = mock.patch.object(database, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.restart()
+        self.addCleanup(self.restart)
+
+    def restart(self):
+        """Drop the connection, the index and unflushed writes, as a new process would start"""
+        if database._flush_timer is not None:
+            database._flush_timer.cancel()
+        if database._conn is not None:
+            database._conn.close()
+        database._conn = database._conn_inode = database._flush_timer = None
+        database._cache = database._cache_key = None
+        database._uuid_index = {}
+        database._sorted = {}
+        database._pending = {}
+
+    def rows_on_disk(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return {row[0]: row[1] for row in conn.execute("SELECT username, uuid FROM users")}
+        finally:
+            conn.close()
+
+
+class WriteBehindTest(DatabaseTestCase):
+    def test_flush_then_reload(self):
+        alice = database.add_user("alice", str(uuid.uuid4()), days=7, quota_bytes=1024, nodes=["local"])
+        bob = database.add_user("bob", str(uuid.uuid4()))
+        self.assertEqual(database.get_user("alice"), alice)
+        self.assertEqual(self.rows_on_disk(), {})
+
+        database.flush()
+        self.assertEqual(self.rows_on_disk(), {"alice": alice["uuid"], "bob": bob["uuid"]})
+
+        self.restart()
+        self.assertEqual(database.get_user("alice"), alice)
+        self.assertEqual(database.get_user_by_uuid(bob["uuid"]), bob)
+
+    def test_delete_is_flushed(self):
+        database.add_users([("alice", str(uuid.uuid4())), ("bob", str(uuid.uuid4()))])
+        database.flush()
+        self.assertTrue(database.delete_user("alice"))
+        self.assertIsNone(database.get_user("alice"))
+        self.assertIn("alice", self.rows_on_disk())
+
+        database.flush()
+        self.restart()
+        self.assertEqual(set(database.load_users()), {"bob"})
+
+    def test_unflushed_writes_are_lost_on_restart(self):
+        database.add_user("alice", str(uuid.uuid4()))
+        self.restart()
+        self.assertIsNone(database.get_user("alice"))
+
+
+class MigrationTest(DatabaseTestCase):
+    def test_users_json_is_imported_once(self):
+        legacy = {name: legacy_user(name) for name in ("alice", "bob")}
+        with open(self.legacy_path, "w") as f:
+            json.dump(legacy, f)
+
+        alice = database.get_user("alice")
+        self.assertEqual(alice["uuid"], legacy["alice"]["uuid"])
+        self.assertEqual(alice["expires_at"], "2099-01-31 00:00:00")
+        self.assertEqual(alice["nodes"], [])
+        self.assertFalse(os.path.exists(self.legacy_path))
+        with open(self.legacy_path + ".migrated") as f:
+            self.assertEqual(json.load(f), legacy)
+
+        # An account deleted after the import must not come back on the next start
+        database.delete_user("bob")
+        database.flush()
+        self.restart()
+        self.assertEqual(set(database.load_users()), {"alice"})
+
+    def test_existing_accounts_win(self):
+        database.add_user("alice", "new-uuid")
+        database.flush()
+        with open(self.legacy_path, "w") as f:
+            json.dump({"alice": legacy_user("alice")}, f)
+
+        self.assertEqual(database.migrate_from_json(), 1)
+        self.restart()
+        self.assertEqual(database.get_user("alice")["uuid"], "new-uuid")
+
+
+class AllocateIdsTest(DatabaseTestCase):
+    def assertDisjoint(self, ranges):
+        ids = [i for first, count in ranges for i in range(first, first + count)]
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_ranges_are_consecutive_and_grow(self):
+        first = database.allocate_ids(5)
+        self.assertEqual(database.allocate_ids(1), first + 5)
+
+    def test_concurrent_threads(self):
+        ranges = []
+
+        def allocate(count):
+            for _ in range(50):
+                ranges.append((database.allocate_ids(count), count))
+
+        threads = [threading.Thread(target=allocate, args=(count,)) for count in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(ranges), 400)
+        self.assertDisjoint(ranges)
+
+    def test_concurrent_processes(self):
+        script = (
+            "import json, database\n"
+            "print(json.dumps([database.allocate_ids(3) for _ in range(50)]))\n"
+        )
+        env = dict(os.environ, DATABASE_FILE=self.path)
+        workers = [
+            subprocess.Popen([sys.executable, "-c", script], cwd=REPO_DIR, env=env, stdout=subprocess.PIPE)
+            for _ in range(3)
+        ]
+        ranges = [(database.allocate_ids(3), 3) for _ in range(50)]
+        for worker in workers:
+            out, _ = worker.communicate(timeout=60)
+            self.assertEqual(worker.returncode, 0)
+            ranges += [(first, 3) for first in json.loads(out)]
+        self.assertEqual(len(ranges), 200)
+        self.assertDisjoint(ranges)
+
+
+if __name__ == "__main__":
+    unittest.main()
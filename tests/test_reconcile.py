@@ -0,0 +1,121 @@
+"""Reconciler planning: drift in both directions and the guards on removals."""
+import time
+import unittest
+import uuid
+from unittest import mock
+
+import reconcile
+from reconcile import Reconciler, diff
+
+
+def client(email, client_id=None):
+    return {"id": client_id or str(uuid.uuid4()), "alterId": 0, "email": email}
+
+
+class FakeFleet:
+    """One node serving a fixed client list, recording what gets applied"""
+
+    def __init__(self, clients):
+        self.nodes = {"local": None}
+        self.clients = clients
+        self.applied = None
+
+    def default_names(self):
+        return ["local"]
+
+    async def gather(self, method, names):
+        return {name: (True, self.clients) for name in names}
+
+    async def apply(self, per_node):
+        self.applied = per_node
+        return {name: [(True, "ok")] * len(mutations) for name, mutations in per_node.items()}
+
+
+class DiffTest(unittest.TestCase):
+    def test_missing_client_is_added(self):
+        kept = client("alice")
+        expected = {kept["id"]: "alice", "uuid-bob": "bob"}
+        self.assertEqual(diff(expected, [kept]), ([("add", "bob", "uuid-bob")], []))
+
+    def test_unknown_client_is_removed(self):
+        kept, stray = client("alice"), client("mallory")
+        adds, removes = diff({kept["id"]: "alice"}, [kept, stray])
+        self.assertEqual(adds, [])
+        self.assertEqual(removes, [("remove", "mallory", stray["id"])])
+
+    def test_in_sync(self):
+        clients = [client(f"user{i}") for i in range(10)]
+        self.assertEqual(diff({c["id"]: c["email"] for c in clients}, clients), ([], []))
+
+    def test_busy_users_are_skipped(self):
+        stray = client("carol")
+        adds, removes = diff({"uuid-bob": "bob"}, [stray], busy=lambda username: username in ("bob", "carol"))
+        self.assertEqual((adds, removes), ([], []))
+
+
+class HoldReasonTest(unittest.TestCase):
+    def setUp(self):
+        self.reconciler = Reconciler(fleet=FakeFleet([]), interval=0, max_remove_ratio=0.5)
+
+    def removes(self, count):
+        return [("remove", f"user{i}", str(i)) for i in range(count)]
+
+    def test_within_ratio(self):
+        self.assertIsNone(self.reconciler.hold_reason(self.removes(5), 10, empty=False, force=False))
+
+    def test_mass_removal_is_held(self):
+        reason = self.reconciler.hold_reason(self.removes(6), 10, empty=False, force=False)
+        self.assertEqual(reason, "6 of 10 clients, use force")
+
+    def test_force_overrides_ratio(self):
+        self.assertIsNone(self.reconciler.hold_reason(self.removes(10), 10, empty=False, force=True))
+
+    def test_empty_database_is_held_even_when_forced(self):
+        reason = self.reconciler.hold_reason(self.removes(1), 10, empty=True, force=True)
+        self.assertEqual(reason, "database has no accounts")
+
+
+class RunOnceTest(unittest.IsolatedAsyncioTestCase):
+    """run_once on a node where most clients have no account left"""
+
+    def setUp(self):
+        self.kept = client("alice")
+        self.strays = [client(f"stray{i}") for i in range(3)]
+        self.fleet = FakeFleet([self.kept] + self.strays)
+        self.reconciler = Reconciler(fleet=self.fleet, interval=0, max_remove_ratio=0.5)
+        accounts = [
+            ("alice", self.kept["id"], ["local"], time.time() + 3600),
+            ("bob", "uuid-bob", ["local"], time.time() + 3600),
+        ]
+        for name, value in [
+            ("active_accounts", lambda: accounts),
+            ("count_users", lambda: {"active": len(accounts), "expired": 0, "revoked": 0, "over_quota": 0}),
+        ]:
+            patcher = mock.patch.object(reconcile, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_removals_held_adds_applied(self):
+        with mock.patch("builtins.print"):
+            report = await self.reconciler.run_once()
+        self.assertEqual(report["local"]["held"], "3 of 4 clients, use force")
+        self.assertEqual(self.fleet.applied, {"local": [("add", "bob", "uuid-bob")]})
+
+    async def test_force_applies_removals(self):
+        with mock.patch("builtins.print"):
+            report = await self.reconciler.run_once(force=True)
+        self.assertNotIn("held", report["local"])
+        self.assertEqual(self.fleet.applied["local"][0], ("add", "bob", "uuid-bob"))
+        self.assertEqual(
+            sorted(self.fleet.applied["local"][1:]),
+            sorted(("remove", c["email"], c["id"]) for c in self.strays),
+        )
+
+    async def test_periodic_pass_only_adds(self):
+        report = await self.reconciler.run_once(remove=False, dry_run=True, force=True)
+        self.assertEqual(report["local"]["held"], "automatic sync only adds")
+        self.assertIsNone(self.fleet.applied)
+
+
+if __name__ == "__main__":
+    unittest.main()
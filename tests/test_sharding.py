@@ -0,0 +1,71 @@
+"""HashRing: resizing moves about 1/N of the keys, and placement does not depend on the process."""
+import json
+import os
+import subprocess
+import sys
+import unittest
+import uuid
+
+from sharding import HashRing
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Fixed keys, so the cross-process check compares the same set
+KEYS = [str(uuid.UUID(int=i * 0x9E3779B97F4A7C15 % (1 << 128))) for i in range(20000)]
+
+
+def names(count):
+    return [f"shard{i}" for i in range(count)]
+
+
+def placement(ring):
+    return {key: ring.lookup(key) for key in KEYS}
+
+
+class HashRingTest(unittest.TestCase):
+    def assertAboutFraction(self, moved, fraction):
+        # 160 virtual nodes keep each share within about 15% of ideal
+        self.assertGreater(moved / len(KEYS), fraction * 0.75)
+        self.assertLess(moved / len(KEYS), fraction * 1.25)
+
+    def test_adding_a_node_moves_keys_only_to_it(self):
+        before = placement(HashRing(names(4)))
+        after = placement(HashRing(names(5)))
+        moved = [key for key in KEYS if before[key] != after[key]]
+        self.assertEqual({after[key] for key in moved}, {"shard4"})
+        self.assertAboutFraction(len(moved), 1 / 5)
+
+    def test_removing_a_node_moves_only_its_keys(self):
+        before = placement(HashRing(names(5)))
+        after = placement(HashRing([name for name in names(5) if name != "shard2"]))
+        moved = [key for key in KEYS if before[key] != after[key]]
+        self.assertEqual(moved, [key for key in KEYS if before[key] == "shard2"])
+        self.assertAboutFraction(len(moved), 1 / 5)
+
+    def test_keys_are_spread_evenly(self):
+        counts = {}
+        for name in placement(HashRing(names(4))).values():
+            counts[name] = counts.get(name, 0) + 1
+        self.assertEqual(set(counts), set(names(4)))
+        for count in counts.values():
+            self.assertAboutFraction(count, 1 / 4)
+
+    def test_placement_is_the_same_in_another_process(self):
+        script = (
+            "import json, sys\n"
+            "from sharding import HashRing\n"
+            "ring = HashRing(json.loads(sys.argv[1]))\n"
+            "print(json.dumps([ring.lookup(key) for key in json.load(sys.stdin)]))\n"
+        )
+        keys = KEYS[:2000]
+        # A different str hash seed must not matter, the ring hashes with md5
+        env = dict(os.environ, PYTHONHASHSEED="12345")
+        result = subprocess.run(
+            [sys.executable, "-c", script, json.dumps(names(4))],
+            input=json.dumps(keys), capture_output=True, text=True, cwd=REPO_DIR, env=env, check=True
+        )
+        ring = HashRing(names(4))
+        self.assertEqual(json.loads(result.stdout), [ring.lookup(key) for key in keys])
+
+
+if __name__ == "__main__":
+    unittest.main()
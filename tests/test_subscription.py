@@ -0,0 +1,75 @@
+"""Subscription endpoint: conditional requests and ETags that follow the account."""
+import time
+import unittest
+import uuid
+from types import SimpleNamespace
+from unittest import mock
+
+import subscription
+from subscription import SubscriptionServer
+
+
+def account(username, active=True):
+    return {
+        "username": username,
+        "uuid": str(uuid.uuid4()),
+        "active": active,
+        "nodes": [],
+        "used_bytes": 0,
+        "quota_bytes": 0,
+        "expiry": time.time() + 86400,
+    }
+
+
+class SubscriptionTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.users = {"alice": account("alice")}
+        patcher = mock.patch.object(subscription, "get_user", lambda username: self.users.get(username))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = SubscriptionServer(key=b"test key")
+
+    async def get(self, username="alice", etag=None, token=None):
+        headers = {"if-none-match": etag} if etag else {}
+        path = f"/sub/{username}/{token or self.server.token(username)}"
+        return await self.server.handle(SimpleNamespace(path=path, headers=headers))
+
+    async def test_matching_etag_is_not_modified(self):
+        status, headers, body = await self.get()
+        self.assertEqual(status, 200)
+        self.assertTrue(body)
+
+        status, not_modified_headers, body = await self.get(etag=headers["ETag"])
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+        self.assertEqual(not_modified_headers["ETag"], headers["ETag"])
+        self.assertEqual((self.server.renders, self.server.not_modified), (1, 1))
+
+    async def test_weak_and_listed_etags_match(self):
+        _, headers, _ = await self.get()
+        for header in [f'W/{headers["ETag"]}', f'"other", {headers["ETag"]}', "*"]:
+            with self.subTest(header=header):
+                status, _, body = await self.get(etag=header)
+                self.assertEqual((status, body), (304, b""))
+
+    async def test_changed_account_gets_new_etag(self):
+        _, headers, body = await self.get()
+        self.users["alice"] = dict(self.users["alice"], uuid=str(uuid.uuid4()))
+
+        status, new_headers, new_body = await self.get(etag=headers["ETag"])
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_headers["ETag"], headers["ETag"])
+        self.assertNotEqual(new_body, body)
+        self.assertEqual(self.server.renders, 2)
+
+    async def test_bad_token_and_unknown_user_look_the_same(self):
+        self.assertEqual((await self.get(token="x" * 22))[0], 404)
+        self.assertEqual((await self.get(username="bob"))[0], 404)
+
+    async def test_disabled_account(self):
+        self.users["alice"]["active"] = False
+        self.assertEqual((await self.get())[0], 403)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""TrafficSampler deltas: the first reading is a baseline, counters that go backwards restart from zero."""
+import os
+import tempfile
+import unittest
+
+from traffic import TrafficSampler
+
+
+def stat(email, direction, value):
+    return (f"user>>>{email}>>>traffic>>>{direction}", value)
+
+
+class TrafficSamplerTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.stats = []
+        self.sampler = TrafficSampler(
+            source=lambda: self.stats, interval=10, ring_size=6, db_file=os.path.join(tmp.name, "traffic.db")
+        )
+        self.addCleanup(self.close)
+
+    def close(self):
+        if self.sampler._conn is not None:
+            self.sampler._conn.close()
+
+    def test_first_sample_is_baseline(self):
+        self.stats = [stat("alice", "uplink", 7_000), stat("alice", "downlink", 5_000_000_000)]
+        self.assertEqual(self.sampler.sample(1000.0), {})
+        self.assertEqual(self.sampler.rates, {})
+
+        self.stats = [stat("alice", "uplink", 7_100), stat("alice", "downlink", 5_000_000_300)]
+        self.assertEqual(self.sampler.sample(1010.0), {"alice": (100, 300)})
+        self.assertEqual(self.sampler.rates, {"alice": (10.0, 30.0)})
+
+    def test_new_user_after_baseline_counts_from_zero(self):
+        self.stats = [stat("alice", "downlink", 100)]
+        self.sampler.sample(1000.0)
+        self.stats = [stat("alice", "downlink", 100), stat("bob", "downlink", 40)]
+        self.assertEqual(self.sampler.sample(1010.0), {"bob": (0, 40)})
+
+    def test_counter_reset(self):
+        self.stats = [stat("alice", "uplink", 1_000), stat("alice", "downlink", 9_000)]
+        self.sampler.sample(1000.0)
+        self.stats = [stat("alice", "uplink", 1_500), stat("alice", "downlink", 9_000)]
+        self.assertEqual(self.sampler.sample(1010.0), {"alice": (500, 0)})
+
+        # XRay restarted: what it reports now was all sent since the restart
+        self.stats = [stat("alice", "uplink", 20), stat("alice", "downlink", 300)]
+        self.assertEqual(self.sampler.sample(1020.0), {"alice": (20, 300)})
+        self.stats = [stat("alice", "uplink", 25), stat("alice", "downlink", 300)]
+        self.assertEqual(self.sampler.sample(1030.0), {"alice": (5, 0)})
+
+    def test_idle_user_is_dropped_after_a_full_ring(self):
+        self.sampler.sample(1000.0)
+        self.stats = [stat("alice", "downlink", 10)]
+        self.sampler.sample(1010.0)
+        for i in range(6):
+            self.assertIn("alice", self.sampler.up)
+            self.assertEqual(self.sampler.sample(1020.0 + 10 * i), {})
+        self.assertNotIn("alice", self.sampler.up)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+"""Round trips of the hand-encoded XRay API messages through an in-process gRPC server.
+
+The fake server sees the raw request bytes and decodes them with the small
+protobuf reader below, written independently of xray_api's encoder.
+"""
+import unittest
+import uuid
+from concurrent import futures
+
+import grpc
+
+import xray_api
+
+HANDLER_SERVICE = "xray.app.proxyman.command.HandlerService"
+STATS_SERVICE = "xray.app.stats.command.StatsService"
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def decode(data):
+    """{field number: [values]} of a message with varint and length-delimited fields"""
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        if key & 7 == 0:
+            value, pos = read_varint(data, pos)
+        elif key & 7 == 2:
+            length, pos = read_varint(data, pos)
+            value, pos = bytes(data[pos:pos + length]), pos + length
+        else:
+            raise AssertionError(f"Unexpected wire type {key & 7}")
+        fields.setdefault(key >> 3, []).append(value)
+    return fields
+
+
+def only(fields, number, default=None):
+    """The single value of a field, default when the field is absent"""
+    values = fields.get(number, [])
+    assert len(values) <= 1, f"field {number} repeated"
+    return values[0] if values else default
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_field(number, value):
+    """One field: ints as varints, str/bytes length-delimited"""
+    if isinstance(value, int):
+        return encode_varint(number << 3) + encode_varint(value)
+    if isinstance(value, str):
+        value = value.encode()
+    return encode_varint(number << 3 | 2) + encode_varint(len(value)) + value
+
+
+def encode_stat(name, value):
+    """xray.app.stats.command.Stat, a zero value left out like protobuf does"""
+    return encode_field(1, name) + (encode_field(2, value) if value else b"")
+
+
+def decode_typed(data):
+    """TypedMessage -> (type name, value bytes)"""
+    fields = decode(data)
+    return only(fields, 1, b"").decode(), only(fields, 2, b"")
+
+
+class FakeXray:
+    """gRPC server on a free localhost port recording raw requests per method"""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = {}
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+        self.port = self.server.add_insecure_port("127.0.0.1:0")
+        self.address = f"127.0.0.1:{self.port}"
+
+    def handle(self, service, method):
+        def handler(request, context):
+            self.requests.append((method, request))
+            response = self.responses.get(method, b"")
+            if isinstance(response, Exception):
+                context.abort(grpc.StatusCode.UNKNOWN, str(response))
+            return response
+        return grpc.unary_unary_rpc_method_handler(handler)
+
+    def serve(self, service, methods):
+        # No (de)serializers: handlers see and return raw bytes
+        self.server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler(
+            service, {method: self.handle(service, method) for method in methods}
+        )])
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop(0)
+
+
+class XrayApiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.xray = FakeXray()
+        self.xray.serve(HANDLER_SERVICE, ["AlterInbound"])
+        self.xray.serve(STATS_SERVICE, ["QueryStats", "GetStats"])
+        self.xray.start()
+
+    def tearDown(self):
+        xray_api.close_channels()
+        self.xray.stop()
+
+    def last_request(self, method):
+        self.assertEqual(len(self.xray.requests), 1)
+        self.assertEqual(self.xray.requests[0][0], method)
+        return self.xray.requests[0][1]
+
+
+class HandlerServiceTest(XrayApiTestCase):
+    def alter_inbound(self):
+        """(tag, operation type, operation fields) of the AlterInbound request"""
+        request = decode(self.last_request("AlterInbound"))
+        operation_type, operation = decode_typed(only(request, 2))
+        return only(request, 1).decode(), operation_type, decode(operation)
+
+    def test_add_vmess_client(self):
+        client_id = str(uuid.uuid4())
+        success, message = xray_api.add_vmess_client("vmess-in", "alice", client_id, address=self.xray.address)
+        self.assertTrue(success, message)
+
+        tag, operation_type, operation = self.alter_inbound()
+        self.assertEqual(tag, "vmess-in")
+        self.assertEqual(operation_type, "xray.app.proxyman.command.AddUserOperation")
+        user = decode(only(operation, 1))
+        self.assertEqual(only(user, 1, 0), 0)
+        self.assertEqual(only(user, 2), b"alice")
+        account_type, account = decode_typed(only(user, 3))
+        self.assertEqual(account_type, "xray.proxy.vmess.Account")
+        self.assertEqual(only(decode(account), 1).decode(), client_id)
+
+    def test_add_vmess_client_level(self):
+        xray_api.add_vmess_client("vmess-in", "bob", str(uuid.uuid4()), level=2, address=self.xray.address)
+        _, _, operation = self.alter_inbound()
+        self.assertEqual(only(decode(only(operation, 1)), 1), 2)
+
+    def test_remove_client(self):
+        success, message = xray_api.remove_client("vmess-in", "alice", address=self.xray.address)
+        self.assertTrue(success, message)
+
+        tag, operation_type, operation = self.alter_inbound()
+        self.assertEqual(tag, "vmess-in")
+        self.assertEqual(operation_type, "xray.app.proxyman.command.RemoveUserOperation")
+        self.assertEqual(operation, {1: [b"alice"]})
+
+    def test_api_error_is_reported(self):
+        self.xray.responses["AlterInbound"] = RuntimeError("User alice already exists")
+        success, message = xray_api.add_vmess_client("vmess-in", "alice", str(uuid.uuid4()), address=self.xray.address)
+        self.assertFalse(success)
+        self.assertIn("already exists", message)
+
+
+class StatsServiceTest(XrayApiTestCase):
+    def test_query_stats(self):
+        self.xray.responses["QueryStats"] = b"".join(encode_field(1, encode_stat(name, value)) for name, value in [
+            ("user>>>alice>>>traffic>>>uplink", 5_000_000_000),
+            ("user>>>alice>>>traffic>>>downlink", 0),
+            ("user>>>bob>>>traffic>>>downlink", 300),
+        ])
+        stats = xray_api.query_stats("user>>>", address=self.xray.address)
+        self.assertEqual(stats, [
+            ("user>>>alice>>>traffic>>>uplink", 5_000_000_000),
+            ("user>>>alice>>>traffic>>>downlink", 0),
+            ("user>>>bob>>>traffic>>>downlink", 300),
+        ])
+        request = decode(self.last_request("QueryStats"))
+        self.assertEqual(only(request, 1), b"user>>>")
+        self.assertEqual(only(request, 2, 0), 0)
+
+    def test_query_stats_reset(self):
+        xray_api.query_stats("user>>>", reset=True, address=self.xray.address)
+        self.assertEqual(only(decode(self.last_request("QueryStats")), 2), 1)
+
+    def test_query_stats_empty(self):
+        self.assertEqual(xray_api.query_stats("", address=self.xray.address), [])
+        self.assertEqual(decode(self.last_request("QueryStats")), {})
+
+    def test_get_stat(self):
+        name = "inbound>>>vmess-in>>>traffic>>>downlink"
+        self.xray.responses["GetStats"] = encode_field(1, encode_stat(name, 1 << 40))
+        self.assertEqual(xray_api.get_stat(name, reset=True, address=self.xray.address), 1 << 40)
+        request = decode(self.last_request("GetStats"))
+        self.assertEqual(only(request, 1).decode(), name)
+        self.assertEqual(only(request, 2), 1)
+
+    def test_get_stat_missing(self):
+        self.assertEqual(xray_api.get_stat("user>>>nobody>>>traffic>>>uplink", address=self.xray.address), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
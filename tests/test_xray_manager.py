@@ -0,0 +1,46 @@
+"""Streaming config encoder: same bytes as json.dumps, never more than a chunk per piece."""
+import json
+import unittest
+import uuid
+
+import xray_manager
+from xray_manager import COMPACT_ENCODER, ENCODE_CHUNK, iter_compact_json
+
+
+def compact(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+class IterCompactJsonTest(unittest.TestCase):
+    def test_large_client_list_is_chunked(self):
+        clients = [{"id": str(uuid.uuid4()), "alterId": 0, "email": f"user{i}"} for i in range(5 * ENCODE_CHUNK + 7)]
+        config = xray_manager.default_xray_config()
+        xray_manager.find_vmess_inbound(config)['settings']['clients'] = clients
+
+        pieces = list(iter_compact_json(config))
+        self.assertEqual(''.join(pieces), compact(config))
+        # A chunk's items plus the separator in front of them, without the brackets
+        largest_chunk = max(
+            len(COMPACT_ENCODER.encode(clients[start:start + ENCODE_CHUNK])) - 1
+            for start in range(0, len(clients), ENCODE_CHUNK)
+        )
+        self.assertLessEqual(max(len(piece) for piece in pieces), largest_chunk)
+
+    def test_matches_json_dumps(self):
+        for value in [
+            {}, [], [[]], [{}] * 3, "é", None,
+            [1, [2, {"a": [3]}], 4],
+            {"a": [{"b": list(range(ENCODE_CHUNK * 2 + 1))}]},
+            [{"x": 1}, [2], {"y": {"z": []}}, 3],
+        ]:
+            with self.subTest(value=value):
+                self.assertEqual(''.join(iter_compact_json(value)), compact(value))
+
+    def test_non_string_keys(self):
+        value = {"a": {1: 2, 1.5: [1], True: None, None: "x"}}
+        self.assertEqual(''.join(iter_compact_json(value)), compact(value))
+        json.loads(''.join(iter_compact_json(value)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,223 @@
+import asyncio
+import heapq
+import sqlite3
+import threading
+import time
+from array import array
+from config import TRAFFIC_SAMPLE_INTERVAL, TRAFFIC_RING_SIZE, TRAFFIC_DB_FILE
+from async_utils import run_blocking
+from monitor import stats_client, stats_to_connections
+
+# Rollup resolutions: name -> (bucket seconds, retention seconds)
+ROLLUPS = {
+    'minute': (60, 2 * 86400),
+    'hour': (3600, 60 * 86400),
+    'day': (86400, 730 * 86400),
+}
+
+WINDOW_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (
+    resolution TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    up INTEGER NOT NULL,
+    down INTEGER NOT NULL,
+    PRIMARY KEY (resolution, bucket, username)
+);
+"""
+
+def parse_window(window):
+    """Parse '15m', '1h', '7d' into seconds"""
+    window = window.strip().lower()
+    if len(window) < 2 or window[-1] not in WINDOW_UNITS or not window[:-1].isdigit():
+        raise ValueError(f"Invalid window: {window}")
+    return int(window[:-1]) * WINDOW_UNITS[window[-1]]
+
+class RingBuffer:
+    """Fixed-size ring of unsigned ints backed by a compact array"""
+
+    def __init__(self, size, typecode='Q'):
+        self.size = size
+        self.values = array(typecode, bytes(array(typecode).itemsize * size))
+
+    def set(self, pos, value):
+        self.values[pos % self.size] = value
+
+    def sum_last(self, pos, count):
+        """Sum the count slots ending at pos (inclusive)"""
+        count = min(count, self.size)
+        total = 0
+        for i in range(pos - count + 1, pos + 1):
+            total += self.values[i % self.size]
+        return total
+
+class TrafficSampler:
+    """Poll per-user counters at a fixed interval and keep recent history.
+
+    The last TRAFFIC_RING_SIZE samples live in per-user ring buffers, older
+    traffic is summed into minute/hour/day rollups stored in SQLite.
+    """
+
+    def __init__(self, source=None, interval=TRAFFIC_SAMPLE_INTERVAL,
+                 ring_size=TRAFFIC_RING_SIZE, db_file=TRAFFIC_DB_FILE):
+        self.source = source or (lambda: stats_client.query("user>>>"))
+        self.interval = interval
+        self.ring_size = ring_size
+        self.db_file = db_file
+        self.tick = -1
+        self.last_sample = None
+        # email -> (uplink, downlink) as of the last sample, None until the first
+        self.last_counters = None
+        self.up = {}
+        self.down = {}
+        self.last_seen = {}
+        self.rates = {}
+        # Async callbacks receiving {username: (up, down)} after each sample
+        self.listeners = []
+        # resolution -> (bucket start, {username: [up, down]})
+        self.open_buckets = {name: (None, {}) for name in ROLLUPS}
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def sample(self, now=None):
+        """Take one sample from the stats source and record the deltas"""
+        now = now or time.time()
+        connections = stats_to_connections(self.source())
+        if self.last_counters is None:
+            # XRay's counters outlive the bot: the first reading after a start
+            # holds traffic that was already counted, so it is only a baseline
+            self.last_counters = {conn['email']: (conn['uplink'], conn['downlink']) for conn in connections}
+            connections = []
+        deltas = {}
+        for conn in connections:
+            email = conn['email']
+            last = self.last_counters.get(email, (0, 0))
+            # Counters go backwards when XRay restarts, count from zero then
+            up = conn['uplink'] - last[0] if conn['uplink'] >= last[0] else conn['uplink']
+            down = conn['downlink'] - last[1] if conn['downlink'] >= last[1] else conn['downlink']
+            self.last_counters[email] = (conn['uplink'], conn['downlink'])
+            if up or down:
+                deltas[email] = (up, down)
+
+        with self._lock:
+            elapsed = now - self.last_sample if self.last_sample else self.interval
+            self.last_sample = now
+            self.tick += 1
+
+            for email in deltas.keys() - self.up.keys():
+                self.up[email] = RingBuffer(self.ring_size)
+                self.down[email] = RingBuffer(self.ring_size)
+
+            # Every ring advances together, idle users get a zero slot
+            self.rates = {}
+            for email in list(self.up):
+                up, down = deltas.get(email, (0, 0))
+                self.up[email].set(self.tick, up)
+                self.down[email].set(self.tick, down)
+                if up or down:
+                    self.last_seen[email] = self.tick
+                    self.rates[email] = (up / elapsed, down / elapsed)
+                elif self.tick - self.last_seen.get(email, self.tick) >= self.ring_size:
+                    # Ring is all zeros now, drop the user
+                    del self.up[email], self.down[email], self.last_seen[email]
+
+            self._roll_up(now, deltas)
+        return deltas
+
+    def _roll_up(self, now, deltas):
+        """Add deltas to the open buckets, persisting buckets that closed"""
+        closed = []
+        for name, (seconds, _) in ROLLUPS.items():
+            bucket = int(now // seconds * seconds)
+            start, totals = self.open_buckets[name]
+            if start is not None and bucket != start and totals:
+                closed.append((name, start, totals))
+            if start != bucket:
+                totals = {}
+                self.open_buckets[name] = (bucket, totals)
+            for email, (up, down) in deltas.items():
+                entry = totals.setdefault(email, [0, 0])
+                entry[0] += up
+                entry[1] += down
+        if closed:
+            self._persist(closed, now)
+
+    def _persist(self, closed, now):
+        conn = self._db()
+        with conn:
+            for name, start, totals in closed:
+                conn.executemany(
+                    "INSERT INTO rollups (resolution, bucket, username, up, down) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(resolution, bucket, username) DO UPDATE SET "
+                    "up = up + excluded.up, down = down + excluded.down",
+                    [(name, start, email, up, down) for email, (up, down) in totals.items()]
+                )
+                conn.execute(
+                    "DELETE FROM rollups WHERE resolution = ? AND bucket < ?",
+                    (name, now - ROLLUPS[name][1])
+                )
+
+    def flush(self):
+        """Persist the open buckets (e.g. on shutdown)"""
+        with self._lock:
+            closed = [(name, start, totals) for name, (start, totals) in self.open_buckets.items() if totals]
+            self.open_buckets = {name: (None, {}) for name in ROLLUPS}
+            if closed:
+                self._persist(closed, time.time())
+
+    def window_totals(self, seconds, now=None):
+        """Return {username: (up, down)} over the last seconds"""
+        now = now or time.time()
+        with self._lock:
+            samples = max(1, int(seconds // self.interval))
+            if samples <= self.ring_size:
+                return {
+                    email: (self.up[email].sum_last(self.tick, samples),
+                            self.down[email].sum_last(self.tick, samples))
+                    for email in self.up
+                }
+            # Longer windows come from the finest rollup that still covers them
+            name = next(n for n, (_, keep) in ROLLUPS.items() if keep >= seconds or n == 'day')
+            start, open_totals = self.open_buckets[name]
+            totals = {email: list(values) for email, values in open_totals.items()}
+            rows = self._db().execute(
+                "SELECT username, SUM(up), SUM(down) FROM rollups "
+                "WHERE resolution = ? AND bucket >= ? GROUP BY username",
+                (name, now - seconds)
+            ).fetchall()
+
+        for email, up, down in rows:
+            entry = totals.setdefault(email, [0, 0])
+            entry[0] += up
+            entry[1] += down
+        return {email: tuple(values) for email, values in totals.items()}
+
+    def top(self, seconds, n=10):
+        """Top-n users by total traffic in the window, as (username, up, down)"""
+        totals = self.window_totals(seconds)
+        best = heapq.nlargest(n, totals.items(), key=lambda item: item[1][0] + item[1][1])
+        return [(email, up, down) for email, (up, down) in best if up or down]
+
+    async def run(self):
+        """Sample forever on a fixed schedule that doesn't drift"""
+        next_run = time.monotonic()
+        while True:
+            try:
+                deltas = await run_blocking(self.sample)
+                for listener in self.listeners:
+                    await listener(deltas)
+            except Exception as e:
+                print(f"Error sampling traffic: {e}")
+            next_run += self.interval
+            await asyncio.sleep(max(0, next_run - time.monotonic()))
+
+sampler = TrafficSampler()
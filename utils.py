@@ -1,39 +1,77 @@
 import json
 import base64
 from config import VPS_IP, VMESS_PORT, BUG_HOST, ARGO_DOMAIN, USE_ARGO
+from sharding import shard_for
 
-def generate_vmess_link(username, uuid, use_argo=None):
-    """Generate VMess link - supports Direct, Bug Host, and Argo Tunnel modes"""
-    
-    # Determine mode
+# Link modes, in the order subscriptions list them
+LINK_MODES = ('direct', 'bughost', 'argo')
+MODE_LABELS = {'direct': 'Direct', 'bughost': 'Bug Host', 'argo': 'Argo'}
+
+def default_link_mode(use_argo=None, argo_domain=None):
+    """Mode used when none is asked for: Argo if enabled, else Bug Host if set, else Direct"""
     if use_argo is None:
         use_argo = USE_ARGO
+    if use_argo and (argo_domain or ARGO_DOMAIN):
+        return 'argo'
+    if BUG_HOST and BUG_HOST.strip():
+        return 'bughost'
+    return 'direct'
+
+def available_link_modes(argo_domain=None):
+    """Every mode the current settings can produce a working link for"""
+    modes = ['direct']
+    if BUG_HOST and BUG_HOST.strip():
+        modes.append('bughost')
+    if argo_domain or ARGO_DOMAIN:
+        modes.append('argo')
+    return modes
+
+def generate_vmess_link(username, uuid, use_argo=None, server=None, port=None, argo_domain=None, label=None,
+                        mode=None, sharded=False):
+    """Generate VMess link - supports Direct, Bug Host, and Argo Tunnel modes.
+
+    server, port and argo_domain default to this VPS; pass a node's values
+    to link to another server. label is shown in the remark. mode picks
+    one of LINK_MODES, by default it follows USE_ARGO and BUG_HOST. sharded
+    marks a link to this machine's sharded XRay, port and path are then
+    those of the account's shard.
+    """
+    
+    # Determine mode
+    server = server or VPS_IP
+    shard = shard_for(uuid) if sharded else None
+    if shard:
+        port = shard.port
+    argo_domain = argo_domain or ARGO_DOMAIN
+    if mode is None:
+        mode = default_link_mode(use_argo, argo_domain)
     
-    if use_argo and ARGO_DOMAIN:
+    if mode == 'argo':
         # Argo Tunnel Mode
-        address = ARGO_DOMAIN
-        host_header = ARGO_DOMAIN
+        address = argo_domain
+        host_header = argo_domain
         port = "443"  # Argo uses 443 with TLS
         tls = "tls"
-        sni = ARGO_DOMAIN
-    elif BUG_HOST and BUG_HOST.strip():
+        sni = argo_domain
+    elif mode == 'bughost':
         # Bug Host Mode
         address = BUG_HOST
-        host_header = VPS_IP
+        host_header = server
         port = "80"
         tls = ""
         sni = ""
     else:
         # Direct Mode
-        address = VPS_IP
+        address = server
         host_header = ""
-        port = str(VMESS_PORT)
+        port = str(port or VMESS_PORT)
         tls = ""
         sni = ""
     
+    remark = f"{username} [{label}]" if label else username
     vmess_config = {
         "v": "2",
-        "ps": f"{username} ({'Argo' if use_argo and ARGO_DOMAIN else 'Direct'})",
+        "ps": f"{remark} ({MODE_LABELS[mode]})",
         "add": address,
         "port": port,
         "id": uuid,
@@ -42,7 +80,7 @@ def generate_vmess_link(username, uuid, use_argo=None):
         "net": "ws",
         "type": "none",
         "host": host_header,
-        "path": "/vmess",
+        "path": shard.path if shard else "/vmess",
         "tls": tls,
         "sni": sni,
         "alpn": ""
@@ -71,7 +109,23 @@ def format_user_info(user, uuid):
     info = f"👤 Username: `{user['username']}`\n"
     info += f"🆔 UUID: `{uuid}`\n"
     info += f"📅 Created: {user['created_at']}\n"
-    info += f"⏰ Expires: {user['expiry_date']}\n"
+    info += f"⏰ Expires: {user.get('expires_at', user['expiry_date'])}\n"
     info += f"⏳ Duration: {user['days']} days\n"
+    if user.get('quota_bytes'):
+        used_gb = user['used_bytes'] / 1024 ** 3
+        quota_gb = user['quota_bytes'] / 1024 ** 3
+        info += f"📦 Quota: {used_gb:.2f} / {quota_gb:.2f} GB\n"
     info += f"✅ Status: {'Active' if user['active'] else 'Inactive'}\n"
     return info
+
+def format_duration(seconds):
+    """Format seconds as e.g. 2d 3h, 4h 5m or 6m 7s"""
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}d {hours}h"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m {seconds}s"
@@ -0,0 +1,164 @@
+from config import XRAY_API_ADDRESS
+
+HANDLER_SERVICE = "/xray.app.proxyman.command.HandlerService"
+STATS_SERVICE = "/xray.app.stats.command.StatsService"
+API_TIMEOUT = 3
+
+_channels = {}
+
+# XRay API messages are encoded by hand so we don't need generated protobuf
+# modules - only grpcio is required
+
+def _varint(value):
+    """Encode an unsigned integer as a protobuf varint"""
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+def _field_varint(number, value):
+    """Encode a varint field (wire type 0)"""
+    if not value:
+        return b""
+    return _varint(number << 3) + _varint(value)
+
+def _field_bytes(number, value):
+    """Encode a length-delimited field (wire type 2)"""
+    if isinstance(value, str):
+        value = value.encode()
+    if not value:
+        return b""
+    return _varint((number << 3) | 2) + _varint(len(value)) + value
+
+def _typed_message(type_name, value):
+    """Encode xray.common.serial.TypedMessage"""
+    return _field_bytes(1, type_name) + _field_bytes(2, value)
+
+def _vmess_user(email, uuid, level=0):
+    """Encode xray.common.protocol.User carrying a VMess account"""
+    account = _field_bytes(1, uuid)
+    return (
+        _field_varint(1, level)
+        + _field_bytes(2, email)
+        + _field_bytes(3, _typed_message("xray.proxy.vmess.Account", account))
+    )
+
+def _decode_fields(data):
+    """Yield (field number, value) pairs from an encoded protobuf message"""
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        yield number, value
+
+def _read_varint(data, pos):
+    """Decode a varint at pos, return (value, new position)"""
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def _decode_stat(data):
+    """Decode xray.app.stats.command.Stat into (name, value)"""
+    name, value = "", 0
+    for number, field in _decode_fields(data):
+        if number == 1:
+            name = bytes(field).decode()
+        elif number == 2:
+            value = field
+    return name, value
+
+def _alter_inbound_request(tag, operation_type, operation):
+    """Encode xray.app.proxyman.command.AlterInboundRequest"""
+    return _field_bytes(1, tag) + _field_bytes(2, _typed_message(operation_type, operation))
+
+def get_channel(address=None):
+    """Return a long-lived gRPC channel to the XRay API, creating it once"""
+    address = address or XRAY_API_ADDRESS
+    channel = _channels.get(address)
+    if channel is None:
+        import grpc
+        channel = grpc.insecure_channel(address)
+        _channels[address] = channel
+    return channel
+
+def close_channels():
+    """Close all cached API channels"""
+    for channel in _channels.values():
+        channel.close()
+    _channels.clear()
+
+def call(method, request, address=None, timeout=API_TIMEOUT):
+    """Invoke a unary API method with a pre-encoded request, return raw bytes"""
+    stub = get_channel(address).unary_unary(method)
+    return stub(request, timeout=timeout)
+
+# HandlerService
+
+def add_vmess_client(tag, email, uuid, level=0, address=None):
+    """Add a VMess client to a running inbound without restarting XRay"""
+    try:
+        request = _alter_inbound_request(
+            tag,
+            "xray.app.proxyman.command.AddUserOperation",
+            _field_bytes(1, _vmess_user(email, uuid, level)),
+        )
+        call(f"{HANDLER_SERVICE}/AlterInbound", request, address)
+        return True, "User added via API"
+    except Exception as e:
+        return False, f"XRay API error: {e}"
+
+def remove_client(tag, email, address=None):
+    """Remove a client (matched by email) from a running inbound"""
+    try:
+        request = _alter_inbound_request(
+            tag,
+            "xray.app.proxyman.command.RemoveUserOperation",
+            _field_bytes(1, email),
+        )
+        call(f"{HANDLER_SERVICE}/AlterInbound", request, address)
+        return True, "User removed via API"
+    except Exception as e:
+        return False, f"XRay API error: {e}"
+
+# StatsService
+
+def query_stats(pattern="", reset=False, address=None):
+    """QueryStats: return [(name, value)] for counters whose name contains pattern"""
+    request = _field_bytes(1, pattern) + _field_varint(2, int(reset))
+    response = call(f"{STATS_SERVICE}/QueryStats", request, address)
+    return [_decode_stat(field) for number, field in _decode_fields(response) if number == 1]
+
+def get_stat(name, reset=False, address=None):
+    """GetStats: return the value of a single counter"""
+    request = _field_bytes(1, name) + _field_varint(2, int(reset))
+    response = call(f"{STATS_SERVICE}/GetStats", request, address)
+    for number, field in _decode_fields(response):
+        if number == 1:
+            return _decode_stat(field)[1]
+    return 0
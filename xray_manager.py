@@ -1,113 +1,698 @@
+import asyncio
+import contextlib
 import json
+import os
 import subprocess
+import tempfile
+import threading
+import time
 import uuid as uuid_lib
-from config import XRAY_CONFIG_PATH
+from config import (
+    XRAY_CONFIG_PATH, XRAY_SERVICE, XRAY_BINARY, XRAY_CONFIG_TEST, XRAY_RELOAD_MODE,
+    XRAY_API_ADDRESS, VMESS_INBOUND_TAG, USE_XRAY_API
+)
+import bluegreen
+import sharding
+import xray_api
+from async_utils import run_blocking
+from locking import FileLock
+from metrics import config_write_seconds, xray_restart_seconds
+
+# Mutations arriving within this many seconds are committed together
+COMMIT_DEBOUNCE = 0.05
+
+# Compact output: at tens of thousands of clients indent=2 more than doubles the file
+COMPACT_ENCODER = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+# Long lists are encoded this many items at a time
+ENCODE_CHUNK = 1000
+
+# What the bot needs from XRay's API: live client changes and traffic counters
+API_TAG = "api"
+API_SERVICES = ("HandlerService", "StatsService", "LoggerService")
+
+# Counters to verify coalescing under burst load
+commit_stats = {
+    'config_writes': 0,
+    'reloads': 0,
+    'batches': 0,
+    'last_batch_size': 0,
+    'max_batch_size': 0
+}
 
 def generate_uuid():
     """Generate random UUID for VMess"""
     return str(uuid_lib.uuid4())
 
-def read_xray_config():
-    """Read XRay config from server"""
+def default_xray_config(shard=None):
+    """Config used when there is no file yet, on the shard's port and path if given"""
+    config = {
+        "inbounds": [{
+            "tag": VMESS_INBOUND_TAG,
+            "port": shard.port if shard else 443,
+            "listen": "0.0.0.0",
+            "protocol": "vmess",
+            "settings": {
+                "clients": []
+            },
+            "streamSettings": {
+                "network": "ws",
+                "wsSettings": {
+                    "path": shard.path if shard else "/vmess",
+                    "headers": {}
+                }
+            }
+        }],
+        "outbounds": [{
+            "protocol": "freedom"
+        }]
+    }
+    provision_stats(config, api_port(shard))
+    return config
+
+def api_port(shard=None):
+    """Port of the API inbound, per shard when sharding"""
+    return shard.api_port if shard else int(XRAY_API_ADDRESS.rsplit(':', 1)[1])
+
+def _ensure(mapping, key, value):
+    """setdefault that reports whether it changed anything"""
+    if mapping.get(key) == value:
+        return False
+    mapping[key] = value
+    return True
+
+def provision_stats(config, port):
+    """Enable the API and per-user traffic counters, True if the config changed.
+
+    Adds the stats service, an API with the Handler/Stats services, a
+    dokodemo-door inbound on 127.0.0.1:port routed to it, and the policy
+    that makes XRay count traffic per client email. Settings already there
+    (another API tag or port) are kept.
+    """
+    changed = 'stats' not in config
+    config.setdefault('stats', {})
+
+    api = config.setdefault('api', {})
+    tag = api.setdefault('tag', API_TAG)
+    services = api.setdefault('services', [])
+    missing = [service for service in API_SERVICES if service not in services]
+    services.extend(missing)
+    changed |= bool(missing)
+
+    policy = config.setdefault('policy', {})
+    level = policy.setdefault('levels', {}).setdefault('0', {})
+    system = policy.setdefault('system', {})
+    for mapping, key in ((level, 'statsUserUplink'), (level, 'statsUserDownlink'),
+                         (system, 'statsInboundUplink'), (system, 'statsInboundDownlink'),
+                         (system, 'statsOutboundUplink'), (system, 'statsOutboundDownlink')):
+        changed |= _ensure(mapping, key, True)
+
+    inbounds = config.setdefault('inbounds', [])
+    if not any(inbound.get('tag') == tag for inbound in inbounds):
+        inbounds.append({
+            "tag": tag,
+            "listen": "127.0.0.1",
+            "port": port,
+            "protocol": "dokodemo-door",
+            "settings": {"address": "127.0.0.1"}
+        })
+        changed = True
+
+    rules = config.setdefault('routing', {}).setdefault('rules', [])
+    if not any(rule.get('outboundTag') == tag and tag in rule.get('inboundTag', []) for rule in rules):
+        # First, so no catch-all rule ahead of it swallows API calls
+        rules.insert(0, {"type": "field", "inboundTag": [tag], "outboundTag": tag})
+        changed = True
+    return changed
+
+def backfill_emails(clients, usernames):
+    """Tag clients with their account's username as email, joined on UUID.
+
+    usernames maps UUID to username. Returns how many clients changed;
+    clients with no account are left as they are.
+    """
+    tagged = 0
+    for uuid, client in clients.items():
+        username = usernames.get(uuid)
+        if username and client.get('email') != username:
+            clients[uuid] = dict(client, email=username)
+            tagged += 1
+    return tagged
+
+def _file_key(path):
+    """Identity of a file on disk, changes whenever it is rewritten or replaced"""
     try:
-        with open(XRAY_CONFIG_PATH, 'r') as f:
-            return json.load(f)
+        st = os.stat(path)
     except FileNotFoundError:
-        # Return default config if file doesn't exist
-        return {
-            "inbounds": [{
-                "port": 443,
-                "listen": "0.0.0.0",
-                "protocol": "vmess",
-                "settings": {
-                    "clients": []
-                },
-                "streamSettings": {
-                    "network": "ws",
-                    "wsSettings": {
-                        "path": "/vmess",
-                        "headers": {}
-                    }
-                }
-            }],
-            "outbounds": [{
-                "protocol": "freedom"
-            }]
-        }
-
-def write_xray_config(config):
-    """Write XRay config to server"""
-    with open(XRAY_CONFIG_PATH, 'w') as f:
-        json.dump(config, f, indent=2)
-
-def restart_xray():
-    """Restart XRay service"""
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class ConfigModel:
+    """One parsed XRay config, kept in memory and reloaded only when the file changes.
+
+    clients indexes the VMess inbound's clients by UUID and is the source of
+    truth for them while the model is loaded; the inbound's client list is
+    rebuilt from it on save. clients is never changed in place, a commit
+    swaps in a new dict, so readers use it without any lock. Writers go
+    through transaction().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.config = None
+        self.inbound = None
+        self.clients = {}
+        self.key = None
+        self.lock = threading.RLock()
+        # Other processes (agent, tools) writing the same file take this too
+        self.file_lock = FileLock(path + ".lock")
+
+    def load(self):
+        """Parse the file if it changed on disk since the last load or save"""
+        key = _file_key(self.path)
+        if self.config is not None and key == self.key:
+            return self
+        with self.lock:
+            key = _file_key(self.path)
+            if self.config is None or key != self.key:
+                if key is None:
+                    config = default_xray_config(sharding.shard_for_path(self.path))
+                else:
+                    with open(self.path, 'r') as f:
+                        config = json.load(f)
+                self._set(config, key)
+            return self
+
+    def _set(self, config, key, clients=None):
+        inbound = find_vmess_inbound(config)
+        if clients is None:
+            # Dict order keeps the original client order
+            clients = {c.get('id'): c for c in (inbound['settings'].get('clients', []) if inbound else [])}
+        # key goes last: a lock-free load() that sees it sees everything else
+        self.clients = clients
+        self.inbound = inbound
+        self.config = config
+        self.key = key
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Hold the model against other threads and processes for a read-modify-write"""
+        with self.lock, self.file_lock:
+            self.load()
+            yield self
+
+    def save(self, config=None, clients=None):
+        """Write the model with new clients, or a replacement config, atomically"""
+        with self.lock, self.file_lock:
+            if config is None:
+                config = self.config
+                if clients is None:
+                    clients = self.clients
+                if self.inbound is not None:
+                    self.inbound['settings']['clients'] = list(clients.values())
+            write_config_file(config, self.path)
+            self._set(config, _file_key(self.path), clients)
+
+    def invalidate(self):
+        """Forget the in-memory state, the next load re-reads the file"""
+        with self.lock:
+            self.config = None
+
+_models = {}
+_models_lock = threading.Lock()
+
+def get_model(path=XRAY_CONFIG_PATH):
+    """The shared, up-to-date config model for a path"""
+    model = _models.get(path)
+    if model is None:
+        with _models_lock:
+            model = _models.setdefault(path, ConfigModel(path))
+    return model.load()
+
+def read_xray_config(path=XRAY_CONFIG_PATH):
+    """Return the cached XRay config, re-read only if the file changed.
+
+    The document is shared: change it only to pass it to write_xray_config.
+    """
+    return get_model(path).config
+
+def test_xray_config(path):
+    """Pre-flight check with 'xray run -test', raise ValueError if XRay rejects it"""
+    try:
+        result = subprocess.run(
+            [XRAY_BINARY, 'run', '-test', '-config', path],
+            capture_output=True, text=True, timeout=30
+        )
+    except FileNotFoundError:
+        raise ValueError(f"{XRAY_BINARY} not found for config test")
+    if result.returncode != 0:
+        output = (result.stdout + result.stderr).strip().splitlines()
+        raise ValueError(f"XRay rejected the config: {output[-1] if output else result.returncode}")
+
+def _flat(value):
+    """True for scalars and for containers holding only scalars"""
+    if isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, list):
+        return True
+    return not any(isinstance(item, (dict, list)) for item in value)
+
+def iter_compact_json(value):
+    """Compact JSON in pieces, so a huge client list is never one string.
+
+    Dicts and lists are walked down to flat ones (only scalars inside),
+    which go through the C encoder in one call; runs of flat list items
+    are encoded ENCODE_CHUNK at a time, so no piece holds more than one
+    chunk of clients. (JSONEncoder.iterencode would fall back to the much
+    slower pure-Python encoder.) Dicts with non-string keys are encoded
+    whole, so the encoder converts the keys the way json.dumps does.
+    """
+    if isinstance(value, dict) and not _flat(value) and all(isinstance(key, str) for key in value):
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                yield ','
+            yield COMPACT_ENCODER.encode(key)
+            yield ':'
+            yield from iter_compact_json(item)
+        yield '}'
+    elif isinstance(value, list) and (len(value) > ENCODE_CHUNK or not _flat(value)):
+        yield '['
+        separator = ''
+        batch = []
+        for item in value:
+            if _flat(item):
+                batch.append(item)
+                if len(batch) == ENCODE_CHUNK:
+                    yield separator + COMPACT_ENCODER.encode(batch)[1:-1]
+                    separator = ','
+                    batch = []
+                continue
+            if batch:
+                yield separator + COMPACT_ENCODER.encode(batch)[1:-1]
+                separator = ','
+                batch = []
+            if separator:
+                yield separator
+            yield from iter_compact_json(item)
+            separator = ','
+        if batch:
+            yield separator + COMPACT_ENCODER.encode(batch)[1:-1]
+        yield ']'
+    else:
+        yield COMPACT_ENCODER.encode(value)
+
+def write_config_file(config, path, check=XRAY_CONFIG_TEST):
+    """Stream compact JSON to a temp file, fsync, optionally test it, then rename over path.
+
+    A crash at any point leaves either the old or the new file, never a
+    truncated one.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix='.xray-', suffix='.json', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for chunk in iter_compact_json(config):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        if check:
+            test_xray_config(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    # Make the rename itself durable
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def write_xray_config(config, path=XRAY_CONFIG_PATH):
+    """Write XRay config to server atomically and make it the cached model"""
+    model = get_model(path)
+    model.save(config)
+
+def restart_xray(service=XRAY_SERVICE):
+    """Restart XRay service, an empty service name skips the restart"""
+    if not service:
+        return False
+    started = time.perf_counter()
     try:
-        subprocess.run(['systemctl', 'restart', 'xray'], check=True)
+        commit_stats['reloads'] += 1
+        subprocess.run(['systemctl', 'restart', service], check=True)
         return True
     except subprocess.CalledProcessError:
         return False
+    finally:
+        xray_restart_seconds.observe(time.perf_counter() - started)
 
-def add_vmess_user(username, uuid):
-    """Add VMess user to XRay config"""
-    config = read_xray_config()
-    
-    # Find VMess inbound
+def _bluegreen_ports(config_path):
+    """Inbound ports of a config, adding the SO_REUSEPORT sockopt they need first"""
+    model = get_model(config_path)
+    with model.transaction():
+        if bluegreen.ensure_reuseport(model.config):
+            model.save()
+        return bluegreen.inbound_ports(model.config)
+
+def reload_xray(config_path=XRAY_CONFIG_PATH, service=XRAY_SERVICE):
+    """Make XRay pick up its config, by blue/green handoff if XRAY_RELOAD_MODE asks for it"""
+    if XRAY_RELOAD_MODE != 'bluegreen' or not service:
+        return restart_xray(service)
+    started = time.perf_counter()
+    try:
+        commit_stats['reloads'] += 1
+        ports = _bluegreen_ports(config_path)
+        if bluegreen.reloader.reload(config_path, ports):
+            return True
+        # Usually the running XRay predates the SO_REUSEPORT sockopt
+        print("Blue/green reload failed, restarting XRay")
+        return bluegreen.reloader.restart(config_path, ports)
+    except Exception as e:
+        print(f"Error reloading XRay: {e}")
+        return False
+    finally:
+        xray_restart_seconds.observe(time.perf_counter() - started)
+
+def start_xray(config_path=XRAY_CONFIG_PATH):
+    """In blue/green mode the bot runs XRay itself (one per shard); start it if it isn't running"""
+    if XRAY_RELOAD_MODE != 'bluegreen':
+        return True
+    paths = [config_path]
+    if config_path == XRAY_CONFIG_PATH and sharding.enabled():
+        paths = [shard.config_path for shard in sharding.shards]
+    return all([bluegreen.reloader.start(path, _bluegreen_ports(path)) for path in paths])
+
+def ensure_inbound_tag(inbound):
+    """Make sure the VMess inbound carries a tag the API can address.
+
+    Returns the tag that is live in the running XRay, or None if the tag was
+    only just added to the config (it takes effect after the next restart).
+    """
+    if inbound.get('tag'):
+        return inbound['tag']
+    inbound['tag'] = VMESS_INBOUND_TAG
+    return None
+
+def hot_add_client(tag, client, address=None):
+    """Add client to running XRay via HandlerService, False if not possible"""
+    if not USE_XRAY_API or not tag:
+        return False
+    success, _ = xray_api.add_vmess_client(tag, client['email'], client['id'], address=address)
+    return success
+
+def hot_remove_client(tag, client, address=None):
+    """Remove client from running XRay via HandlerService, False if not possible"""
+    if not USE_XRAY_API or not tag or not client.get('email'):
+        return False
+    success, _ = xray_api.remove_client(tag, client['email'], address=address)
+    return success
+
+def find_vmess_inbound(config):
+    """Return the VMess inbound of a config, or None"""
     for inbound in config['inbounds']:
         if inbound.get('protocol') == 'vmess':
-            # Check if user already exists
-            clients = inbound['settings'].get('clients', [])
-            if any(client.get('id') == uuid for client in clients):
-                return False, "User already exists"
-            
-            # Add new client (no email field needed)
-            clients.append({
-                "id": uuid,
-                "alterId": 0
-            })
-            inbound['settings']['clients'] = clients
+            return inbound
+    return None
+
+def apply_mutations(mutations, config_path=XRAY_CONFIG_PATH, api_address=None, service=XRAY_SERVICE):
+    """Apply a batch of client changes with one config write and at most one restart.
+
+    Each mutation is ("add", username, uuid) or ("remove", username[, uuid]).
+    Removals without a UUID look it up in the local database. Returns a
+    (success, message) tuple per mutation, in order. With sharding on, the
+    stock config path stands for every shard.
+    """
+    if config_path == XRAY_CONFIG_PATH and sharding.enabled():
+        return apply_sharded(mutations, service)
+    model = get_model(config_path)
+    results = []
+    live_ops = []
+    
+    with model.transaction():
+        inbound = model.inbound
+        if inbound is None:
+            return [(False, "VMess inbound not found")] * len(mutations)
+        # Copy on write: readers keep the committed clients until the save
+        clients = dict(model.clients)
+        
+        for mutation in mutations:
+            action, username = mutation[0], mutation[1]
+            if action == "add":
+                uuid = mutation[2]
+                if uuid in clients:
+                    results.append((False, "User already exists"))
+                    continue
+                # Email is what the API uses to address the client later
+                client = {
+                    "id": uuid,
+                    "alterId": 0,
+                    "email": username
+                }
+                clients[uuid] = client
+                live_ops.append((hot_add_client, client))
+                results.append((True, "User added successfully"))
+            elif action == "remove":
+                if len(mutation) > 2:
+                    uuid = mutation[2]
+                else:
+                    from database import get_user
+                    user = get_user(username)
+                    if not user:
+                        results.append((False, "User not found in database"))
+                        continue
+                    uuid = user['uuid']
+                client = clients.pop(uuid, None)
+                if client is None:
+                    results.append((False, "User not found in XRay config"))
+                    continue
+                live_ops.append((hot_remove_client, client))
+                results.append((True, "User removed successfully"))
+            else:
+                results.append((False, f"Unknown action: {action}"))
+        
+        if live_ops:
+            tag = ensure_inbound_tag(inbound)
             
-            write_xray_config(config)
-            restart_xray()
-            return True, "User added successfully"
+            # Persist for the next cold start
+            started = time.perf_counter()
+            try:
+                model.save(clients=clients)
+            except Exception as e:
+                # The old file is untouched, drop our changes with it
+                model.invalidate()
+                live_ops = []
+                results = [(False, f"Config write failed: {e}") if ok else (ok, message) for ok, message in results]
+            else:
+                config_write_seconds.observe(time.perf_counter() - started)
+                commit_stats['config_writes'] += 1
+    
+    # Then apply live, outside the lock so readers aren't held up by the API
+    if live_ops and not all(op(tag, client, api_address) for op, client in live_ops):
+        reload_xray(config_path, service)
     
-    return False, "VMess inbound not found"
+    commit_stats['batches'] += 1
+    commit_stats['last_batch_size'] = len(mutations)
+    commit_stats['max_batch_size'] = max(commit_stats['max_batch_size'], len(mutations))
+    return results
 
-def remove_vmess_user(username):
-    """Remove VMess user from XRay config by UUID"""
-    # Get user's UUID from database
-    from database import get_user
-    user = get_user(username)
-    if not user:
-        return False, "User not found in database"
+def apply_sharded(mutations, service=XRAY_SERVICE):
+    """Apply mutations on the shards their UUIDs hash to.
+
+    Only shards that get a mutation are written and, if needed, reloaded.
+    An empty service still means never restart.
+    """
+    results = [None] * len(mutations)
+    per_shard = {}
+    for i, mutation in enumerate(mutations):
+        action, username = mutation[0], mutation[1]
+        if action == "remove" and len(mutation) < 3:
+            from database import get_user
+            user = get_user(username)
+            if not user:
+                results[i] = (False, "User not found in database")
+                continue
+            mutation = ("remove", username, user['uuid'])
+        elif action not in ("add", "remove"):
+            results[i] = (False, f"Unknown action: {action}")
+            continue
+        per_shard.setdefault(sharding.shard_for(mutation[2]), []).append((i, mutation))
     
-    uuid = user['uuid']
-    config = read_xray_config()
+    for shard, batch in per_shard.items():
+        shard_results = apply_mutations(
+            [mutation for _, mutation in batch], shard.config_path,
+            api_address=shard.api_address, service=shard.service if service else ""
+        )
+        for (i, _), result in zip(batch, shard_results):
+            results[i] = result
+    return results
+
+def prepare_shards(service=XRAY_SERVICE):
+    """Create missing shard configs and move clients to the shard they hash to.
+
+    Clients of the unsharded config are copied into their shards, so
+    turning sharding on keeps every account. Returns the number of clients
+    added to a shard.
+    """
+    if not sharding.enabled():
+        return 0
+    os.makedirs(os.path.dirname(sharding.shards[0].config_path), exist_ok=True)
+    adds, removes = {}, {}
+    for shard in sharding.shards:
+        if not os.path.exists(shard.config_path):
+            get_model(shard.config_path).save()
+            if service:
+                reload_xray(shard.config_path, shard.service)
+        for client in get_vmess_users(shard.config_path):
+            target = sharding.shard_for(client['id'])
+            if target is not shard:
+                adds.setdefault(target, []).append(("add", client.get('email', ''), client['id']))
+                removes.setdefault(shard, []).append(("remove", client.get('email', ''), client['id']))
+    if os.path.exists(XRAY_CONFIG_PATH):
+        sharded = {client['id'] for shard in sharding.shards for client in get_vmess_users(shard.config_path)}
+        legacy = [
+            client for uuid, client in get_model(XRAY_CONFIG_PATH).clients.items()
+            if uuid and uuid not in sharded
+        ]
+        for client in legacy:
+            adds.setdefault(sharding.shard_for(client['id']), []).append(("add", client.get('email', ''), client['id']))
     
-    for inbound in config['inbounds']:
-        if inbound.get('protocol') == 'vmess':
-            clients = inbound['settings'].get('clients', [])
-            original_count = len(clients)
-            
-            # Remove user by UUID
-            clients = [c for c in clients if c.get('id') != uuid]
-            
-            if len(clients) < original_count:
-                inbound['settings']['clients'] = clients
-                write_xray_config(config)
-                restart_xray()
-                return True, "User removed successfully"
-            else:
-                return False, "User not found in XRay config"
+    moved = 0
+    # Adds first so a moved client is never missing from both shards
+    for changes in (adds, removes):
+        for shard, batch in changes.items():
+            results = apply_mutations(batch, shard.config_path, api_address=shard.api_address,
+                                      service=shard.service if service else "")
+            if changes is adds:
+                moved += sum(1 for ok, _ in results if ok)
+    return moved
+
+def upgrade_xray_config(config_path=XRAY_CONFIG_PATH, service=XRAY_SERVICE, port=None, usernames=None):
+    """Provision stats and the API in a config and backfill client emails.
+
+    Also tags the VMess inbound, so the first hot add does not need a
+    restart. usernames maps UUID -> username for the email backfill; the
+    agent has no database and passes none. Returns (provisioned, tagged).
+    XRay is reloaded if either changed anything, a running process picks
+    up neither. With sharding on, the stock config path upgrades every
+    shard.
+    """
+    if config_path == XRAY_CONFIG_PATH and sharding.enabled():
+        results = [
+            upgrade_xray_config(shard.config_path, shard.service if service else "", usernames=usernames)
+            for shard in sharding.shards
+        ]
+        return any(provisioned for provisioned, _ in results), sum(tagged for _, tagged in results)
     
-    return False, "VMess inbound not found"
+    model = get_model(config_path)
+    with model.transaction():
+        provisioned = provision_stats(model.config, port or api_port(sharding.shard_for_path(config_path)))
+        if model.inbound is not None and ensure_inbound_tag(model.inbound) is None:
+            provisioned = True
+        clients = dict(model.clients)
+        tagged = backfill_emails(clients, usernames) if usernames else 0
+        if provisioned or tagged:
+            model.save(clients=clients)
+    if provisioned or tagged:
+        reload_xray(config_path, service)
+    return provisioned, tagged
+
+def add_vmess_user(username, uuid):
+    """Add VMess user to XRay config"""
+    return apply_mutations([("add", username, uuid)])[0]
+
+def remove_vmess_user(username):
+    """Remove VMess user from XRay config by UUID"""
+    return apply_mutations([("remove", username)])[0]
+
+def add_vmess_users(accounts):
+    """Add many (username, uuid) accounts in a single config commit"""
+    return apply_mutations([("add", username, uuid) for username, uuid in accounts])
 
-def get_vmess_users():
-    """Get all VMess users from XRay config"""
-    config = read_xray_config()
+class CommitScheduler:
+    """Coalesce config mutations that arrive within a short window.
+
+    Callers await their own (success, message) result while the worker
+    applies everything queued during the debounce window as one batch.
+    """
     
-    for inbound in config['inbounds']:
-        if inbound.get('protocol') == 'vmess':
-            return inbound['settings'].get('clients', [])
+    def __init__(self, debounce=COMMIT_DEBOUNCE, apply=apply_mutations):
+        self.debounce = debounce
+        self.apply = apply
+        self._queue = None
+        self._worker = None
     
-    return []
+    async def submit(self, mutation):
+        """Queue a mutation and wait for its result"""
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((mutation, future))
+        return await future
+    
+    async def submit_many(self, mutations):
+        """Queue several mutations so they land in the same batch"""
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        futures = []
+        # The queue is unbounded so nothing here yields to the worker
+        for mutation in mutations:
+            future = loop.create_future()
+            self._queue.put_nowait((mutation, future))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+    
+    async def _run(self):
+        """Drain the queue in debounced batches"""
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.debounce)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            try:
+                results = await run_blocking(self.apply, [m for m, _ in batch])
+            except Exception as e:
+                results = [(False, f"Config commit failed: {e}")] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+scheduler = CommitScheduler()
+
+async def add_vmess_user_async(username, uuid):
+    """Add VMess user through the coalescing commit scheduler"""
+    return await scheduler.submit(("add", username, uuid))
+
+async def remove_vmess_user_async(username):
+    """Remove VMess user through the coalescing commit scheduler"""
+    return await scheduler.submit(("remove", username))
+
+async def add_vmess_users_async(accounts):
+    """Add many (username, uuid) accounts through the scheduler as one batch"""
+    return await scheduler.submit_many([("add", username, uuid) for username, uuid in accounts])
+
+def get_vmess_users(config_path=XRAY_CONFIG_PATH):
+    """Get all VMess users from XRay config, from every shard if sharding is on"""
+    if config_path == XRAY_CONFIG_PATH and sharding.enabled():
+        return [client for shard in sharding.shards for client in get_vmess_users(shard.config_path)]
+    return list(get_model(config_path).clients.values())
+
+def find_vmess_client(uuid, config_path=XRAY_CONFIG_PATH):
+    """Look up a VMess client by UUID in O(1), or None"""
+    if config_path == XRAY_CONFIG_PATH and sharding.enabled():
+        config_path = sharding.shard_for(uuid).config_path
+    return get_model(config_path).clients.get(uuid)